@@ -1,55 +1,116 @@
 import threading
+import queue
 import app.settings as settings
 from app.lib.jobqueue import Jobqueue, JOB_STATUS_COLLECTION, JOB_DEFINITIONS, JOB_COLLECTION, STATUS_RUNNING, \
-    STATUS_FAILED, STATUS_CREATING, STATUS_COMPLETE, MAX_STDLOG_SIZE
+    STATUS_FAILED, STATUS_CREATING, STATUS_COMPLETE, STATUS_CANCELLED, STATUS_RETRY, TERMINAL_STATUSES, \
+    MAX_STDLOG_SIZE, job_key
 import logging
 import traceback
 import datetime
+import time
+from functools import partial
+from pymongo import UpdateOne
 from app.lib.setup import update_fiat_rates
 from app.lib.db import remove_api_method_locks
+from app.lib.workerpool import WorkerPool
+from app.lib.dispatcher import JobDispatcher
+from app.lib.scheduler import JobScheduler
+from app.lib.cadence import AdaptiveCadence
+from app.lib.retryqueue import RetryQueue, retry_delay
+from app.lib import lease
+from app.lib.archive import archive
 from os import getpid, kill
+from socket import gethostname
+
+
+# the key of the single compare interval in compare_trade_pairs_intervals with COMPARE_BATCH
+COMPARE_BATCH_INTERVAL = 'COMPARE_BATCH'
 
 
 # Create an instance of the app! Execute a job queue. Begin scraping prices of crypto. Look for jobs to start based on
 # the scrapes.
 class JobQueueExecutor:
 
-    def __init__(self):
+    # trade_pairs and exchanges are given to a shard of the executor, see app.lib.sharding. Without them the executor
+    # compares every trade pair and runs every job
+    def __init__(self, trade_pairs=None, exchanges=None):
         self.jq = Jobqueue()
-        self.runningjobs = []
+        self.sharded = trade_pairs is not None
+        self.trade_pairs = list(trade_pairs if trade_pairs is not None else settings.TRADE_PAIRS)
+        self.exchanges = list(exchanges or [])
+        # _id => JobQueueThread of the jobs running in this process
+        self.runningjobs = {}
+        # running jobs put their thread here as soon as they finish
+        self.completed = queue.Queue()
+        self.reaper = None
         self.compare_trade_pairs_intervals = {}
+        # set while too many jobs are waiting to add more COMPARE jobs, see compares_paused
+        self.compares_paused_at = None
+        # with COMPARE_BATCH: when each trade pair was last added to a batch and the pairs in batches waiting or running
+        self.batched_at = {}
+        self.batched_pairs = set()
         self.start_jobs_interval = None
         self._id = None
         self.running = False
-        self.finishedjobs = []
+        # jobs either run in their own subprocess or in a pool of long lived workers
+        self.pool = None
+        if settings.JOB_EXECUTION_MODE == 'pool':
+            self.pool = WorkerPool()
+        self.dispatcher = None
+        # jobs wait here until there is room for them to run
+        self.scheduler = JobScheduler(self.launch_job, self.cancel_job)
+        # how often each trade pair is compared, shards split the request budgets evenly between them
+        self.cadence = AdaptiveCadence(self.trade_pairs,
+                                       budget_share=1 / settings.EXECUTOR_SHARDS if self.sharded else 1)
+        # job_key of the jobs this executor has added that are waiting or running
+        self.active_job_keys = set()
+        # keys and batched pairs held for jobs that were not found at the last sync_job_keys
+        self.missing_job_keys = set()
+        self.missing_batched_pairs = set()
+        # jobs waiting to be retried
+        self.retries = RetryQueue(self.retry_job)
         return
 
     def execute(self):
         # this is the  job queue monitor that polls the database for new, completed, and failed jobs
         # it will periodically run compares for a set list of currency pairs
 
-        self.jq.db[JOB_STATUS_COLLECTION].remove()
-
-        self._id = self.jq.db[JOB_STATUS_COLLECTION].insert({'running': True, 'pid': getpid()})
-
-        # remove any api locks that were stored previously
-        remove_api_method_locks()
+        self.register()
 
         # we are going to constantly check apis for arbitrage opportunities
-        for trade_pair in settings.TRADE_PAIRS:
-            logging.debug(trade_pair)
-            self.compare_trade_pairs_intervals[trade_pair] = call_repeatedly(settings.INTERVAL_COMPARE,
-                                                                             self.compare_trade_pair,
-                                                                             trade_pair)
+        if settings.COMPARE_BATCH:
+            self.compare_trade_pairs_intervals[COMPARE_BATCH_INTERVAL] = call_repeatedly(
+                settings.INTERVAL_COMPARE_MIN, self.compare_trade_pairs)
+        else:
+            for trade_pair in self.trade_pairs:
+                logging.debug(trade_pair)
+                self.compare_trade_pairs_intervals[trade_pair] = call_repeatedly(partial(self.cadence.interval,
+                                                                                         trade_pair),
+                                                                                 self.compare_trade_pair,
+                                                                                 trade_pair)
 
         # we periodically update the fiat rate of BTC to identify potential profit
         self.fiat_rate_interval = call_repeatedly(settings.INTERVAL_FIAT_RATE, update_fiat_rates)
 
-        # when opportunities are identified they are added as jobs to the db. this next function will be notified of any
-        # new jobs that are added and it will be called
-        self.jq.bind_to(self.start_job)
+        # when opportunities are identified they are added as jobs to the db. start_job will be called for any new jobs,
+        # either by following the jobs collection or by being notified when this process adds one
+        if settings.JOB_DISPATCH_MODE == 'changestream':
+            self.dispatcher = JobDispatcher(self.jq.db[JOB_COLLECTION], self.start_job)
+            self.dispatcher.start()
+        else:
+            self.jq.bind_to(self.start_jobs)
 
-        self.check_running_jobs_interval = call_repeatedly(settings.INTERVAL_RUNNINGJOBS, self.check_running_jobs)
+        self.reaper = threading.Thread(target=self.reap_jobs, daemon=True)
+        self.reaper.start()
+
+        # keep our leases alive and take over the jobs of executors that have died
+        self.heartbeat_interval = call_repeatedly(settings.JOB_HEARTBEAT_INTERVAL, self.heartbeat)
+
+        # keep the jobs collection small by moving old finished jobs into history
+        self.archive_interval = call_repeatedly(settings.INTERVAL_ARCHIVE, self.archive_jobs)
+
+        self.start_retries()
+        self.start_released()
 
         # TODO jobs to check balances between exchanges and periodically move large amounts
         # job is called REPLENISH
@@ -60,16 +121,85 @@ class JobQueueExecutor:
 
         return
 
-    def start_job(self, _id):
+    # other executors may be sharing the database so only our own status is added, see heartbeat
+    def register(self):
+        self._id = self.jq.db[JOB_STATUS_COLLECTION].insert_one({'running': True,
+                                                                 'pid': getpid(),
+                                                                 'host': gethostname(),
+                                                                 'heartbeat': time.time()}).inserted_id
+        # jobs added by our jobs belong to this job queue
+        self.jq._id = self._id
 
-        job = self.jq.db[JOB_COLLECTION].find_one({'_id': _id})
-        job_type = job['job_type']
-        if job_type not in JOB_DEFINITIONS:
-            raise TypeError('Unknown job type {}'.format(job_type))
+        # remove any api locks that were stored by job queues that are no longer running
+        remove_api_method_locks()
 
-        if job_type in settings.JOBS_NOT_RUNNING:
+    def heartbeat(self):
+        self.jq.db[JOB_STATUS_COLLECTION].update_one({'_id': self._id}, {'$set': {'heartbeat': time.time()}})
+        jobs = self.jq.db[JOB_COLLECTION]
+        lease.renew(jobs, self._id)
+        self.sync_job_keys()
+        reclaimed, failed = lease.reclaim_expired(jobs)
+        if reclaimed or failed:
+            logging.info('Reclaimed {} and failed {} jobs of job queues that stopped'.format(len(reclaimed), failed))
+            remove_api_method_locks()
+        # only a job queue following the jobs collection hears about jobs put back to CREATING
+        self.start_jobs(reclaimed)
+
+    def archive_jobs(self):
+        try:
+            archive(self.jq.db)
+        except Exception:
+            # try again next time rather than stopping the interval
+            logging.error('Error archiving jobs: {}'.format(traceback.format_exc()))
+
+    def start_job(self, _id):
+        self.start_jobs([_id])
+
+    # jobs added together, e.g. both legs of an arbitrage, are handed to the scheduler together
+    def start_jobs(self, _ids):
+        _ids = [_id for _id in _ids if not self.scheduler.is_known(_id)]
+        if not _ids:
             return
 
+        jobs = []
+        # jobs that have already been started are not returned
+        for job in self.jq.db[JOB_COLLECTION].find({'_id': {'$in': _ids}, 'job_status': STATUS_CREATING}):
+            job_type = job['job_type']
+            # left CREATING, for the shard it belongs to or until the job type is switched back on
+            if job_type in settings.JOBS_NOT_RUNNING or not self.owns_job(job):
+                continue
+            try:
+                if job_type not in JOB_DEFINITIONS:
+                    raise TypeError('Unknown job type {}'.format(job_type))
+                # check the arguments now rather than when the scheduler gets round to the job
+                self.build_safecmd(job)
+            except TypeError as e:
+                logging.error('Not starting job {}: {}'.format(job['_id'], e))
+                self.cancel_job(job, str(e), STATUS_FAILED)
+                continue
+            jobs.append(job)
+
+        # keep the order the jobs were added in
+        jobs.sort(key=lambda x: _ids.index(x['_id']))
+        self.scheduler.submit_many(jobs)
+
+    # Every shard follows the whole jobs collection so each one only starts the jobs that belong to it. In 'observer'
+    # dispatch mode a shard only hears about the jobs it added itself and runs all of them
+    def owns_job(self, job):
+        if not self.sharded or settings.JOB_DISPATCH_MODE != 'changestream':
+            return True
+        job_args = job['job_args']
+        if job['job_type'] == 'COMPARE':
+            return '{}-{}'.format(job_args.get('curr_x'), job_args.get('curr_y')) in self.trade_pairs
+        if job['job_type'] == 'COMPARE_BATCH':
+            # a batch only ever holds the trade pairs of the shard that added it
+            return job_args.get('trade_pairs', '').split(',')[0] in self.trade_pairs
+        if job_args.get('exchange'):
+            return job_args['exchange'] in self.exchanges
+        return True
+
+    def build_safecmd(self, job):
+        job_type = job['job_type']
         safecmd = ['app.jobs.{}'.format(job_type.lower())]
         for arg_key, arg_value in job['job_args'].items():
             type_function = None
@@ -78,42 +208,191 @@ class JobQueueExecutor:
                 safecmd.append(type_function(arg_value))
             except:
                 raise TypeError('Invalid job argument supplied: {} should be {}'.format(arg_value, type_function))
-        jobthread = JobQueueThread(self.jq, job, safecmd)
+        return safecmd
+
+    # called by the scheduler when there is room for the job to run
+    def launch_job(self, job):
+        safecmd = self.build_safecmd(job)
+        job = self.claim_job(job)
+        if not job:
+            return False
+
+        jobthread = JobQueueThread(self.jq, job, safecmd, self.pool, on_complete=self.completed.put)
         jobthread.setDaemon(True)
+        self.runningjobs[job['_id']] = jobthread
         jobthread.start()
-        job['job_startat'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        job['job_status'] = STATUS_RUNNING
-        job['job_lock'] = True
-        job['jobqueue_id'] = self._id
-        self.jq.update_job(job)
-        self.runningjobs.append(jobthread)
-
-    def check_running_jobs(self):
-        ok = True
-        self.finishedjobs = []
-        for jobthread in self.runningjobs:
-            if not jobthread.is_alive():
-                # the thread is /probably/ dead. But it may simply not have quite started yet. Give it a while to join, then check again
-                jobthread.join(2)
-                if not jobthread.is_alive():
-
-                    self.finishedjobs.append(jobthread)
-
-                # we had an internal error => immediate quit!
+        return True
+
+    # claim the job so that it is only started once, however many times we are told about it
+    def claim_job(self, job):
+        dispatched = time.time()
+        claim = {'job_startat': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                 'job_lock': True,
+                 'jobqueue_id': self._id,
+                 'job_timestamps.dispatched': dispatched}
+        enqueued = job.get('job_timestamps', {}).get('enqueued')
+        if enqueued:
+            claim['job_dispatch_latency'] = dispatched - enqueued
+        # a retried or reclaimed job starts without the result of its last attempt
+        return lease.claim(self.jq.db[JOB_COLLECTION], job['_id'], self._id, claim, unset=['job_result', 'job_error'])
+
+    # called by the scheduler and start_jobs for jobs that will not be run
+    def cancel_job(self, job, reason, status=STATUS_CANCELLED):
+        logging.debug('Cancelling {} {}: {}'.format(job['job_type'], job['_id'], reason))
+        self.jq.db[JOB_COLLECTION].update_one({'_id': job['_id'], 'job_status': STATUS_CREATING},
+                                              {'$set': {'job_status': status, 'job_error': reason,
+                                                        'job_timestamps.finished': time.time()},
+                                               '$unset': {'job_key': ''}})
+        self.forget_job_key(job)
+
+    # Finishes jobs as their threads complete. Waits for one job to complete then takes every other job that has
+    # completed in the meantime, so that their updates go to the database in one bulk write
+    def reap_jobs(self):
+        stopping = False
+        while not stopping:
+            finished = [self.completed.get()]
+            while len(finished) < settings.REAP_BATCH_SIZE:
+                try:
+                    finished.append(self.completed.get_nowait())
+                except queue.Empty:
+                    break
+            # None is put on the queue to stop reaping
+            stopping = None in finished
+            jobthreads = [x for x in finished if x is not None]
+            for jobthread in jobthreads:
+                self.runningjobs.pop(jobthread.job['_id'], None)
                 if jobthread.err:
                     # just print it out normally, cron will nab and email it!
                     print(jobthread.err)
                     print(jobthread.job)
-                    logging.debug(jobthread.err)
+            try:
+                self.finish_jobs([jobthread.job for jobthread in jobthreads])
+            except Exception:
+                logging.error('Error finishing jobs: {}'.format(traceback.format_exc()))
 
-                    ok = False
+    def finish_job(self, job):
+        self.finish_jobs([job])
 
-        for jobthread in self.finishedjobs:
-            self.runningjobs.remove(jobthread)
-            jobthread.job['job_status'] = STATUS_COMPLETE
-            self.jq.update_job(jobthread.job)
-            # logging.debug('Job has finished {}'.format(jobthread.job['job_pid']))
-        return ok
+    def finish_jobs(self, jobs):
+        if not jobs:
+            return
+        retrying = {}
+        updates = []
+        for job in jobs:
+            if job['job_status'] not in TERMINAL_STATUSES:
+                # the job was never run to completion, e.g. the thread running it raised
+                job['job_status'] = STATUS_FAILED
+            retrying[job['_id']] = self.should_retry(job) and self.schedule_retry(job)
+            job.pop('job_lease_expires', None)
+            updates.append(UpdateOne(*self.jq.update_job_request(job, {'job_owner': self._id,
+                                                                       'job_status': STATUS_RUNNING})))
+        result = self.jq.db[JOB_COLLECTION].bulk_write(updates, ordered=False)
+
+        owned = {job['_id'] for job in jobs}
+        if result.matched_count < len(updates):
+            # if our lease ran out the job has been reclaimed and belongs to another job queue now
+            owned = {x['_id'] for x in self.jq.db[JOB_COLLECTION].find({'_id': {'$in': list(owned)},
+                                                                        'job_owner': self._id}, {'_id': 1})}
+
+        for job in jobs:
+            if job['_id'] not in owned:
+                logging.warning('Lost the lease on {} {} before it finished'.format(job['job_type'], job['_id']))
+            if job['_id'] in owned and retrying[job['_id']]:
+                self.retries.schedule(job['_id'], job['job_run_at'])
+            else:
+                self.forget_job_key(job)
+            # make room for waiting jobs
+            self.scheduler.release(job)
+            self.update_cadence(job)
+
+        # a job reclaimed while it was still running here is CREATING again, e.g. on a single node that missed its
+        # heartbeats, and was passed over while it was running. It is started again now
+        self.start_jobs([job['_id'] for job in jobs if job['_id'] not in owned])
+
+    def should_retry(self, job):
+        if (job.get('job_result') or {}).get('retry'):
+            return True
+        return job['job_status'] == STATUS_FAILED and job['job_type'] in settings.RETRY_JOB_TYPES
+
+    # sets the job to be retried later, or returns False if it has been tried too many times already
+    def schedule_retry(self, job):
+        attempts = job.get('job_attempts', 0) + 1
+        if attempts > settings.RETRY_MAX_ATTEMPTS:
+            logging.info('Not retrying {} {}: {} attempts made'.format(job['job_type'], job['_id'], attempts - 1))
+            return False
+        base_delay = (job.get('job_result') or {}).get('retry') or settings.RETRY_BASE_DELAY
+        delay = retry_delay(attempts, base_delay)
+        logging.debug('Retrying {} {} in {:.0f}s'.format(job['job_type'], job['_id'], delay))
+        job['job_status'] = STATUS_RETRY
+        job['job_attempts'] = attempts
+        # stored on the job so that the retry survives a restart of the executor
+        job['job_run_at'] = time.time() + delay
+        return True
+
+    def start_retries(self):
+        for job in self.jq.db[JOB_COLLECTION].find({'job_status': STATUS_RETRY}, {'job_run_at': 1}):
+            self.retries.schedule(job['_id'], job.get('job_run_at', 0))
+        self.retries.start()
+
+    # Jobs handed back by a job queue that stopped are left CREATING with nothing to start them unless the jobs collection
+    # is followed, so they are started when a job queue starts. Only RECLAIM_JOB_TYPES are ever handed back, other jobs
+    # left CREATING are not started behind the back of the job queue that added them
+    def start_released(self):
+        if settings.JOB_DISPATCH_MODE == 'changestream':
+            # the dispatcher starts every CREATING job when it starts following the collection
+            return
+        query = {'job_status': STATUS_CREATING, 'job_type': {'$in': settings.RECLAIM_JOB_TYPES}}
+        self.start_jobs([job['_id'] for job in self.jq.db[JOB_COLLECTION].find(query, {'_id': 1}).sort([('_id', 1)])])
+
+    # called by the retry queue when a job is due to be retried
+    def retry_job(self, _id):
+        result = self.jq.db[JOB_COLLECTION].update_one({'_id': _id, 'job_status': STATUS_RETRY},
+                                                       {'$set': {'job_status': STATUS_CREATING}})
+        if result.modified_count:
+            self.start_job(_id)
+
+    def forget_job_key(self, job):
+        self.active_job_keys.discard(job.get('job_key'))
+        if job['job_type'] == 'COMPARE_BATCH':
+            self.batched_pairs.difference_update(job['job_args']['trade_pairs'].split(','))
+
+    # Compare keys and batched pairs are held from just before their job is added until it finishes. Any still held for
+    # a job that is no longer waiting or running here, e.g. one that was never delivered, are dropped so that the trade
+    # pair is compared again. Only those already missing at the previous sync are dropped, as a key is held for a moment
+    # before its job is inserted
+    def sync_job_keys(self):
+        live_keys, live_pairs = set(), set()
+        for job in self.jq.db[JOB_COLLECTION].find({'jobqueue_id': self._id,
+                                                    'job_type': {'$in': ['COMPARE', 'COMPARE_BATCH']},
+                                                    'job_status': {'$in': [STATUS_CREATING, STATUS_RUNNING,
+                                                                           STATUS_RETRY]}},
+                                                   {'job_type': 1, 'job_args': 1, 'job_key': 1}):
+            if job['job_type'] == 'COMPARE_BATCH':
+                live_pairs.update(job['job_args']['trade_pairs'].split(','))
+            else:
+                live_keys.add(job.get('job_key'))
+        missing_keys = self.active_job_keys - live_keys
+        missing_pairs = self.batched_pairs - live_pairs
+        stale_keys = missing_keys & self.missing_job_keys
+        stale_pairs = missing_pairs & self.missing_batched_pairs
+        if stale_keys or stale_pairs:
+            logging.warning('Releasing {} compare keys and {} batched trade pairs of jobs that are no longer running'
+                            .format(len(stale_keys), len(stale_pairs)))
+            self.active_job_keys.difference_update(stale_keys)
+            self.batched_pairs.difference_update(stale_pairs)
+        self.missing_job_keys = missing_keys - stale_keys
+        self.missing_batched_pairs = missing_pairs - stale_pairs
+
+    def update_cadence(self, job):
+        job_args = job.get('job_args', {})
+        summary = (job.get('job_result') or {}).get('market_summary')
+        if job['job_type'] == 'COMPARE' and summary:
+            self.cadence.record('{}-{}'.format(job_args['curr_x'], job_args['curr_y']), summary)
+        elif job['job_type'] == 'COMPARE_BATCH':
+            for trade_pair, summary in ((job.get('job_result') or {}).get('market_summaries') or {}).items():
+                self.cadence.record(trade_pair, summary)
+        elif job_args.get('exchange'):
+            self.cadence.spend(job_args['exchange'])
 
     def compare_trade_pair(self, trade_pair):
         # stop command may have been issued
@@ -122,6 +401,9 @@ class JobQueueExecutor:
             # cancels the interval
             self.compare_trade_pairs_intervals[trade_pair]()
 
+        if self.compares_paused():
+            return
+
         # logging.info('Now adding compare trade pair jobs')
 
         # Always run a compare job for each trade pair
@@ -129,28 +411,62 @@ class JobQueueExecutor:
         trade_pair_split = trade_pair.split('-')
         curr_x = trade_pair_split[0]
         curr_y = trade_pair_split[1]
-        existing_job = self.jq.db[JOB_COLLECTION].find_one({'job_type': 'COMPARE',
-                                                            'job_args.curr_x': curr_x,
-                                                            'job_args.curr_y': curr_y,
-                                                            'job_args.jobqueue_id': str(self._id),
-                                                            'job_status':
-                                                                {'$in': [STATUS_CREATING,
-                                                                         STATUS_RUNNING]
-                                                                 }
-                                                            })
-
-        if not existing_job:
+        job_args = {'curr_x': curr_x, 'curr_y': curr_y, 'jobqueue_id': str(self._id)}
+        key = job_key('COMPARE', job_args)
+
+        # check for an existing job running under **this** job queue. means old dead RUNNING jobs are ignored.
+        # the unique index on job_key catches any job added since by another process
+        if key not in self.active_job_keys:
             # logging.info('Adding comparison job for {}'.format(trade_pair))
-            # check for an existing job running under **this** job queue. means old dead RUNNING jobs are ignored.
-            self.jq.add_job(
-                {
-                    'job_type': 'COMPARE',
-                    'job_args': {'curr_x': curr_x, 'curr_y': curr_y, 'jobqueue_id': str(self._id)},
-                },
-                self._id)
+            # the key is held before the insert as the job may be started, and even cancelled, before add_job returns
+            self.active_job_keys.add(key)
+            added = None
+            try:
+                added = self.jq.add_job({'job_type': 'COMPARE', 'job_args': job_args}, self._id)
+            finally:
+                if not added:
+                    self.active_job_keys.discard(key)
         else:
             logging.debug('Not adding COMPARE {} {} job: Existing job!'.format(curr_x, curr_y))
 
+    # Adds one COMPARE_BATCH for every trade pair whose interval has passed since it was last added, unless it is still
+    # waiting or running in an earlier batch
+    def compare_trade_pairs(self):
+        # stop command may have been issued
+        self.is_running()
+        if not self.running:
+            # cancels the interval
+            self.compare_trade_pairs_intervals[COMPARE_BATCH_INTERVAL]()
+
+        if self.compares_paused():
+            return
+
+        now = time.time()
+        due = [trade_pair for trade_pair in self.trade_pairs if trade_pair not in self.batched_pairs and
+               now - self.batched_at.get(trade_pair, 0) >= self.cadence.interval(trade_pair)]
+        if not due:
+            return
+        # held before the insert as the job may be started, and even cancelled, before add_job returns
+        self.batched_pairs.update(due)
+        if self.jq.add_job({'job_type': 'COMPARE_BATCH',
+                            'job_args': {'trade_pairs': ','.join(due), 'jobqueue_id': str(self._id)}}, self._id):
+            self.batched_at.update({trade_pair: now for trade_pair in due})
+        else:
+            self.batched_pairs.difference_update(due)
+
+    # Backpressure from the scheduler: compares stop being added when the queue of waiting jobs reaches its high
+    # watermark and only start again once it has drained to the low watermark
+    def compares_paused(self):
+        depth = self.scheduler.queue_depth()
+        if self.compares_paused_at is None and depth >= settings.COMPARE_PAUSE_QUEUE_DEPTH:
+            logging.info('Pausing compares: {} jobs waiting'.format(depth))
+            self.compares_paused_at = time.time()
+        elif self.compares_paused_at is not None and depth <= settings.COMPARE_RESUME_QUEUE_DEPTH:
+            logging.info('Resuming compares after {:.1f}s: {} jobs waiting'.format(
+                time.time() - self.compares_paused_at, depth))
+            self.compares_paused_at = None
+        return self.compares_paused_at is not None
+
     def job_finished(self, process):
         retcode = process.wait()
         while retcode != 0:
@@ -180,19 +496,46 @@ class JobQueueExecutor:
         except:
             pass
 
-        self.jq.db.jobs.remove({'job_status': STATUS_RUNNING}, multi=True)
+        if self.dispatcher:
+            self.dispatcher.stop()
+
+        self.retries.stop()
+
+        try:
+            self.fiat_rate_interval()
+            self.heartbeat_interval()
+            self.archive_interval()
+        except:
+            pass
+
+        self.completed.put(None)
+
+        # only our own jobs, other job queues may still be running
+        # jobs handed back are started by the next job queue to start, see start_released
+        reclaimed, failed = lease.release_owned(self.jq.db[JOB_COLLECTION], self._id)
+        if reclaimed or failed:
+            logging.info('Handed back {} and failed {} jobs that were still running'.format(len(reclaimed), failed))
+        self.jq.db[JOB_STATUS_COLLECTION].update_one({'_id': self._id}, {'$set': {'running': False}})
+
+        if self.pool:
+            self.pool.stop()
 
         logging.info('Job queue stopped')
 
 
 class JobQueueThread(threading.Thread):
 
-    def __init__(self, jq, job, safecmd):
-        super(JobQueueThread, self).__init__(target=jq.run_command, args=(job, safecmd))
+    # on_complete(thread) is called as soon as the job has finished, however it finished
+    def __init__(self, jq, job, safecmd, pool=None, on_complete=None):
+        if pool:
+            super(JobQueueThread, self).__init__(target=jq.run_pooled, args=(job, pool))
+        else:
+            super(JobQueueThread, self).__init__(target=jq.run_command, args=(job, safecmd))
         self.err = None
         self.safecmd = safecmd
         self.job = job
         self.output = None
+        self.on_complete = on_complete
 
     def run(self):
         try:
@@ -204,23 +547,23 @@ class JobQueueThread(threading.Thread):
                 print(self.safecmd)
             if self.job:
                 print(self.job)
-            raise Exception(e)
             self.err = traceback.format_exc()
-        # finally:
-        #     runningjobslock.acquire()
-        #     runningjobslock.notify()
-        #     runningjobslock.release()
+            raise Exception(e)
+        finally:
+            if self.on_complete:
+                self.on_complete(self)
 
 
 class RunCommandException(Exception):
     pass
 
 
+# interval is a number of seconds or a function returning one, called before every wait
 def call_repeatedly(interval, func, *args):
     stopped = threading.Event()
 
     def loop():
-        while not stopped.wait(interval):  # the first call is in `interval` secs
+        while not stopped.wait(interval() if callable(interval) else interval):  # the first call is in `interval` secs
             ok = func(*args)
 
     threading.Thread(target=loop).start()
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+import traceback
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import app.settings as settings
+from app.execute import JobQueueExecutor, COMPARE_BATCH_INTERVAL
+from app.lib.jobqueue import JOB_COLLECTION, STATUS_RUNNING, MAX_STDLOG_SIZE, STREAM_CHUNK_SIZE, RESULT_FD_ENV
+from app.lib.setup import update_fiat_rates
+from app.lib.dispatcher import JobDispatcher
+
+
+# The job queue executor on a single asyncio event loop. Trade pair timers, fiat rate updates and running jobs are all
+# coroutines so the number of threads no longer grows with the number of trade pairs or running jobs. pymongo is
+# blocking so database calls are handed to a small fixed pool of threads (ASYNC_DB_THREADS).
+class AsyncJobQueueExecutor(JobQueueExecutor):
+
+    def __init__(self, trade_pairs=None, exchanges=None):
+        super(AsyncJobQueueExecutor, self).__init__(trade_pairs, exchanges)
+        self.loop = None
+        self.stopped = None
+        self.tasks = []
+        self.db_executor = ThreadPoolExecutor(settings.ASYNC_DB_THREADS, thread_name_prefix='jobqueue-db')
+        # pooled jobs block a thread until their worker replies, keep them away from the database threads
+        self.pool_executor = None
+        if self.pool:
+            self.pool_executor = ThreadPoolExecutor(settings.WORKER_POOL_SIZE, thread_name_prefix='jobqueue-pool')
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGINT, self.stopped.set)
+        self.loop.add_signal_handler(signal.SIGTERM, self.stopped.set)
+
+        await self.run_db(self.register)
+        logging.info('Job queue running with id {}'.format(self._id))
+
+        # we are going to constantly check apis for arbitrage opportunities
+        if settings.COMPARE_BATCH:
+            task = self.loop.create_task(repeat(settings.INTERVAL_COMPARE_MIN, self.run_db, self.compare_trade_pairs))
+            self.tasks.append(task)
+            self.compare_trade_pairs_intervals[COMPARE_BATCH_INTERVAL] = cancel_threadsafe(self.loop, task)
+        else:
+            for trade_pair in self.trade_pairs:
+                task = self.loop.create_task(repeat(partial(self.cadence.interval, trade_pair), self.run_db,
+                                                    self.compare_trade_pair, trade_pair))
+                self.tasks.append(task)
+                # compare_trade_pair cancels its own interval from a database thread
+                self.compare_trade_pairs_intervals[trade_pair] = cancel_threadsafe(self.loop, task)
+
+        # we periodically update the fiat rate of BTC to identify potential profit
+        self.tasks.append(self.loop.create_task(repeat(settings.INTERVAL_FIAT_RATE, self.run_db, update_fiat_rates)))
+
+        # keep our leases alive and take over the jobs of executors that have died
+        self.tasks.append(self.loop.create_task(repeat(settings.JOB_HEARTBEAT_INTERVAL, self.run_db, self.heartbeat)))
+
+        # keep the jobs collection small by moving old finished jobs into history
+        self.tasks.append(self.loop.create_task(repeat(settings.INTERVAL_ARCHIVE, self.run_db, self.archive_jobs)))
+
+        # stop when the job queue is stopped, e.g. by jobqueue stop, as well as on a signal
+        self.tasks.append(self.loop.create_task(repeat(settings.JOB_HEARTBEAT_INTERVAL, self.run_db,
+                                                       self.check_running)))
+
+        if settings.JOB_DISPATCH_MODE == 'changestream':
+            self.dispatcher = JobDispatcher(self.jq.db[JOB_COLLECTION], self.start_job)
+            self.dispatcher.start()
+        else:
+            self.jq.bind_to(self.start_jobs)
+
+        await self.run_db(self.start_retries)
+        await self.run_db(self.start_released)
+
+        await self.stopped.wait()
+
+        await self.run_db(self.stop_jobqueue)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.db_executor.shutdown(wait=False)
+        if self.pool_executor:
+            self.pool_executor.shutdown(wait=False)
+
+    # called from a database thread
+    def check_running(self):
+        self.is_running()
+        if not self.running:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def run_db(self, func, *args):
+        return self.loop.run_in_executor(self.db_executor, func, *args)
+
+    # called by the scheduler, from whichever thread submitted or released a job. The job is claimed on the loop and a
+    # job that cannot be claimed is released again in place of returning False
+    def launch_job(self, job):
+        safecmd = self.build_safecmd(job)
+        asyncio.run_coroutine_threadsafe(self.run_job(job, safecmd), self.loop)
+        return True
+
+    async def run_job(self, job, safecmd):
+        claimed = await self.run_db(self.claim_job, job)
+        if not claimed:
+            await self.run_db(self.scheduler.release, job)
+            return
+
+        task = asyncio.current_task()
+        self.tasks.append(task)
+        try:
+            if self.pool:
+                await self.loop.run_in_executor(self.pool_executor, self.jq.run_pooled, claimed, self.pool)
+            else:
+                await self.run_command(claimed, safecmd)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.error('Error running job {}: {}'.format(claimed['_id'], traceback.format_exc()))
+        finally:
+            self.tasks.remove(task)
+
+        await self.run_db(self.finish_job, claimed)
+
+    # the coroutine version of Jobqueue.run_command
+    async def run_command(self, job, safecmd):
+        env = os.environ.copy()
+        cmd = ['python3', '-m', ] + [str(x) for x in safecmd]
+        logging.debug('Running command {}'.format(' '.join(cmd)))
+
+        result_read, result_write = os.pipe()
+        env[RESULT_FD_ENV] = str(result_write)
+        try:
+            process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE,
+                                                           stdin=asyncio.subprocess.DEVNULL, env=env,
+                                                           close_fds=True, pass_fds=(result_write,))
+        finally:
+            os.close(result_write)
+
+        job['job_status'] = STATUS_RUNNING
+        job['job_pid'] = process.pid
+        job.setdefault('job_timestamps', {})['spawned'] = time.time()
+
+        result_reader = asyncio.StreamReader()
+        transport, _ = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(result_reader),
+                                                         os.fdopen(result_read, 'rb'))
+        try:
+            stdout_log, stderr_log, result_frames = await asyncio.gather(read_tail(process.stdout, MAX_STDLOG_SIZE),
+                                                                         read_tail(process.stderr, MAX_STDLOG_SIZE),
+                                                                         result_reader.read())
+            retcode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        finally:
+            transport.close()
+
+        await self.run_db(self.jq.handle_command_output, job, retcode, stdout_log, stderr_log, result_frames)
+
+
+# keep the last `limit` bytes written to a stream, see StreamTail
+async def read_tail(stream, limit):
+    data = bytearray()
+    while True:
+        chunk = await stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > limit:
+            del data[:len(data) - limit]
+    return data.decode('utf-8', errors='replace').strip()
+
+
+# the coroutine version of call_repeatedly. `func` is a coroutine function, or returns an awaitable
+async def repeat(interval, func, *args):
+    while True:
+        await asyncio.sleep(interval() if callable(interval) else interval)  # the first call is in `interval` secs
+        try:
+            await func(*args)
+        except Exception:
+            # a failed call must not stop the timer
+            logging.error(traceback.format_exc())
+
+
+def cancel_threadsafe(loop, task):
+    def cancel():
+        loop.call_soon_threadsafe(task.cancel)
+
+    return cancel
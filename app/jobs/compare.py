@@ -1,53 +1,90 @@
 import argparse
+import copy
 import logging
 import itertools
 from app.lib.setup import setup_environment, load_currency_pairs, choose_random_exchanges, \
     dynamically_import_exchange
 from app.lib.errors import ErrorTradePairDoesNotExist
-from app.settings import FIAT_DEFAULT_SYMBOL, FIAT_ARBITRAGE_MINIMUM, LOGLEVEL, EXCHANGES, FIAT_REPLENISH_AMOUNT
-from app.lib.jobqueue import return_value_to_stdout
+from app.settings import FIAT_DEFAULT_SYMBOL, FIAT_ARBITRAGE_MINIMUM, LOGLEVEL, EXCHANGES, FIAT_REPLENISH_AMOUNT, \
+    COMPARE_ALL_EXCHANGES, COMPARE_ORDER_BOOK_DEPTH
+from app.lib.jobqueue import return_result, record_stage
 from decimal import Decimal
-from app.lib.db import store_audit, get_fiat_rate as db_get_fiat_rate, get_exchange_lock, get_replenish_jobs
+from app.lib.db import store_audit, get_exchange_lock, \
+    get_recent_replenish_jobs as db_get_recent_replenish_jobs
 from app.lib.common import round_decimal_number, decimal_as_string
 from threading import Thread
-from app.lib.coingecko import get_current_fiat_rate
+from app.lib.fiatcache import FiatRateCache
+from app.lib.depth import plan_arbitrage, remaining
+from app.lib import prefilter
+from app.lib.recorder import record_order_book
 
+# fiat rates are kept between the compares run by the same process, e.g. by a pool worker or a COMPARE_BATCH
+FIAT_RATES = FiatRateCache()
 
-def compare(cur_x, cur_y, markets, jobqueue_id):
-    arbitrages = []
+
+# directory is where the exchange wraps are imported from, e.g. app.replay.wrap to compare recorded order books
+def compare(cur_x, cur_y, markets, jobqueue_id, directory=None):
     result = {'downstream_jobs': []}
-    exchange_shortlist = []
 
-    for exchange in EXCHANGES:
-        if not get_exchange_lock(exchange, jobqueue_id, 'COMPARE'):
-            exchange_shortlist.append(exchange)
+    apis_trade_pair_valid = exchange_selection(cur_x, cur_y, markets, unlocked_exchanges(jobqueue_id), jobqueue_id,
+                                               directory)
 
-    apis_trade_pair_valid = exchange_selection(cur_x, cur_y, markets, exchange_shortlist, jobqueue_id)
+    result['market_summary'] = {'spread': None, 'arbitrages': 0,
+                                'exchanges': [exchange.name for exchange in apis_trade_pair_valid]}
 
     if len(apis_trade_pair_valid) < 2:
         logging.debug('No arbitrage possible as less than two exchanges trade this pair')
         # return early as there will be no arbitrage possibility with only one or zero exchanges
-        return_value_to_stdout(result)
+        return_result(result)
         return result
 
     fiat_rate = get_fiat_rate(cur_y)
 
-    # generate a unique list of permutations for comparison [[buy, sell], [buy, sell], ...]
-    # TODO make sure not to do everything twice. Currently calling both APIs twice
-    exchange_permutations = list(itertools.permutations(apis_trade_pair_valid, 2))
-
     # run order book functions asynchronously
     run_exchange_functions_as_threads(apis_trade_pair_valid, 'order_book')
+    result['market_summary']['spread'] = best_spread(apis_trade_pair_valid)
+
+    candidates = screen([apis_trade_pair_valid], [fiat_rate])[0]
+    arbitrages, result['downstream_jobs'] = evaluate(apis_trade_pair_valid, fiat_rate, jobqueue_id, candidates)
+    result['market_summary'].update(evaluation_summary(apis_trade_pair_valid, candidates, arbitrages))
+
+    logging.debug('Returning {}'.format(result))
+
+    # hand the result back to the job queue executor
+    return_result(result)
+
+    return result
+
+
+# the exchanges that are not locked by another job
+def unlocked_exchanges(jobqueue_id):
+    exchange_shortlist = []
+    for exchange in EXCHANGES:
+        if not get_exchange_lock(exchange, jobqueue_id, 'COMPARE'):
+            exchange_shortlist.append(exchange)
+    return exchange_shortlist
+
+
+# The buy/sell combinations of each list of exchanges that could make more than FIAT_ARBITRAGE_MINIMUM, found for every
+# trade pair at once with floats, see app.lib.prefilter. Only these are worked out exactly by evaluate
+def screen(exchange_lists, fiat_rates):
+    return prefilter.screen(exchange_lists, fiat_rates, FIAT_ARBITRAGE_MINIMUM, available_volume)
+
 
-    # determine whether buying and selling across each permutation will result in a profit > FIAT_ARBITRAGE_MINIMUM
-    for exchange_permutation in exchange_permutations:
-        exchange_buy, exchange_sell = exchange_permutation
-        if exchange_buy.lowest_ask and exchange_buy.highest_bid and exchange_sell.lowest_ask and exchange_sell.highest_bid:
+# Finds the arbitrages between exchanges whose order books have been fetched for one trade pair, trying only the
+# candidates (buy, sell) that passed the screen. Returns the arbitrages and the downstream jobs (trades and replenishes)
+# to add for them
+def evaluate(exchanges, fiat_rate, jobqueue_id, candidates):
+    arbitrages = []
+    if COMPARE_ALL_EXCHANGES:
+        arbitrages = find_all_arbitrages(exchanges, fiat_rate, candidates=candidates)
+    else:
+        # determine whether buying and selling across each candidate will result in a profit > FIAT_ARBITRAGE_MINIMUM
+        for exchange_buy, exchange_sell in candidates:
             arbitrage = None
             try:
                 # make sure the volumes are identical in each exchange object
                 exchange_buy, exchange_sell = equalise_buy_and_sell_volumes(exchange_buy, exchange_sell)
-                # ?????
                 arbitrage = find_arbitrage(exchange_buy, exchange_sell, fiat_rate)
                 # profit!
             except InvalidTrade:
@@ -55,35 +92,132 @@ def compare(cur_x, cur_y, markets, jobqueue_id):
                 continue
             if arbitrage:
                 arbitrages.append(arbitrage)
-                exchange_names = [arbitrage['buy'].name, arbitrage['sell'].name]
-                profit_audit_record = profit_audit(arbitrage['profit'],
-                                                   exchange_names,
-                                                   arbitrage['buy'].trade_pair_common)
-                store_audit(profit_audit_record)
+
+    for arbitrage in arbitrages:
+        exchange_names = [arbitrage['buy'].name, arbitrage['sell'].name]
+        profit_audit_record = profit_audit(arbitrage['profit'],
+                                           exchange_names,
+                                           arbitrage['buy'].trade_pair_common)
+        store_audit(profit_audit_record)
 
     replenish_jobs, viable_arbitrages = get_downstream_jobs(arbitrages, fiat_rate)
 
     # result is a list of downstream jobs to add to the queue
-    result['downstream_jobs'] = viable_arbitrages + replenish_jobs
-    for job in result['downstream_jobs']:
+    downstream_jobs = viable_arbitrages + replenish_jobs
+    for job in downstream_jobs:
         job['job_args']['jobqueue_id'] = jobqueue_id
+    return arbitrages, downstream_jobs
+
+
+# how many buy/sell combinations there were, how many passed the screen and how many were confirmed as arbitrages
+def evaluation_summary(exchanges, candidates, arbitrages):
+    logging.debug('{} of {} exchange combinations passed the screen, {} confirmed'.format(
+        len(candidates), len(exchanges) * (len(exchanges) - 1), len(arbitrages)))
+    return {'combinations': len(exchanges) * (len(exchanges) - 1), 'screened': len(candidates),
+            'arbitrages': len(arbitrages)}
+
+
+# the highest bid less the lowest ask across all exchanges, as a fraction of the lowest ask. Positive when some pair of
+# exchanges could be arbitraged before fees. Used by the job queue to decide how often to compare the pair
+def best_spread(exchanges):
+    asks = [exchange.lowest_ask['price'] for exchange in exchanges if exchange.lowest_ask]
+    bids = [exchange.highest_bid['price'] for exchange in exchanges if exchange.highest_bid]
+    if not asks or not bids or not min(asks):
+        return None
+    return float((max(bids) - min(asks)) / min(asks))
+
+
+# Every buy/sell combination of exchanges where the lowest ask on one is below the highest bid on the other, the widest
+# spread first. The global lowest ask and highest bid are found in one pass: when they do not cross no combination can
+# and nothing else is looked at. Otherwise only combinations that cross are visited
+def rank_crossings(exchanges):
+    quoted = [exchange for exchange in exchanges if exchange.lowest_ask and exchange.highest_bid]
+    if len(quoted) < 2:
+        return []
+    lowest_ask = min(exchange.lowest_ask['price'] for exchange in quoted)
+    highest_bid = max(exchange.highest_bid['price'] for exchange in quoted)
+    if lowest_ask >= highest_bid:
+        return []
+
+    bids = sorted(quoted, key=lambda x: x.highest_bid['price'], reverse=True)
+    crossings = []
+    for exchange_buy in sorted(quoted, key=lambda x: x.lowest_ask['price']):
+        if exchange_buy.lowest_ask['price'] >= highest_bid:
+            break
+        for exchange_sell in bids:
+            if exchange_sell.highest_bid['price'] <= exchange_buy.lowest_ask['price']:
+                break
+            if exchange_sell is not exchange_buy:
+                crossings.append((exchange_buy, exchange_sell))
+    crossings.sort(key=lambda x: x[1].highest_bid['price'] - x[0].lowest_ask['price'], reverse=True)
+    return crossings
+
+
+# Finds the arbitrages across every exchange from one set of order books, most profitable first. The volume at the top
+# of each exchange's book is shared out in order of spread, so two arbitrages never count on the same volume. When the
+# books are walked each arbitrage is planned against the levels that earlier arbitrages have left of them.
+# Arbitrages are made from copies of the exchanges as the same exchange can be the buy or sell of several of them.
+# candidates, if given, are the only (buy, sell) combinations tried
+def find_all_arbitrages(exchanges, fiat_rate, fiat_arbitrage_minimum=None, candidates=None):
+    ask_volumes = {exchange.name: available_volume(exchange.lowest_ask, exchange.asks)
+                   for exchange in exchanges if exchange.lowest_ask}
+    bid_volumes = {exchange.name: available_volume(exchange.highest_bid, exchange.bids)
+                   for exchange in exchanges if exchange.highest_bid}
+    asks = {exchange.name: exchange.asks for exchange in exchanges}
+    bids = {exchange.name: exchange.bids for exchange in exchanges}
+    crossings = rank_crossings(exchanges)
+    if candidates is not None:
+        crossings = [(x, y) for x, y in crossings if any(x is buy and y is sell for buy, sell in candidates)]
+    arbitrages = []
+    for exchange_buy, exchange_sell in crossings:
+        volume = min(ask_volumes[exchange_buy.name], bid_volumes[exchange_sell.name])
+        if volume <= 0:
+            continue
+        exchange_buy = copy_exchange(exchange_buy)
+        exchange_sell = copy_exchange(exchange_sell)
+        if COMPARE_ORDER_BOOK_DEPTH and asks[exchange_buy.name] and bids[exchange_sell.name]:
+            exchange_buy.asks = asks[exchange_buy.name]
+            exchange_sell.bids = bids[exchange_sell.name]
+            exchange_buy.lowest_ask = dict(exchange_buy.asks[0])
+            exchange_sell.highest_bid = dict(exchange_sell.bids[0])
+        exchange_buy.lowest_ask['volume'] = volume
+        exchange_sell.highest_bid['volume'] = volume
+        try:
+            arbitrage = find_arbitrage(exchange_buy, exchange_sell, fiat_rate, fiat_arbitrage_minimum,
+                                       max_volume=volume)
+        except InvalidTrade:
+            logging.debug('Invalid Trade')
+            continue
+        if arbitrage:
+            arbitrages.append(arbitrage)
+            # the volume may have been cut down to the maximum trade size
+            ask_volumes[exchange_buy.name] -= arbitrage['buy'].lowest_ask['volume']
+            bid_volumes[exchange_sell.name] -= arbitrage['sell'].highest_bid['volume']
+            if COMPARE_ORDER_BOOK_DEPTH and asks[exchange_buy.name] and bids[exchange_sell.name]:
+                asks[exchange_buy.name] = remaining(asks[exchange_buy.name], arbitrage['buy'].lowest_ask['volume'])
+                bids[exchange_sell.name] = remaining(bids[exchange_sell.name], arbitrage['sell'].highest_bid['volume'])
+    arbitrages.sort(key=lambda x: x['profit'], reverse=True)
+    return arbitrages
 
-    logging.debug('Returning {}'.format(result))
 
-    # make sure the job queue executor can access the result by writing to stdout
-    return_value_to_stdout(result)
+# the volume an exchange has to trade, the whole of its book when the books are walked
+def available_volume(best, levels):
+    if COMPARE_ORDER_BOOK_DEPTH and levels:
+        return sum(level['volume'] for level in levels)
+    return best['volume']
 
-    return result
+
+# the order book is shared with the original, the best ask and bid are copied as the arbitrage changes their volume
+def copy_exchange(exchange):
+    exchange = copy.copy(exchange)
+    exchange.lowest_ask = dict(exchange.lowest_ask)
+    exchange.highest_bid = dict(exchange.highest_bid)
+    return exchange
 
 
 def get_fiat_rate(symbol):
-    try:
-        fiat_rate = round_decimal_number(db_get_fiat_rate(symbol)[FIAT_DEFAULT_SYMBOL], 2)
-        logging.debug('Fiat rate is {}'.format(fiat_rate))
-    except:
-        logging.debug('Fiat rate for {} not present. Trying to download.'.format(symbol))
-        get_current_fiat_rate(symbol)
-        fiat_rate = round_decimal_number(db_get_fiat_rate(symbol)[FIAT_DEFAULT_SYMBOL], 2)
+    fiat_rate = round_decimal_number(FIAT_RATES.get(symbol), 2)
+    logging.debug('Fiat rate is {}'.format(fiat_rate))
     return fiat_rate
 
 
@@ -93,8 +227,14 @@ def run_exchange_functions_as_threads(exchanges, function_name):
     # TODO make this use multiprocessing
     threads = []
     count = 0
+    def call(exchange):
+        getattr(exchange, function_name)()
+        record_stage('first_exchange_response')
+        if function_name == 'order_book':
+            record_order_book(exchange)
+
     for exchange in exchanges:
-        threads.append(Thread(name='exchange_{}'.format(count), target=getattr(exchange, function_name)))
+        threads.append(Thread(name='exchange_{}'.format(count), target=call, args=(exchange,)))
         count += 1
 
     for thread in threads:
@@ -107,15 +247,14 @@ def run_exchange_functions_as_threads(exchanges, function_name):
 def get_downstream_jobs(arbitrages, fiat_rate):
     replenish_jobs = []
     viable_arbitrages = []
+    fetch_balances(arbitrages)
+    # a replenish job may have recently run successfully but the balance will still be zero if confirmations have not
+    # been received. BTC takes ages.
+    recent_replenish_jobs = get_recent_replenish_jobs(arbitrages)
     for arbitrage in arbitrages:
-        # runs the get balance functions as threads meaning the cpu can switch between tasks during I/O
-        run_exchange_functions_as_threads([arbitrage['buy'], arbitrage['sell']], 'get_balances')
         # first, make sure we do not have zero of the currency we're trying to sell
         # send more of the currency to that exchange if there is a zero balance
         new_replenish_jobs = check_zero_balances(arbitrage)
-        # however, a replenish job may have recently run successfully but the balance will still be zero if
-        # confirmations have not been received. BTC takes ages.
-        recent_replenish_jobs = get_recent_replenish_jobs(arbitrage)
         if not replenish_jobs:
             viable_arbitrages.extend(determine_arbitrage_viability(arbitrage, fiat_rate))
         # now remove any unnecessary replenish jobs
@@ -124,16 +263,30 @@ def get_downstream_jobs(arbitrages, fiat_rate):
     return replenish_jobs, viable_arbitrages
 
 
-def get_recent_replenish_jobs(arbitrage):
-    recent_jobs = []
-    for buy_type in ['buy', 'sell']:
-        recent_jobs_quote = [replenish_job(x['exchange'], x['currency']) for x in
-                             get_replenish_jobs(arbitrage[buy_type].name, arbitrage[buy_type].quote_currency)]
-        recent_jobs += recent_jobs_quote
-        recent_jobs_base = [replenish_job(x['exchange'], x['currency']) for x in
-                            get_replenish_jobs(arbitrage[buy_type].name, arbitrage[buy_type].base_currency)]
-        recent_jobs += recent_jobs_base
-    return recent_jobs
+# Balances belong to the exchange account rather than the trade pair so each exchange's balances are fetched once,
+# however many arbitrages it is part of, and shared with every other job through the balance cache
+def fetch_balances(arbitrages):
+    exchanges = {}
+    for arbitrage in arbitrages:
+        for exchange in (arbitrage['buy'], arbitrage['sell']):
+            exchanges.setdefault(exchange.name, []).append(exchange)
+    # runs the get balance functions as threads meaning the cpu can switch between tasks during I/O
+    run_exchange_functions_as_threads([same[0] for same in exchanges.values()], 'get_cached_balances')
+    for same in exchanges.values():
+        for exchange in same[1:]:
+            exchange.balances = same[0].balances
+
+
+# the recent replenish jobs of every exchange and currency in the arbitrages, from one query
+def get_recent_replenish_jobs(arbitrages):
+    exchange_currencies = set()
+    for arbitrage in arbitrages:
+        for buy_type in ['buy', 'sell']:
+            exchange = arbitrage[buy_type]
+            exchange_currencies.add((exchange.name, exchange.quote_currency))
+            exchange_currencies.add((exchange.name, exchange.base_currency))
+    return [replenish_job(x['job_args']['exchange'], x['job_args']['currency']) for x in
+            db_get_recent_replenish_jobs(exchange_currencies)]
 
 
 def check_zero_balances(arbitrage):
@@ -223,7 +376,7 @@ def determine_arbitrage_viability(arbitrage, fiat_rate):
 
     # use the same function as before to check the modified trades for profitability
     if revalidate:
-        revalidation_result = find_arbitrage(exchange_buy, exchange_sell, fiat_rate=fiat_rate)
+        revalidation_result = find_arbitrage(exchange_buy, exchange_sell, fiat_rate=fiat_rate, max_volume=volume_base)
 
     # if the trades were good first time round or the altered trades would generate enough profit
     if not revalidate or revalidation_result:
@@ -257,7 +410,9 @@ def check_trade_pair(trade_pair):
     return result
 
 
-def find_arbitrage(exchange_x, exchange_y, fiat_rate, fiat_arbitrage_minimum=None):
+# max_volume limits the volume when the order books are walked (COMPARE_ORDER_BOOK_DEPTH), otherwise the volume of the
+# lowest ask is used
+def find_arbitrage(exchange_x, exchange_y, fiat_rate, fiat_arbitrage_minimum=None, max_volume=None):
     result = {}
     if fiat_arbitrage_minimum is None:
         fiat_arbitrage_minimum = FIAT_ARBITRAGE_MINIMUM
@@ -270,7 +425,11 @@ def find_arbitrage(exchange_x, exchange_y, fiat_rate, fiat_arbitrage_minimum=Non
         if exchange_x.lowest_ask['price'] < exchange_y.highest_bid['price']:
             logging.debug('Potential arbitrages')
 
-            exchange_x, exchange_y, profit = calculate_profit_and_volume(exchange_x, exchange_y, fiat_rate)
+            if COMPARE_ORDER_BOOK_DEPTH and exchange_x.asks and exchange_y.bids:
+                exchange_x, exchange_y, profit = calculate_depth_profit_and_volume(exchange_x, exchange_y, fiat_rate,
+                                                                                   max_volume)
+            else:
+                exchange_x, exchange_y, profit = calculate_profit_and_volume(exchange_x, exchange_y, fiat_rate)
 
             if profit > fiat_arbitrage_minimum:
                 result = {'buy': exchange_x, 'sell': exchange_y, 'profit': profit}
@@ -321,10 +480,30 @@ def calculate_profit_and_volume(exchange_buy, exchange_sell, fiat_rate):
     return exchange_buy, exchange_sell, profit
 
 
+# Walks down both order books for the volume that makes the most profit, see app.lib.depth. The lowest ask and highest
+# bid become limit orders at the last level taken from each book so that one order sweeps every level in the plan, the
+# levels themselves are kept with them
+def calculate_depth_profit_and_volume(exchange_buy, exchange_sell, fiat_rate, max_volume=None):
+    plan = plan_arbitrage(exchange_buy, exchange_sell, fiat_rate, max_volume=max_volume,
+                          max_cost=FIAT_REPLENISH_AMOUNT)
+    if not plan:
+        return exchange_buy, exchange_sell, 0
+
+    logging.debug('Walked {} asks and {} bids for volume {}'.format(len(plan['buy_levels']), len(plan['sell_levels']),
+                                                                    plan['volume']))
+    # new dicts, the lowest ask and highest bid are the first levels of the order books
+    exchange_buy.lowest_ask = {'price': plan['price_buy'], 'volume': plan['volume'], 'levels': plan['buy_levels']}
+    exchange_sell.highest_bid = {'price': plan['price_sell'], 'volume': plan['volume'], 'levels': plan['sell_levels']}
+    return exchange_buy, exchange_sell, plan['profit']
+
+
 # randomly select the names of two exchanges and then check if the trade pair exists in both exchanges
 # if the trade pair is not in both exchanges, repeat until we have a pair, up to 10 times
+# with COMPARE_ALL_EXCHANGES every exchange that trades the pair is used instead
 # TODO construct the cross sections of trade pairs and exchanges and randomly select from it instead
-def exchange_selection(cur_x, cur_y, markets, exchanges, jobqueue_id, directory=None):
+def exchange_selection(cur_x, cur_y, markets, exchanges, jobqueue_id, directory=None, all_exchanges=None):
+    if all_exchanges is None:
+        all_exchanges = COMPARE_ALL_EXCHANGES
     trade_pair = '{}-{}'.format(cur_x, cur_y)
     potential_exchanges = []
     apis_trade_pair_valid = []
@@ -336,7 +515,7 @@ def exchange_selection(cur_x, cur_y, markets, exchanges, jobqueue_id, directory=
     if len(potential_exchanges) < 2:
         # there are not enough exchanges that trade this pair
         return apis_trade_pair_valid
-    if len(potential_exchanges) == 2:
+    if len(potential_exchanges) == 2 or all_exchanges:
         random_exchanges = potential_exchanges
     else:
 
@@ -401,6 +580,7 @@ def transact_job(exchange_name, trade_pair, volume, price, buy_type, profit):
 
 
 def setup():
+    record_stage('imports_done')
     parser = argparse.ArgumentParser(description='Process some currencies.')
     parser.add_argument('curr_x', type=str, help='Currency to compare')
     parser.add_argument('curr_y', type=str, help='Currency to compare')
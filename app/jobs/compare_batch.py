@@ -0,0 +1,74 @@
+import argparse
+import logging
+from app.lib.setup import setup_environment, load_currency_pairs
+from app.settings import LOGLEVEL
+from app.lib.jobqueue import return_result, record_stage
+from app.jobs.compare import exchange_selection, unlocked_exchanges, run_exchange_functions_as_threads, best_spread, \
+    get_fiat_rate, screen, evaluate, evaluation_summary
+
+
+# Compares several trade pairs in one job. The exchange locks are checked once, every order book of every pair is
+# fetched in one round of concurrent requests and the fiat rate of each quote currency is read once. Every exchange
+# combination of every pair is screened in one go, then each pair is evaluated exactly as a COMPARE would, and the
+# downstream jobs of all of them are returned together with a market summary for each pair.
+def compare_batch(trade_pairs, markets, jobqueue_id):
+    result = {'downstream_jobs': [], 'market_summaries': {}}
+    exchange_shortlist = unlocked_exchanges(jobqueue_id)
+
+    selected = {}
+    for trade_pair in trade_pairs:
+        cur_x, cur_y = trade_pair.split('-')
+        exchanges = exchange_selection(cur_x, cur_y, markets, exchange_shortlist, jobqueue_id)
+        result['market_summaries'][trade_pair] = {'spread': None, 'arbitrages': 0,
+                                                  'exchanges': [exchange.name for exchange in exchanges]}
+        if len(exchanges) < 2:
+            logging.debug('No arbitrage possible for {} as less than two exchanges trade it'.format(trade_pair))
+            continue
+        selected[trade_pair] = exchanges
+
+    run_exchange_functions_as_threads([exchange for exchanges in selected.values() for exchange in exchanges],
+                                      'order_book')
+
+    fiat_rates = {}
+    for trade_pair in selected:
+        cur_y = trade_pair.split('-')[1]
+        if cur_y not in fiat_rates:
+            fiat_rates[cur_y] = get_fiat_rate(cur_y)
+    pair_fiat_rates = [fiat_rates[trade_pair.split('-')[1]] for trade_pair in selected]
+    pair_candidates = screen(list(selected.values()), pair_fiat_rates)
+
+    for (trade_pair, exchanges), fiat_rate, candidates in zip(selected.items(), pair_fiat_rates, pair_candidates):
+        summary = result['market_summaries'][trade_pair]
+        summary['spread'] = best_spread(exchanges)
+        arbitrages, downstream_jobs = evaluate(exchanges, fiat_rate, jobqueue_id, candidates)
+        summary.update(evaluation_summary(exchanges, candidates, arbitrages))
+        result['downstream_jobs'] += downstream_jobs
+
+    logging.debug('Returning {}'.format(result))
+
+    # hand the result back to the job queue executor
+    return_result(result)
+
+    return result
+
+
+def setup():
+    record_stage('imports_done')
+    parser = argparse.ArgumentParser(description='Compare several trade pairs at once.')
+    parser.add_argument('trade_pairs', type=str, help='Comma separated trade pairs to compare, e.g. ETH-BTC,LTC-BTC')
+    parser.add_argument('jobqueue_id', type=str, help='Jobqueue Id')
+    parser.add_argument('--setup', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    if args.setup:
+        setup_environment(args.jobqueue_id)
+
+    markets = load_currency_pairs()
+
+    output = compare_batch(args.trade_pairs.split(','), markets, args.jobqueue_id)
+    return output
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
@@ -2,9 +2,9 @@ import argparse
 import logging
 from app.settings import LOGLEVEL, MASTER_EXCHANGE
 from app.lib.setup import get_exchanges, load_currency_pairs
-from app.lib.jobqueue import return_value_to_stdout
+from app.lib.jobqueue import return_result, record_stage
 from app.lib.common import get_replenish_quantity
-from app.lib.db import store_trade
+from app.lib.db import store_trade, invalidate_balances
 from app.lib.common import get_number_of_decimal_places
 from decimal import Decimal, Context, setcontext
 
@@ -34,13 +34,16 @@ def convert(exchange, currency_from, currency_to, markets, jobqueue_id):
             # TODO assuming all pairs in the form XXX-BTC. Should be smarter?
 
             master_exchange.order_book()
-            trade = master_exchange.trade('buy', volume=quantity, price=master_exchange.lowest_ask['price'])
+            try:
+                trade = master_exchange.trade('buy', volume=quantity, price=master_exchange.lowest_ask['price'])
+            finally:
+                invalidate_balances(master_exchange.name)
             if trade:
                 trade['type'] = 'CONVERT'
                 store_trade(trade)
                 result['trade'] = trade
                 result['success'] = True
-                return_value_to_stdout(result)
+                return_result(result)
                 # {"success": true,
                 #  "trade": {"external_id": "27a63353-4aa0-4f7e-bc90-45d087e2c5e5", "_id": "None", "status": "Closed",
                 #            "trade_pair_common": "ADX-BTC", "trade_pair": "BTC-ADX", "trade_type": "buy",
@@ -52,6 +55,7 @@ def convert(exchange, currency_from, currency_to, markets, jobqueue_id):
 
 
 def setup():
+    record_stage('imports_done')
     parser = argparse.ArgumentParser(description='Convert from one currency to another on a particular exchange')
     parser.add_argument('exchange', type=str, help='Exchange name')
     parser.add_argument('currency_from', type=str, help='Currency to convert from')
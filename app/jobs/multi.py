@@ -83,7 +83,8 @@ def construct_rate_graph(currencies, exchanges):
     return graph
 
 
-def process():
+# directory is where the exchange wraps are imported from, e.g. app.replay.wrap with the markets of a recording
+def process(markets=None, directory=None):
     exchanges = []
     # trade pairs are BUY-SELL
     # get all trade pairs that exist on every exchange
@@ -106,9 +107,10 @@ def process():
     exchange_count = len(pairs)
     random_exchanges = choose_random_exchanges(number=len(pairs), duplicates=True)
     for exchange in random_exchanges:
-        exchanges.append(dynamically_import_exchange(exchange)('xxx'))
+        exchanges.append(dynamically_import_exchange(exchange, directory)('xxx'))
 
-    markets = load_currency_pairs()
+    if markets is None:
+        markets = load_currency_pairs()
 
     currencies = []
 
@@ -201,6 +203,7 @@ def process():
 
     logging.debug('Time taken {}s'.format(time.time() - start_time))
     #bellend(currencies, exchanges, pairs)
+    return profit
 
 
 def find_trade_path(previous, current):
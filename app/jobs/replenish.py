@@ -2,10 +2,10 @@ import argparse
 import logging
 from app.settings import LOGLEVEL, DEFAULT_CURRENCY, FIAT_DEFAULT_SYMBOL
 from app.lib.setup import get_master_exchange, get_exchange
-from app.lib.jobqueue import return_value_to_stdout
+from app.lib.jobqueue import return_result, record_stage
 from app.lib.common import get_replenish_quantity
 from app.lib.coingecko import get_current_fiat_rate
-from app.lib.db import get_replenish_jobs, store_audit, exchange_lock
+from app.lib.db import get_replenish_jobs, store_audit, exchange_lock, invalidate_balances
 
 
 def replenish(exchange, currency, jobqueue_id):
@@ -51,7 +51,11 @@ def replenish(exchange, currency, jobqueue_id):
         if currency in child_exchange.pending_balances:
             pass
         elif currency not in child_exchange.pending_balances or pending_balances_not_implemented:
-            withdrawal_success, uuid = master_exchange.withdraw(currency.upper(), to_address, quantity)
+            try:
+                withdrawal_success, uuid = master_exchange.withdraw(currency.upper(), to_address, quantity)
+            finally:
+                invalidate_balances(master_exchange.name)
+                invalidate_balances(exchange)
 
             if not withdrawal_success:
                 # this means we did not have enough of the currency to withdraw and will need to convert some DEFAULT_CURRENCY (ETH) to this currency
@@ -64,19 +68,19 @@ def replenish(exchange, currency, jobqueue_id):
                         'jobqueue_id': jobqueue_id
                     }
                 })
-                # we will retry this job in 20 seconds time
-                # TODO make job queue executor retry jobs
+                # the job queue executor will retry this job in 20 seconds time
                 result['retry'] = int(20)
             else:
                 result['success'] = True
-                audit_id = store_audit(withdrawal_tx_fee_audit(0, fiat_rate, 0, exchange, currency, uuid))
+                # the WITHDRAWAL_FEE job updates this audit so it must be written before the job is added
+                audit_id = store_audit(withdrawal_tx_fee_audit(0, fiat_rate, 0, exchange, currency, uuid), durable=True)
                 downstream_jobs.append(withdrawal_fee_job(master_exchange.name, currency, uuid, audit_id))
     else:
         result['success'] = True
     if downstream_jobs:
         result['downstream_jobs'] = downstream_jobs
     exchange_lock(exchange, jobqueue_id, 'REPLENISH', lock=False)
-    return_value_to_stdout(result)
+    return_result(result)
 
 
 def withdrawal_fee_job(exchange_name, currency, id, audit_id):
@@ -104,6 +108,7 @@ def withdrawal_tx_fee_audit(fee, fiat_rate, fee_fiat, exchange, currency, id):
 
 
 def setup():
+    record_stage('imports_done')
     parser = argparse.ArgumentParser(description='Process some currencies.')
     parser.add_argument('exchange', type=str, help='Currency to compare')
     parser.add_argument('currency', type=str, help='Currency to compare')
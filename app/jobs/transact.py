@@ -9,9 +9,9 @@ import argparse
 from app.settings import LOGLEVEL
 import logging
 from app.lib.setup import load_currency_pairs
-from app.lib.jobqueue import return_value_to_stdout
+from app.lib.jobqueue import return_result, record_stage
 from decimal import Decimal
-from app.lib.db import store_trade, get_trade_id, exchange_lock
+from app.lib.db import store_trade, get_trade_id, exchange_lock, invalidate_balances
 from app.lib.common import dynamically_import_exchange
 import json
 from bson import json_util
@@ -51,18 +51,23 @@ def transact(exchange, trade_pair_common, volume, price, type, markets, jobqueue
             raise TransactionError('Error converting price/volume to str {}'.format(e))
 
         logging.debug('Trading volume {} price {} notional {}'.format(volume_str, price_str, price * volume))
-        trade = exchange_obj.trade(trade_type=type, volume=volume_str, price=price_str, trade_id=trade_id)
+        try:
+            trade = exchange_obj.trade(trade_type=type, volume=volume_str, price=price_str, trade_id=trade_id)
+        finally:
+            # the trade may have gone through even if the response was an error
+            invalidate_balances(exchange)
         logging.debug(trade)
         if trade:
             trade['type'] = 'TRANSACT'
             trade['_id'] = trade_id
             logging.debug(trade)
             store_trade(trade)
-            return_value_to_stdout({'job_result': trade})
+            return_result({'job_result': trade})
     exchange_lock(exchange, jobqueue_id, 'TRANSACT', lock=False)
 
 
 def setup():
+    record_stage('imports_done')
     parser = argparse.ArgumentParser(description='Buy or sell a trade pair')
 
     parser.add_argument('exchange', type=str, help='Exchange on which to perform transaction')
@@ -87,4 +92,5 @@ class TransactionError(Exception):
     pass
 
 
-setup()
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
@@ -2,7 +2,7 @@ import argparse
 import logging
 from app.settings import LOGLEVEL, MASTER_EXCHANGE
 from app.lib.setup import get_exchange, get_master_exchange
-from app.lib.jobqueue import return_value_to_stdout
+from app.lib.jobqueue import return_result, record_stage
 from app.lib.db import update_withdrawal_fee
 from bson import ObjectId
 
@@ -21,10 +21,11 @@ def withdrawal_fee(exchange_name, currency, withdrawal_id, audit_id, jobqueue_id
     except Exception as e:
         raise WithdrawalFeeError('Problem getting withdrawal fee from Master Exchange: {}'.format(e))
 
-    return_value_to_stdout(result)
+    return_result(result)
 
 
 def setup():
+    record_stage('imports_done')
     parser = argparse.ArgumentParser(description='Get the withdrawal fee for a withdrawal and update the database')
     parser.add_argument('exchange', type=str, help='Exchange name')
     parser.add_argument('currency', type=str, help='Currency to compare')
@@ -0,0 +1,116 @@
+import datetime
+import logging
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid
+from app.settings import JOB_ARCHIVE_AGE, JOB_ARCHIVE_BATCH, JOB_HISTORY_TTL_DAYS
+from app.lib.jobqueue import JOB_COLLECTION, TERMINAL_STATUSES
+
+# finished jobs are moved to one collection per day, by the day the job finished, e.g. jobs_history_20190131
+JOB_HISTORY_PREFIX = 'jobs_history_'
+# number of jobs ever archived by day, job type and status
+JOB_COUNTERS_COLLECTION = 'job_counters'
+DUPLICATE_KEY_ERROR = 11000
+# (database, collection) of the history collections this process has already created or found
+HISTORY_COLLECTIONS = set()
+
+
+def history_collection_name(date):
+    return '{}{}'.format(JOB_HISTORY_PREFIX, date.strftime('%Y%m%d'))
+
+
+# Moves finished jobs added more than JOB_ARCHIVE_AGE minutes ago out of the jobs collection and into the history
+# collections, counting them in job_counters as they go. Job queues on several nodes may archive at the same time: a job
+# is only counted by the node that inserted it into the history. Returns the number of jobs archived
+def archive_jobs(db, age=None, batch=None):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(minutes=age or JOB_ARCHIVE_AGE)
+    # ObjectIds start with the time they were created so the _id index finds old jobs
+    query = {'_id': {'$lt': ObjectId.from_datetime(cutoff)}, 'job_status': {'$in': TERMINAL_STATUSES}}
+    archived = 0
+    while True:
+        jobs = list(db[JOB_COLLECTION].find(query).sort([('_id', ASCENDING)]).limit(batch or JOB_ARCHIVE_BATCH))
+        if not jobs:
+            break
+        inserted = []
+        for date, day_jobs in group_by_date(jobs).items():
+            inserted += insert_history(db, date, day_jobs)
+        db[JOB_COLLECTION].delete_many({'_id': {'$in': [job['_id'] for job in jobs]}})
+        count_jobs(db, inserted)
+        archived += len(inserted)
+    if archived:
+        logging.debug('Archived {} jobs'.format(archived))
+    return archived
+
+
+# when the job was given its final status, or when it was added for jobs finished before that was recorded
+def finished_at(job):
+    finished = (job.get('job_timestamps') or {}).get('finished')
+    if finished is None:
+        return job['_id'].generation_time
+    return datetime.datetime.fromtimestamp(finished, datetime.timezone.utc)
+
+
+def group_by_date(jobs):
+    days = {}
+    for job in jobs:
+        days.setdefault(finished_at(job).date(), []).append(job)
+    return days
+
+
+# History collections expire their documents, see also drop_expired_history. The index is made when the day's collection
+# is created rather than for every batch archived into it
+def history_collection(db, date):
+    name = history_collection_name(date)
+    if (db.name, name) not in HISTORY_COLLECTIONS:
+        try:
+            db.create_collection(name).create_index([('job_archived_at', ASCENDING)],
+                                                    expireAfterSeconds=JOB_HISTORY_TTL_DAYS * 24 * 60 * 60)
+        except CollectionInvalid:
+            # created by an earlier run or by another job queue
+            pass
+        HISTORY_COLLECTIONS.add((db.name, name))
+    return db[name]
+
+
+# returns the jobs that were inserted by this call
+def insert_history(db, date, jobs):
+    collection = history_collection(db, date)
+    archived_at = datetime.datetime.utcnow()
+    for job in jobs:
+        job['job_archived_at'] = archived_at
+    try:
+        collection.insert_many(jobs, ordered=False)
+    except BulkWriteError as e:
+        # jobs already archived by another job queue, or by an archive that stopped before deleting them
+        errors = e.details['writeErrors']
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        return [job for index, job in enumerate(jobs) if index not in duplicates]
+    return jobs
+
+
+def count_jobs(db, jobs):
+    counts = {}
+    for job in jobs:
+        key = (finished_at(job).strftime('%Y-%m-%d'), job.get('job_type'), job.get('job_status'))
+        counts[key] = counts.get(key, 0) + 1
+    if counts:
+        db[JOB_COUNTERS_COLLECTION].bulk_write([
+            UpdateOne({'date': date, 'job_type': job_type, 'job_status': job_status}, {'$inc': {'count': count}},
+                      upsert=True)
+            for (date, job_type, job_status), count in counts.items()], ordered=False)
+
+
+# once every job in a day's history has expired the empty collection is dropped
+def drop_expired_history(db, ttl_days=None):
+    oldest = datetime.datetime.utcnow().date() - datetime.timedelta(days=(ttl_days or JOB_HISTORY_TTL_DAYS) + 1)
+    for name in db.list_collection_names():
+        if name.startswith(JOB_HISTORY_PREFIX) and name < history_collection_name(oldest):
+            db.drop_collection(name)
+            HISTORY_COLLECTIONS.discard((db.name, name))
+
+
+def archive(db):
+    archive_jobs(db)
+    drop_expired_history(db)
@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import deque, defaultdict
+from statistics import pstdev
+from app.settings import INTERVAL_COMPARE, INTERVAL_COMPARE_MIN, INTERVAL_COMPARE_MAX, COMPARE_REQUEST_BUDGET, \
+    EXCHANGE_REQUEST_BUDGETS, EXCHANGE_REQUEST_BUDGET_DEFAULT, CADENCE_WINDOW, CADENCE_HIT_WEIGHT, EXCHANGES
+
+# requests made by other jobs are counted over this many seconds, budgets are per minute
+REQUEST_WINDOW = 60
+
+
+# Works out how often each trade pair is compared. Every COMPARE result reports the best spread across the exchanges
+# that trade the pair and how many arbitrages were found. Pairs whose spread moves a lot, or that often have an
+# arbitrage, are given more weight and compared more often, quiet pairs less often.
+#
+# An interval of k / weight is given to every pair, where k is the smallest value that keeps the order book requests
+# made by all compares within COMPARE_REQUEST_BUDGET and the requests made against each exchange within what is left
+# of its budget once requests by other jobs (TRANSACT, REPLENISH, ...) are taken off. Intervals are then clamped to
+# INTERVAL_COMPARE_MIN and INTERVAL_COMPARE_MAX.
+#
+# The budgets are for everything sharing the exchange accounts. budget_share is the part of them this cadence may use,
+# e.g. 1 / EXECUTOR_SHARDS for each shard of a sharded executor.
+class AdaptiveCadence:
+
+    def __init__(self, trade_pairs, base_interval=None, min_interval=None, max_interval=None, request_budget=None,
+                 exchange_budgets=None, window=None, hit_weight=None, exchanges=None, budget_share=1):
+        self.trade_pairs = list(trade_pairs)
+        self.base_interval = base_interval or INTERVAL_COMPARE
+        self.min_interval = min_interval or INTERVAL_COMPARE_MIN
+        self.max_interval = max_interval or INTERVAL_COMPARE_MAX
+        self.budget_share = budget_share
+        self.request_budget = (request_budget or COMPARE_REQUEST_BUDGET) * budget_share
+        self.exchange_budgets = exchange_budgets if exchange_budgets is not None else EXCHANGE_REQUEST_BUDGETS
+        self.hit_weight = hit_weight if hit_weight is not None else CADENCE_HIT_WEIGHT
+        window = window or CADENCE_WINDOW
+        self.spreads = {trade_pair: deque(maxlen=window) for trade_pair in self.trade_pairs}
+        self.hits = {trade_pair: deque(maxlen=window) for trade_pair in self.trade_pairs}
+        # until a pair has been compared assume that every exchange is asked for its order book
+        self.exchanges = {trade_pair: list(exchanges or EXCHANGES) for trade_pair in self.trade_pairs}
+        self.other_requests = defaultdict(deque)
+        self.intervals = {trade_pair: self.base_interval for trade_pair in self.trade_pairs}
+        self.lock = threading.Lock()
+
+    def interval(self, trade_pair):
+        return self.intervals.get(trade_pair, self.base_interval)
+
+    # called with the market_summary of every finished COMPARE
+    def record(self, trade_pair, summary):
+        with self.lock:
+            if trade_pair not in self.spreads:
+                return
+            if summary.get('spread') is not None:
+                self.spreads[trade_pair].append(float(summary['spread']))
+            self.hits[trade_pair].append(1 if summary.get('arbitrages') else 0)
+            if summary.get('exchanges'):
+                self.exchanges[trade_pair] = list(summary['exchanges'])
+            self.update()
+
+    # called when any other job makes requests against an exchange
+    def spend(self, exchange, requests=1, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.other_requests[exchange].extend([now] * requests)
+            self.update(now)
+
+    def volatility(self, trade_pair):
+        spreads = self.spreads[trade_pair]
+        return pstdev(spreads) if len(spreads) > 1 else 0
+
+    def hit_rate(self, trade_pair):
+        hits = self.hits[trade_pair]
+        return sum(hits) / len(hits) if hits else 0
+
+    def weights(self):
+        volatilities = {trade_pair: self.volatility(trade_pair) for trade_pair in self.trade_pairs}
+        mean_volatility = sum(volatilities.values()) / len(volatilities) if volatilities else 0
+        weights = {}
+        for trade_pair in self.trade_pairs:
+            relative_volatility = volatilities[trade_pair] / mean_volatility if mean_volatility else 1
+            weights[trade_pair] = relative_volatility + self.hit_weight * self.hit_rate(trade_pair)
+            # a pair that has been quiet for the whole window is still compared now and again
+            weights[trade_pair] = max(weights[trade_pair], 0.1)
+        return weights
+
+    def remaining_exchange_budget(self, exchange, now):
+        requests = self.other_requests[exchange]
+        while requests and requests[0] < now - REQUEST_WINDOW:
+            requests.popleft()
+        budget = self.exchange_budgets.get(exchange, EXCHANGE_REQUEST_BUDGET_DEFAULT) * self.budget_share
+        return max(budget - len(requests), 1)
+
+    def update(self, now=None):
+        now = now or time.time()
+        if not self.trade_pairs:
+            return
+        weights = self.weights()
+
+        # with no budgets to worry about a pair of average weight is compared every base_interval
+        k = self.base_interval * sum(weights.values()) / len(weights)
+
+        # every compare asks each exchange that trades the pair for its order book, budgets are per minute
+        requests_per_k = sum(weights[trade_pair] * len(self.exchanges[trade_pair]) for trade_pair in self.trade_pairs)
+        k = max(k, requests_per_k * 60 / self.request_budget)
+
+        per_exchange = defaultdict(float)
+        for trade_pair in self.trade_pairs:
+            for exchange in self.exchanges[trade_pair]:
+                per_exchange[exchange] += weights[trade_pair]
+        for exchange, exchange_weight in per_exchange.items():
+            k = max(k, exchange_weight * 60 / self.remaining_exchange_budget(exchange, now))
+
+        for trade_pair in self.trade_pairs:
+            interval = k / weights[trade_pair]
+            self.intervals[trade_pair] = min(max(interval, self.min_interval), self.max_interval)
@@ -23,7 +23,6 @@ def get_current_fiat_rates(crypto_symbols, fiat_symbol=None):
     uri = build_fiat_rates_uri(crypto_symbols_set, fiat_symbol, meta_data)
     coingecko_rates_data = api_request(uri)
     rates_data = {}
-    meta_data = get_coingecko_meta()
     fiat_symbol_key = get_fiat_symbol(fiat_symbol).upper()
     for crypto_symbol in crypto_symbols_set:
         coingecko_symbol = get_coingecko_id(crypto_symbol.lower(), meta_data)
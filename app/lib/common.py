@@ -1,5 +1,5 @@
 from app.settings import FIAT_REPLENISH_AMOUNT, FIAT_DEFAULT_SYMBOL, EXCHANGES
-from math import log10, log2, modf, floor
+from math import log10, log2, modf, floor, ceil
 from decimal import Decimal, Context, setcontext
 import os, json, requests
 import logging
@@ -126,6 +126,15 @@ def decimal_as_string(number):
 def get_exchanges():
     return EXCHANGES
 
+
+# nearest rank percentile of a list of numbers, e.g. percentile(latencies, 0.95)
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
 def get_longest_trade_path(trade_pairs):
     # trade_pairs is a list of pairs like [[ETH, BTC], [LTC, BTC], ...]
     # this function will find the longest route between trade pairs
@@ -1,21 +1,34 @@
 import pymongo
 import app.settings as settings
+import atexit
 import datetime
+import logging
+import queue
+import threading
 import uuid
 from decimal import Decimal
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
 import os
+import socket
+import time
 from app.lib.common import check_pid
 
+# Generic Database connection
 
-# TODO make this a service shared by the job queue so that we're not always connecting to the database?
+_connection = None
+_connection_pid = None
 
-# Generic Database connection
 
+# MongoClient pools its connections and is thread safe so one is shared by the whole process. A forked child must not
+# use its parent's sockets so it makes its own
 def db_connection():
-    dbconn = pymongo.MongoClient(host=settings.DB_HOST,
-                                 port=settings.DB_PORT_JOBQUEUE)
-    return dbconn
+    global _connection, _connection_pid
+    if _connection is None or _connection_pid != os.getpid():
+        _connection = pymongo.MongoClient(host=settings.DB_HOST,
+                                          port=settings.DB_PORT_JOBQUEUE)
+        _connection_pid = os.getpid()
+    return _connection
 
 
 # Database Connections
@@ -50,21 +63,106 @@ def exchange_db():
     return db
 
 
+# Buffered writes
+
+# Records that the job does not read back straight away (profit audits, the balance history) are handed to a thread that
+# writes them in the background so that a compare never waits on the database to carry on looking for arbitrages. The
+# thread gathers records for up to WRITE_BATCH_INTERVAL seconds or WRITE_BATCH_SIZE records and writes each collection's
+# records with one bulk write. At most WRITE_QUEUE_SIZE records wait to be written: beyond that the job waits for the
+# thread to catch up. Everything is written before the process exits, and flush() waits for it after each job run by a
+# pool worker.
+class BufferedWriter:
+
+    def __init__(self, batch_size=None, interval=None, max_queued=None):
+        self.batch_size = batch_size or settings.WRITE_BATCH_SIZE
+        self.interval = interval if interval is not None else settings.WRITE_BATCH_INTERVAL
+        self.max_queued = max_queued or settings.WRITE_QUEUE_SIZE
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # operation is a pymongo write, e.g. InsertOne, for collection in the database named database_name
+    def write(self, database_name, collection, operation):
+        self.start()
+        self.queue.put((database_name, collection, operation))
+
+    def start(self):
+        with self.lock:
+            # a forked child does not have its parent's thread, or anything the parent had queued
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.max_queued)
+            self.thread = threading.Thread(name='db_writer', target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            batch = []
+            record = self.queue.get()
+            deadline = time.monotonic() + self.interval
+            # None is queued by flush() to write what has been gathered without waiting for the rest of the interval
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write_batch(batch)
+            for _ in range(len(batch) + (record is None)):
+                self.queue.task_done()
+
+    def write_batch(self, batch):
+        collections = {}
+        for database_name, collection, operation in batch:
+            collections.setdefault((database_name, collection), []).append(operation)
+        for (database_name, collection), operations in collections.items():
+            try:
+                db_connection()[database_name][collection].bulk_write(operations, ordered=True)
+            except Exception as e:
+                # the thread carries on, a record that cannot be written must not stop the ones after it
+                logging.error('Error writing {} records to {}.{}: {}'.format(len(operations), database_name,
+                                                                             collection, e))
+
+    # waits until every record written so far by this process is in the database
+    def flush(self):
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.queue.join()
+
+
+WRITER = BufferedWriter()
+atexit.register(WRITER.flush)
+
+
 # Database methods
 
-def store_trade(trade):
-    db = trades_db()
+# trades are written before returning unless durable is False as the trade is the only record of the money moved
+def store_trade(trade, durable=True):
     trade['datetime'] = datetime.datetime.utcnow()
-    db.trades.update_one({'_id': trade.get('_id')}, {'$set': trade}, upsert=True)
+    if durable:
+        trades_db().trades.update_one({'_id': trade.get('_id')}, {'$set': trade}, upsert=True)
+    else:
+        WRITER.write(settings.DB_NAME_TRADES, 'trades', UpdateOne({'_id': trade.get('_id')}, {'$set': trade},
+                                                                   upsert=True))
 
 
-def store_audit(audit):
-    db = audit_db()
+# audits are written in the background unless durable is True, e.g. when a downstream job will update the audit. The
+# _id is made here so that it can be returned straight away
+def store_audit(audit, durable=False):
     audit['datetime'] = datetime.datetime.utcnow()
     if 'type' not in audit:
         raise ValueError('Audit type must be specified')
-    _id = db.audit.insert(audit)
-    return _id
+    audit.setdefault('_id', ObjectId())
+    if durable:
+        audit_db().audit.insert_one(audit)
+    else:
+        WRITER.write(settings.DB_NAME_AUDIT, 'audit', InsertOne(audit))
+    return audit['_id']
 
 
 def update_audit(_id, update_dict):
@@ -99,13 +197,21 @@ def get_fiat_rate(symbol):
     return fiat_rates
 
 
+# the latest rates of symbol and when they were stored, or None if there are none
+def get_latest_fiat_rate(symbol):
+    db = common_db()
+    records = [x for x in db.fiat_rates.find({symbol: {'$exists': True}}).sort([('datetime', -1)]).limit(1)]
+    if not records:
+        return None
+    return records[0][symbol], records[0]['datetime']
+
+
 def store_balances(exchange, balances):
-    db = exchange_db()
     balances_record = {}
     balances_record['balances'] = {symbol: float(amount) for symbol, amount in balances.items()}
     balances_record['datetime'] = datetime.datetime.utcnow()
     balances_record['exchange'] = exchange
-    db.balances.insert_one(balances_record)
+    WRITER.write(settings.DB_NAME_EXCHANGE, 'balances', InsertOne(balances_record))
 
 
 def get_balances(exchange):
@@ -117,13 +223,50 @@ def get_balances(exchange):
     return balances
 
 
+# The balances last fetched from each exchange are shared by every job through the balance_cache collection, one
+# document per exchange. A COMPARE that finds several arbitrages on the same exchange, or compares running at the same
+# time, fetch the balances once between them. Amounts are stored as strings so that they come back as the same Decimal.
+def store_cached_balances(exchange, balances):
+    db = exchange_db()
+    db.balance_cache.replace_one({'_id': exchange},
+                                 {'balances': {symbol: str(amount) for symbol, amount in balances.items()
+                                               if amount is not None},
+                                  'fetched_at': datetime.datetime.utcnow()}, upsert=True)
+
+
+# returns the cached balances of the exchange or None if there are none younger than ttl seconds
+def get_cached_balances(exchange, ttl):
+    db = exchange_db()
+    fetched_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    record = db.balance_cache.find_one({'_id': exchange, 'fetched_at': {'$gt': fetched_after}})
+    if not record:
+        return None
+    return {symbol: Decimal(amount) for symbol, amount in record['balances'].items()}
+
+
+# called once funds have moved on the exchange so that the next job fetches the balances again
+def invalidate_balances(exchange):
+    db = exchange_db()
+    db.balance_cache.delete_one({'_id': exchange})
+
+
 def get_replenish_jobs(exchange, currency):
+    return get_recent_replenish_jobs([(exchange, currency)])
+
+
+# The REPLENISH jobs of the last 30 minutes that succeeded for any of the (exchange, currency) pairs, found with one query
+# on the index created by setup_database. Jobs are timed by their _id as they are given no other creation time
+def get_recent_replenish_jobs(exchange_currencies):
+    exchange_currencies = set(exchange_currencies)
+    if not exchange_currencies:
+        return []
     db = jobqueue_db()
     recent_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=30)
     replenish_jobs = [x for x in db.jobs.find(
-        {'job_args.exchange': exchange,
-         'job_args.currency': currency,
-         'datetime': {'$gt': recent_time},
+        {'job_type': 'REPLENISH',
+         '$or': [{'job_args.exchange': exchange, 'job_args.currency': currency}
+                 for exchange, currency in sorted(exchange_currencies)],
+         '_id': {'$gt': ObjectId.from_datetime(recent_time)},
          'job_result.success': True})]
     return replenish_jobs
 
@@ -140,9 +283,10 @@ def exchange_lock(exchange, jobqueue_id, job, lock):
     return
 
 
+# locks are shared by every job queue so that jobs on other nodes are seen too
 def get_exchange_lock(exchange, jobqueue_id, job):
     db = exchange_db()
-    lock = db.exchange_lock.find_one({'exchange': exchange, 'jobqueue_id': jobqueue_id, 'job': job})
+    lock = db.exchange_lock.find_one({'exchange': exchange, 'job': job})
     return lock
 
 
@@ -219,41 +363,48 @@ def unlock_api_method(exchange, method, jobqueue_id):
     db.method_lock.delete_one({'exchange': exchange, 'method': method, 'jobqueue_id': ObjectId(jobqueue_id)})
 
 
-# check if an API method is locked
+# check if an API method is locked, by a job on any node
 def get_api_method_lock(exchange, method, jobqueue_id):
     result = False
     db = exchange_db()
-    record = db.method_lock.find_one({'exchange': exchange, 'method': method, 'jobqueue_id': ObjectId(jobqueue_id)})
+    record = db.method_lock.find_one({'exchange': exchange, 'method': method})
     if record:
         result = True
     return result
 
 
-# Remove any locks on api methods that are not owned by a running jobqueue
+# Remove any exchange and api method locks that are not owned by a running jobqueue
 def remove_api_method_locks():
     db = jobqueue_db()
 
     jobqueues_ended = []
-    # first check to see if the jobqueues listed in the db are actually running
-    # TODO a more thorough check than PID only, although it is fairly unique
-    for jobqueue_status_doc in db.status.find({'running': True}):
-        # if there is no pid field the use a PID that is too large to be running
-        if not check_pid(jobqueue_status_doc.get('pid', 9999999999999)):
+    # first check to see if the jobqueues listed in the db are actually running. Job queues on other hosts are judged by
+    # their heartbeat, see JobQueueExecutor.heartbeat
+    expired = time.time() - settings.JOB_LEASE_DURATION
+    for jobqueue_status_doc in db.status.find({}):
+        if jobqueue_status_doc.get('host', socket.gethostname()) == socket.gethostname() and \
+                not check_pid(jobqueue_status_doc.get('pid', 9999999999999)):
+            # if there is no pid field the use a PID that is too large to be running
+            jobqueues_ended.append(jobqueue_status_doc['_id'])
+        elif jobqueue_status_doc.get('heartbeat', 0) < expired or not jobqueue_status_doc.get('running'):
             jobqueues_ended.append(jobqueue_status_doc['_id'])
 
     # remove the jobqueue statuses for jobqueues that are not running
     db.status.delete_many({'_id': {'$in': jobqueues_ended}})
     db = exchange_db()
-    # remove any method locks associated with jobqueues that are not running
-    db.method_lock.delete_many({'_id': {'$in': jobqueues_ended}})
+    # remove any locks associated with jobqueues that are not running. job arguments hold the jobqueue_id as a string
+    jobqueue_ids = jobqueues_ended + [str(x) for x in jobqueues_ended]
+    db.method_lock.delete_many({'jobqueue_id': {'$in': jobqueue_ids}})
+    db.exchange_lock.delete_many({'jobqueue_id': {'$in': jobqueue_ids}})
 
 
 def get_trade_id():
     job_pid = os.getpid()
     db = jobqueue_db()
-    this_job = db.jobs.find_one({'job_pid': job_pid})
+    # pooled workers run many jobs under the same pid so take the most recent one
+    this_job = [x for x in db.jobs.find({'job_pid': job_pid}).sort([('_id', -1)]).limit(1)]
     if this_job:
-        trade_id = this_job.get('_id')
+        trade_id = this_job[0].get('_id')
     else:
         # we may be running the job outside of the job queue
         trade_id = uuid.uuid4().hex.replace('-', '')[0:23]
@@ -0,0 +1,127 @@
+import numpy as np
+from decimal import Decimal, Context, ROUND_DOWN
+
+
+# Works out how much of an arbitrage to take by walking down the buy exchange's asks and the sell exchange's bids rather
+# than stopping at the best ask and bid. The cost of buying v and the revenue of selling v are piecewise linear in v,
+# changing slope at the levels of either book, and their difference is concave: every further unit is bought dearer and
+# sold cheaper. The volume that makes the most profit is therefore one of the level boundaries, and all of them are
+# tried at once with numpy. The plan for that volume is then worked out again level by level in Decimal so that the
+# prices, volumes and profit handed on are exact.
+
+
+# cumulative volume and notional (price * volume) at the end of each level, starting from nothing
+def cumulative(levels):
+    levels = [level for level in levels if level['volume'] > 0]
+    prices = np.array([float(level['price']) for level in levels])
+    volumes = np.array([float(level['volume']) for level in levels])
+    return np.concatenate(([0.], np.cumsum(volumes))), np.concatenate(([0.], np.cumsum(prices * volumes)))
+
+
+# Returns the volume that makes the most profit after fees, or 0 if no volume is profitable. The volume is kept between
+# min_volume and max_volume and the amount spent buying is kept under max_cost
+def optimal_volume(asks, bids, fee_buy, fee_sell, min_volume=0, max_volume=None, max_cost=None):
+    ask_volumes, ask_notionals = cumulative(asks)
+    bid_volumes, bid_notionals = cumulative(bids)
+    limit = min(ask_volumes[-1], bid_volumes[-1])
+    if max_volume is not None:
+        limit = min(limit, max_volume)
+    if max_cost is not None:
+        limit = min(limit, np.interp(max_cost, ask_notionals, ask_volumes))
+    if limit <= 0 or min_volume > limit:
+        return 0
+
+    volumes = np.union1d(ask_volumes, bid_volumes)
+    volumes = np.concatenate((volumes[(volumes > min_volume) & (volumes < limit)], [min_volume, limit]))
+    volumes = volumes[volumes > 0]
+    cost = np.interp(volumes, ask_volumes, ask_notionals) * (1 + fee_buy)
+    revenue = np.interp(volumes, bid_volumes, bid_notionals) * (1 - fee_sell)
+    profit = revenue - cost
+    best = np.argmax(profit)
+    return float(volumes[best]) if profit[best] > 0 else 0
+
+
+# the levels of the book taken to fill volume
+def walk(levels, volume):
+    taken = []
+    for level in levels:
+        if volume <= 0:
+            break
+        level_volume = min(level['volume'], volume)
+        if level_volume > 0:
+            taken.append({'price': level['price'], 'volume': level_volume})
+            volume -= level_volume
+    return taken
+
+
+# the levels of the book left once volume has been taken from the top of it
+def remaining(levels, volume):
+    left = []
+    for level in levels:
+        if volume >= level['volume']:
+            volume -= level['volume']
+        elif volume > 0:
+            left.append(dict(level, volume=level['volume'] - volume))
+            volume = 0
+        else:
+            left.append(level)
+    return left
+
+
+def notional(levels):
+    return sum((level['price'] * level['volume'] for level in levels), Decimal(0))
+
+
+# The most profitable way of buying on exchange_buy and selling on exchange_sell. Returns None if nothing is profitable
+# or the volume is too small to trade, otherwise the volume, the levels taken from each book, the limit prices that
+# sweep those levels and the profit in fiat. max_cost (in fiat) caps the amount spent buying
+def plan_arbitrage(exchange_buy, exchange_sell, fiat_rate, max_volume=None, max_cost=None):
+    asks, bids = exchange_buy.asks, exchange_sell.bids
+    if not asks or not bids:
+        return None
+
+    top_price = float(asks[0]['price'])
+    volume = optimal_volume(asks, bids, float(exchange_buy.fee), float(exchange_sell.fee),
+                            min_volume=minimum_volume([exchange_buy, exchange_sell], top_price),
+                            max_volume=float(max_volume) if max_volume is not None else None,
+                            max_cost=float(max_cost / fiat_rate) if max_cost is not None else None)
+    if not volume:
+        return None
+
+    # floats are only used to find the volume, round it down so that it is never more than the books hold. The context
+    # set by the exchanges counts significant digits rather than decimal places so is not used here
+    places = min(exchange_buy.decimal_places, exchange_sell.decimal_places)
+    volume = Decimal(repr(volume)).quantize(Decimal(1).scaleb(-places), rounding=ROUND_DOWN, context=Context(prec=28))
+    buy_levels = walk(asks, volume)
+    sell_levels = walk(bids, volume)
+    if not buy_levels or not sell_levels:
+        return None
+    price_buy = buy_levels[-1]['price']
+    price_sell = sell_levels[-1]['price']
+
+    valid_buy = exchange_buy.trade_validity(currency=exchange_buy.base_currency, price=price_buy, volume=volume)[0]
+    valid_sell = exchange_sell.trade_validity(currency=exchange_sell.base_currency, price=price_sell, volume=volume)[0]
+    if not valid_buy or not valid_sell:
+        return None
+
+    cost = notional(buy_levels)
+    revenue = notional(sell_levels)
+    fee = exchange_buy.fee * cost + exchange_sell.fee * revenue
+    profit = (revenue - cost - fee) * fiat_rate
+    if profit <= 0:
+        return None
+    return {'volume': volume, 'price_buy': price_buy, 'price_sell': price_sell, 'buy_levels': buy_levels,
+            'sell_levels': sell_levels, 'profit': profit}
+
+
+# the smallest volume both exchanges accept, minimum trade sizes in the quote currency are converted at price
+def minimum_volume(exchanges, price):
+    volumes = [0]
+    for exchange in exchanges:
+        if exchange.min_trade_size_currency == exchange.base_currency:
+            volumes.append(float(exchange.min_trade_size))
+        elif price:
+            volumes.append(float(exchange.min_trade_size) / price)
+        if getattr(exchange, 'min_notional', None) and price:
+            volumes.append(float(exchange.min_notional) / price)
+    return max(volumes)
@@ -0,0 +1,96 @@
+import threading
+import logging
+from pymongo.errors import OperationFailure, PyMongoError
+from app.settings import DISPATCH_POLL_INTERVAL, DISPATCH_RETRY_DELAY, DISPATCH_RETRY_MAX_DELAY, JOBS_NOT_RUNNING
+from app.lib.jobqueue import STATUS_CREATING
+
+# how long a change stream waits for a change before checking whether the dispatcher has been stopped
+WATCH_MAX_AWAIT_MS = 200
+
+
+# Follows a jobs collection and calls callback(_id) for every job that becomes CREATING, whichever process inserted it.
+# A change stream is used where the server supports one (replica sets), otherwise the collection is polled.
+# The callback may be given the same _id more than once so it must claim jobs atomically. Jobs it passes over, e.g. those
+# of another shard, are left CREATING and are not given to it again until they have left CREATING and come back.
+class JobDispatcher:
+
+    def __init__(self, collection, callback, poll_interval=None):
+        self.collection = collection
+        self.callback = callback
+        self.poll_interval = poll_interval or DISPATCH_POLL_INTERVAL
+        self.stopped = threading.Event()
+        self.thread = None
+        self.mode = None
+        # CREATING jobs found by the last dispatch_creating
+        self.dispatched = set()
+        # database errors in a row
+        self.failures = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    # keeps following the collection until stopped, whatever happens to the connection
+    def follow(self):
+        while not self.stopped.is_set():
+            try:
+                if self.mode == 'poll':
+                    self.poll()
+                else:
+                    self.watch()
+            except OperationFailure as e:
+                if self.mode is None:
+                    # standalone mongod does not support change streams
+                    logging.info('Change streams unavailable, polling for new jobs instead: {}'.format(e))
+                    self.mode = 'poll'
+                else:
+                    self.back_off(e)
+            except PyMongoError as e:
+                self.back_off(e)
+
+    def back_off(self, e):
+        delay = min(DISPATCH_RETRY_DELAY * 2 ** self.failures, DISPATCH_RETRY_MAX_DELAY)
+        self.failures += 1
+        logging.error('Lost the jobs collection, following it again in {}s: {}'.format(delay, e))
+        self.stopped.wait(delay)
+
+    def watch(self):
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'insert',
+             'fullDocument.job_status': STATUS_CREATING,
+             'fullDocument.job_type': {'$nin': JOBS_NOT_RUNNING}},
+            # jobs can also be put back to CREATING, e.g. to be retried
+            {'operationType': 'update',
+             'updateDescription.updatedFields.job_status': STATUS_CREATING},
+        ]}}]
+        with self.collection.watch(pipeline, max_await_time_ms=WATCH_MAX_AWAIT_MS) as stream:
+            self.mode = 'changestream'
+            # pick up anything created before the stream was opened
+            self.dispatch_creating()
+            while not self.stopped.is_set():
+                change = stream.try_next()
+                if change:
+                    self.dispatch(change['documentKey']['_id'])
+
+    def poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.dispatch_creating()
+
+    def dispatch_creating(self):
+        query = {'job_status': STATUS_CREATING, 'job_type': {'$nin': JOBS_NOT_RUNNING}}
+        _ids = [job['_id'] for job in self.collection.find(query, {'_id': 1}).sort([('_id', 1)])]
+        self.failures = 0
+        # jobs the callback failed on are tried again next time
+        self.dispatched = {_id for _id in _ids if _id in self.dispatched or self.dispatch(_id)}
+
+    def dispatch(self, _id):
+        try:
+            self.callback(_id)
+            return True
+        except Exception as e:
+            # one bad job must not stop the dispatcher
+            logging.error('Error dispatching job {}: {}'.format(_id, e))
+            return False
@@ -2,6 +2,8 @@ from abc import ABC, abstractmethod
 from app.lib.errors import ErrorTradePairDoesNotExist
 from decimal import Decimal, setcontext, Context, getcontext
 from app.lib.common import round_decimal_number
+from app.lib.db import get_cached_balances, store_cached_balances
+from app.settings import BALANCE_CACHE_TTL, BALANCE_CACHE_TTLS
 import logging
 
 
@@ -140,6 +142,17 @@ class exchange(ABC):
 
         return result, price, volume_corrected
 
+    # sets self.balances from the balances shared by all jobs, only asking the exchange when they are older than the
+    # exchange's BALANCE_CACHE_TTL
+    def get_cached_balances(self):
+        balances = get_cached_balances(self.name, BALANCE_CACHE_TTLS.get(self.name, BALANCE_CACHE_TTL))
+        if balances is not None:
+            self.balances = balances
+            return
+        self.get_balances()
+        if self.balances is not None:
+            store_cached_balances(self.name, self.balances)
+
     def get_minimum_deposit_volume(self, currency):
         minimum_deposit_volume = self.minimum_deposit.get(currency, 0)
         return minimum_deposit_volume
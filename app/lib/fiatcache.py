@@ -0,0 +1,87 @@
+import datetime
+import logging
+import threading
+import time
+from app.settings import INTERVAL_FIAT_RATE, FIAT_DEFAULT_SYMBOL
+from app.lib.db import get_latest_fiat_rate
+from app.lib.coingecko import get_current_fiat_rate
+
+
+# the rate of symbol stored by the job queue and when it was stored (seconds since the epoch), or None
+def load_fiat_rate(symbol):
+    record = get_latest_fiat_rate(symbol)
+    if record is None:
+        return None
+    rates, stored_at = record
+    return rates[FIAT_DEFAULT_SYMBOL], stored_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+# Keeps the fiat rate of each currency in the process so that compares do not read the fiat_rates collection every time.
+# A rate is kept for INTERVAL_FIAT_RATE seconds after it was stored, the interval at which the job queue stores new
+# ones. After that the old rate is still returned while one thread reads the new rate, downloading it from CoinGecko if
+# the job queue has not stored one, so a compare only ever waits for a rate the process has never had. Callers asking
+# for a rate that is already being fetched wait for that fetch instead of starting their own.
+class FiatRateCache:
+
+    def __init__(self, ttl=None, load=None, download=None):
+        self.ttl = ttl if ttl is not None else INTERVAL_FIAT_RATE
+        self.load = load or load_fiat_rate
+        self.download = download or get_current_fiat_rate
+        # symbol => (rate, time after which it is refreshed)
+        self.rates = {}
+        # symbol => event set once the refresh running for it has finished
+        self.refreshing = {}
+        self.lock = threading.Lock()
+
+    def get(self, symbol):
+        entry = self.rates.get(symbol)
+        if entry is None:
+            self.refresh(symbol, wait=True)
+            entry = self.rates.get(symbol)
+            if entry is None:
+                raise FiatRateError('No fiat rate for {}'.format(symbol))
+        elif time.time() >= entry[1]:
+            self.refresh(symbol, wait=False)
+        return entry[0]
+
+    # fixes the rate of symbol for good, e.g. so that a replay does not depend on the rates of the day it is run
+    def pin(self, symbol, rate):
+        self.rates[symbol] = (rate, float('inf'))
+
+    def refresh(self, symbol, wait):
+        with self.lock:
+            done = self.refreshing.get(symbol)
+            leader = done is None
+            if leader:
+                done = self.refreshing[symbol] = threading.Event()
+        if not leader:
+            if wait:
+                done.wait()
+        elif wait:
+            self.revalidate(symbol, done)
+        else:
+            threading.Thread(name='fiat_rate_{}'.format(symbol), target=self.revalidate, args=(symbol, done),
+                             daemon=True).start()
+
+    def revalidate(self, symbol, done):
+        try:
+            entry = self.load(symbol)
+            if entry is None or time.time() - entry[1] >= self.ttl:
+                logging.debug('Fiat rate for {} not present. Trying to download.'.format(symbol))
+                self.download(symbol)
+                entry = self.load(symbol)
+            if entry is not None:
+                # if the download did not give a newer rate, try again a tenth of the interval later
+                self.rates[symbol] = (entry[0], max(entry[1] + self.ttl, time.time() + self.ttl / 10))
+        except Exception as e:
+            logging.warning('Could not refresh the fiat rate of {}: {}'.format(symbol, e))
+            if symbol in self.rates:
+                self.rates[symbol] = (self.rates[symbol][0], time.time() + self.ttl / 10)
+        finally:
+            with self.lock:
+                del self.refreshing[symbol]
+            done.set()
+
+
+class FiatRateError(Exception):
+    pass
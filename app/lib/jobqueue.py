@@ -8,7 +8,14 @@ import datetime
 import json
 import sys
 import calendar
+import time
+import pickle
+import struct
+import threading
+from decimal import Decimal
+from bson import Decimal128
 from bson import json_util
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import simplejson
 
 POLL_INTERVAL = timedelta(seconds=2)
@@ -16,9 +23,22 @@ STATUS_CREATING = 'CREATING'
 STATUS_RUNNING = 'RUNNING'
 STATUS_COMPLETE = 'COMPLETE'
 STATUS_FAILED = 'FAILED'
+# jobs that were never run, e.g. shed by the scheduler
+STATUS_CANCELLED = 'CANCELLED'
+# waiting to be put back to CREATING at job_run_at
+STATUS_RETRY = 'RETRY'
+# jobs added together are held in this state until all of them have been inserted, see add_jobs
+STATUS_INSERTING = 'INSERTING'
+# jobs in these states are finished and no longer hold their job_key
+TERMINAL_STATUSES = [STATUS_COMPLETE, STATUS_FAILED, STATUS_CANCELLED]
 JOB_COLLECTION = 'jobs'
 JOB_STATUS_COLLECTION = 'status'
 MAX_STDLOG_SIZE = 100 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+# environment variable holding the file descriptor that a job writes its result to
+RESULT_FD_ENV = 'ARB_RESULT_FD'
+# each result frame is a 4 byte big endian length followed by that many bytes of pickle
+RESULT_FRAME_HEADER = struct.Struct('>I')
 JOB_DEFINITIONS = {'TRANSACT':
                        {'type': {'type': str, 'valid': ['buy', 'sell']},
                         'exchange': {'type': str},
@@ -32,6 +52,10 @@ JOB_DEFINITIONS = {'TRANSACT':
                         'curr_y': {'type': str},
                         'jobqueue_id': {'type': str},
                         },
+                   'COMPARE_BATCH':
+                       {'trade_pairs': {'type': str},
+                        'jobqueue_id': {'type': str},
+                        },
                    'REPLENISH':
                        {'exchange': {'type': str},
                         'currency': {'type': str},
@@ -46,6 +70,14 @@ JOB_DEFINITIONS = {'TRANSACT':
                         }
                    }
 
+# the stages of a job's life that are timed in job_timestamps, in the order they happen. dispatched and the stages after
+# it are timed from the stage before that was recorded. finished is when the job was given its final status
+JOB_STAGES = ['enqueued', 'dispatched', 'spawned', 'imports_done', 'first_exchange_response', 'result_parsed',
+              'downstream_inserted', 'finished']
+
+# only one job of these types with the same arguments may be waiting or running at once, see job_key
+DEDUPLICATED_JOB_TYPES = ['COMPARE']
+
 
 # Handles CRUD of jobs, starts jobs, exists as an instance of a "JobQueue" in the database
 class Jobqueue:
@@ -57,18 +89,19 @@ class Jobqueue:
         self._id = None
         self.compare_trade_pairs_intervals = {}
         self.runningjobs = []
-        self._newjob = None
+        self._newjobs = []
         self._observers = []
 
+    # the _ids of the jobs last added by this process. Observers are called once with all of the jobs added together
     @property
-    def newjob(self):
-        return self._newjob
+    def newjobs(self):
+        return self._newjobs
 
-    @newjob.setter
-    def newjob(self, value):
-        self._newjob = value
+    @newjobs.setter
+    def newjobs(self, value):
+        self._newjobs = value
         for callback in self._observers:
-            callback(self._newjob)
+            callback(self._newjobs)
 
     def bind_to(self, callback):
         self._observers.append(callback)
@@ -78,27 +111,60 @@ class Jobqueue:
         return result
 
     def add_job(self, job, jobqueue_id):
-        _id = None
-        jobtype = job['job_type'].upper()
-        if jobtype not in JOB_DEFINITIONS:
-            raise TypeError('Unknown job type {}'.format(jobtype))
-
-        valid_job = self.validate_job(job, JOB_DEFINITIONS[jobtype])
-
-        if valid_job:
-            valid_job['jobqueue_id'] = jobqueue_id
+        valid_job = self.prepare_job(job, jobqueue_id)
+        try:
             _id_result = self.db[JOB_COLLECTION].insert_one(valid_job)
-            _id = _id_result.inserted_id
-            self.newjob = _id
+        except DuplicateKeyError:
+            # an identical job is already waiting or running, possibly added by another process
+            logging.debug('Not adding {}: Existing job!'.format(valid_job['job_key']))
+            return None
+        _id = _id_result.inserted_id
+        self.newjobs = [_id]
         return _id
 
+    # Adds several jobs with one insert, all of them or none. The jobs are all validated before any is added and are
+    # inserted in order, held as INSERTING so that none is started before the others are in. Only then are they released
+    # to CREATING and handed to the observers together, so the buy leg of an arbitrage never runs without its sell leg
     def add_jobs(self, jobs):
-        _ids = []
-        if isinstance(jobs, list):
-            for job in jobs:
-                _ids.append(self.add_job(job, jobqueue_id=self._id))
+        if not isinstance(jobs, list) or not jobs:
+            return []
+        valid_jobs = [dict(self.prepare_job(job, self._id), job_status=STATUS_INSERTING) for job in jobs]
+        collection = self.db[JOB_COLLECTION]
+        try:
+            _ids = collection.insert_many(valid_jobs, ordered=True).inserted_ids
+        except BulkWriteError as e:
+            # an ordered insert stops at the first job that could not be added, e.g. a duplicate job_key. The jobs
+            # inserted before it are cancelled rather than started without it
+            error = e.details['writeErrors'][0]['errmsg']
+            logging.error('Not adding {} jobs, job {} of them could not be added: {}'.format(
+                len(valid_jobs), e.details['nInserted'] + 1, error))
+            inserted = [job['_id'] for job in valid_jobs[:e.details['nInserted']]]
+            if inserted:
+                collection.update_many({'_id': {'$in': inserted}, 'job_status': STATUS_INSERTING},
+                                       {'$set': {'job_status': STATUS_CANCELLED,
+                                                 'job_error': 'Added with a job that could not be added: {}'.format(
+                                                     error)},
+                                        '$unset': {'job_key': ''}})
+            return []
+        collection.update_many({'_id': {'$in': _ids}, 'job_status': STATUS_INSERTING},
+                               {'$set': {'job_status': STATUS_CREATING}})
+        self.newjobs = _ids
         return _ids
 
+    # the document stored for a new job
+    def prepare_job(self, job, jobqueue_id):
+        jobtype = job['job_type'].upper()
+        if jobtype not in JOB_DEFINITIONS:
+            raise TypeError('Unknown job type {}'.format(jobtype))
+
+        valid_job = self.validate_job(job, JOB_DEFINITIONS[jobtype])
+        valid_job['jobqueue_id'] = jobqueue_id
+        # wall clock rather than monotonic so that jobs inserted by other processes or hosts can be timed
+        valid_job['job_timestamps'] = {'enqueued': time.time()}
+        if jobtype in DEDUPLICATED_JOB_TYPES:
+            valid_job['job_key'] = job_key(jobtype, valid_job['job_args'])
+        return valid_job
+
     def validate_job(self, job, job_def):
         for param, paramdef in job_def.items():
             if param not in job['job_args']:
@@ -113,49 +179,113 @@ class Jobqueue:
         valid_job['job_status'] = STATUS_CREATING
         return valid_job
 
-    def update_job(self, job):
+    # query narrows down the update, e.g. to jobs still owned by this job queue. Returns whether the job was updated
+    def update_job(self, job, query=None):
+        if isinstance(job, dict):
+            result = self.db[JOB_COLLECTION].update_one(*self.update_job_request(job, query))
+            return result.matched_count == 1
+
+    # the filter and update of update_job, e.g. for bulk writes of several jobs
+    def update_job_request(self, job, query=None):
         job_copy = job.copy()
         job_copy.pop('_id')
-        if isinstance(job, dict):
-            _id = self.db[JOB_COLLECTION].update_one({'_id': ObjectId(job['_id'])}, {'$set': job_copy})
+        update = {'$set': job_copy}
+        if job_copy.get('job_status') in TERMINAL_STATUSES:
+            # free the key so that the same job can be added again
+            job_copy.pop('job_key', None)
+            update['$unset'] = {'job_key': ''}
+            job_copy['job_timestamps'] = dict(job_copy.get('job_timestamps') or {}, finished=time.time())
+        return dict(query or {}, _id=ObjectId(job['_id'])), update
 
     def get_job(self, _id):
         job = self.db[JOB_COLLECTION].find_one({'_id': ObjectId(_id)})
         return job
 
-    def run_command(self, job, safecmd, stdin=None):
-
-        stdin = json_util.dumps({}, ensure_ascii=False, indent=2, cls=JsonEncoder).encode('utf-8')
-        # now actually run the cmd
+    def run_command(self, job, safecmd):
         env = os.environ.copy()
         safecmd = [str(x) for x in safecmd]
         logging.debug('Running command {}'.format(' '.join(['python3', '-m', ] + safecmd)))
         cmd = ['python3', '-m', ] + safecmd
+
+        # the job hands its result back on a pipe of its own so that stdout and stderr are only ever logs
+        result_read, result_write = os.pipe()
+        env[RESULT_FD_ENV] = str(result_write)
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                   stdin=subprocess.PIPE, env=env, close_fds=True)
+                                   stdin=subprocess.DEVNULL, env=env, close_fds=True, pass_fds=(result_write,))
+        os.close(result_write)
 
         job['job_status'] = STATUS_RUNNING
         job['job_pid'] = process.pid
+        job.setdefault('job_timestamps', {})['spawned'] = time.time()
 
+        # drain all three pipes at once, a job that fills one of them while we wait on another would block forever
+        stdout_tail = StreamTail(process.stdout, MAX_STDLOG_SIZE)
+        stderr_tail = StreamTail(process.stderr, MAX_STDLOG_SIZE)
+        stdout_tail.start()
+        stderr_tail.start()
+        with os.fdopen(result_read, 'rb') as result_pipe:
+            result_frames = result_pipe.read()
+        stdout_tail.join()
+        stderr_tail.join()
         retcode = process.wait()
-        (stdout, stderr) = process.communicate(stdin)
 
+        self.handle_command_output(job, retcode, stdout_tail.text(), stderr_tail.text(), result_frames)
+
+        return
+
+    # record the outcome of a job run by run_command, and add any downstream jobs it returned
+    def handle_command_output(self, job, retcode, stdout_log, stderr_log, result_frames):
         if retcode == 0:
-            print(stderr.strip().decode('ascii'))
-            print(stdout.strip().decode('ascii'))
+            print(stderr_log)
+            print(stdout_log)
             job['job_status'] = STATUS_COMPLETE
-            stdout_str = stdout.strip().decode('ascii')
-            job['job_result'] = json.loads(stdout_str, object_hook=json_util.object_hook)
-            if len(job['job_result'].get('downstream_jobs', [])):
-                self.add_jobs(job['job_result']['downstream_jobs'])
+            results = read_result_frames(result_frames)
+            self.set_job_result(job, results[-1] if results else {})
         else:
             logging.error('FAILURE!')
-            logging.error(stderr.strip().decode('ascii'))
+            logging.error(stderr_log)
             job['job_status'] = STATUS_FAILED
-            job['job_error'] = stderr.strip().decode('ascii')
+            job['job_error'] = stderr_log
+
+    def run_pooled(self, job, pool):
+        # same contract as run_command but the job is handed to a worker process that is already running
+
+        def worker_assigned(pid):
+            job['job_pid'] = pid
+            job.setdefault('job_timestamps', {})['spawned'] = time.time()
+            # jobs look themselves up by pid (see get_trade_id) so this must be stored before the job starts
+            self.db[JOB_COLLECTION].update_one({'_id': job['_id']}, {'$set': {'job_pid': pid}})
+
+        job['job_status'] = STATUS_RUNNING
+        logging.debug('Running {} {} in worker pool'.format(job['job_type'], job['job_args']))
+        success, output = pool.run(job['job_type'], job['job_args'], worker_assigned)
+
+        if success:
+            job['job_status'] = STATUS_COMPLETE
+            self.set_job_result(job, output or {})
+        else:
+            logging.error('FAILURE!')
+            logging.error(output)
+            job['job_status'] = STATUS_FAILED
+            job['job_error'] = output
 
         return
 
+    # p50/p95/p99 of the time spent in each stage, by job type, for jobs added since `since` (a datetime)
+    def stage_stats(self, since):
+        return list(self.db[JOB_COLLECTION].aggregate(stage_stats_pipeline(since)))
+
+    def set_job_result(self, job, result):
+        result = dict(result)
+        job_timestamps = job.setdefault('job_timestamps', {})
+        # the stages timed by the job itself come back with its result
+        job_timestamps.update(result.pop('job_timestamps', {}))
+        job_timestamps['result_parsed'] = time.time()
+        job['job_result'] = bson_compatible(result)
+        if len(job['job_result'].get('downstream_jobs', [])):
+            self.add_jobs(job['job_result']['downstream_jobs'])
+            job_timestamps['downstream_inserted'] = time.time()
+
 
 class JsonEncoder(json.JSONEncoder):
     def default(self, o):
@@ -165,7 +295,148 @@ class JsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
-def return_value_to_stdout(value=None):
-    if value:
+# Keeps the last limit bytes read from a stream, e.g. a job's stdout, reading until the stream is closed
+class StreamTail(threading.Thread):
+
+    def __init__(self, stream, limit):
+        super(StreamTail, self).__init__(daemon=True)
+        self.stream = stream
+        self.limit = limit
+        self.data = bytearray()
+
+    def run(self):
+        while True:
+            chunk = self.stream.read1(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.data += chunk
+            if len(self.data) > self.limit:
+                del self.data[:len(self.data) - self.limit]
+
+    def text(self):
+        return self.data.decode('utf-8', errors='replace').strip()
+
+
+# identifies a job by its type and arguments. Jobs of DEDUPLICATED_JOB_TYPES store this as job_key while they are
+# waiting or running, and a unique index on job_key stops a second identical job being added
+def job_key(job_type, job_args):
+    return '{}:{}'.format(job_type.upper(), ','.join('{}={}'.format(k, job_args[k]) for k in sorted(job_args)))
+
+
+# set inside pooled workers so that job results are handed straight back instead of being written out
+_result_callback = None
+
+
+def set_result_callback(callback):
+    global _result_callback
+    _result_callback = callback
+
+
+# One aggregation that works out, for every job, how long each stage took after the stage before it that was recorded,
+# then groups the durations by job type and stage and picks the percentiles by nearest rank from the sorted durations.
+# total is the time from enqueued to the last stage recorded
+def stage_stats_pipeline(since, fractions=(0.5, 0.95, 0.99)):
+    def timestamp(stage):
+        return '$job_timestamps.{}'.format(stage)
+
+    def first_recorded(stages):
+        # the latest of `stages` that was recorded
+        expression = timestamp(stages[0])
+        for stage in stages[1:]:
+            expression = {'$ifNull': [timestamp(stage), expression]}
+        return expression
+
+    def duration(end, start):
+        # missing fields are less than null, so both stages must have been recorded
+        return {'$cond': [{'$and': [{'$gt': [end, None]}, {'$gt': [start, None]}]},
+                          {'$subtract': [end, start]},
+                          None]}
+
+    durations = {stage: duration(timestamp(stage), first_recorded(JOB_STAGES[:i]))
+                 for i, stage in enumerate(JOB_STAGES) if i > 0}
+    durations['total'] = duration(first_recorded(JOB_STAGES), timestamp(JOB_STAGES[0]))
+
+    percentiles = {}
+    for fraction in fractions:
+        rank = {'$toInt': {'$subtract': [{'$ceil': {'$multiply': [fraction, '$count']}}, 1]}}
+        percentiles['p{}'.format(int(fraction * 100))] = {'$arrayElemAt': ['$seconds', rank]}
+
+    return [
+        # ObjectIds start with their creation time so the window is found with the _id index
+        {'$match': {'_id': {'$gte': ObjectId.from_datetime(since)}, 'job_timestamps': {'$exists': True}}},
+        {'$project': {'_id': 0, 'job_type': 1, 'durations': {'$objectToArray': durations}}},
+        {'$unwind': '$durations'},
+        {'$match': {'durations.v': {'$ne': None}}},
+        {'$sort': {'durations.v': 1}},
+        {'$group': {'_id': {'job_type': '$job_type', 'stage': '$durations.k'},
+                    'seconds': {'$push': '$durations.v'},
+                    'count': {'$sum': 1}}},
+        {'$project': dict({'_id': 0, 'job_type': '$_id.job_type', 'stage': '$_id.stage', 'count': 1}, **percentiles)},
+    ]
+
+
+# times of the stages that happen inside the job, see JOB_STAGES. Sent back to the executor with the job's result
+_job_timestamps = {}
+
+
+# record the first time a job reaches a stage
+def record_stage(stage):
+    _job_timestamps.setdefault(stage, time.time())
+
+
+def reset_stages():
+    _job_timestamps.clear()
+
+
+# jobs call this with their result. Under the job queue the result is sent to the executor as a length prefixed
+# pickle on the file descriptor in RESULT_FD_ENV (so Decimal and ObjectId survive), when run by hand it is printed
+def return_result(value=None):
+    if not value:
+        return
+    if _job_timestamps and isinstance(value, dict):
+        value = dict(value, job_timestamps=dict(_job_timestamps))
+    if _result_callback:
+        _result_callback(value)
+    elif os.environ.get(RESULT_FD_ENV):
+        write_result_frame(int(os.environ[RESULT_FD_ENV]), value)
+    else:
         sys.stdout.flush()
-        sys.stdout.write(json.dumps(value))
+        sys.stdout.write(json.dumps(value, default=str))
+
+
+def write_result_frame(fd, value):
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    frame = memoryview(RESULT_FRAME_HEADER.pack(len(payload)) + payload)
+    while frame:
+        written = os.write(fd, frame)
+        frame = frame[written:]
+
+
+def read_result_frames(data):
+    results = []
+    offset = 0
+    while offset < len(data):
+        if offset + RESULT_FRAME_HEADER.size > len(data):
+            raise JobqueueError('Truncated result frame header')
+        (length,) = RESULT_FRAME_HEADER.unpack_from(data, offset)
+        offset += RESULT_FRAME_HEADER.size
+        if offset + length > len(data):
+            raise JobqueueError('Truncated result frame: expected {} bytes got {}'.format(length, len(data) - offset))
+        results.append(pickle.loads(data[offset:offset + length]))
+        offset += length
+    return results
+
+
+# mongo cannot store Decimal, convert any in a job result to Decimal128
+def bson_compatible(value):
+    if isinstance(value, Decimal):
+        return Decimal128(value)
+    if isinstance(value, dict):
+        return {key: bson_compatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [bson_compatible(item) for item in value]
+    return value
+
+
+class JobqueueError(Exception):
+    pass
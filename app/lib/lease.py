@@ -0,0 +1,68 @@
+import time
+from pymongo import ReturnDocument
+from app.settings import JOB_LEASE_DURATION, RECLAIM_JOB_TYPES
+from app.lib.jobqueue import STATUS_CREATING, STATUS_RUNNING, STATUS_FAILED
+
+# Several job queue executors (nodes) can share one jobs collection. A node claims a job by moving it from CREATING to
+# RUNNING and writing itself as the job_owner with a lease that it renews while the job runs. Jobs whose lease has
+# expired belonged to a node that died and are reclaimed by any other node.
+#
+# Leases must be much longer than the heartbeat that renews them (JOB_HEARTBEAT_INTERVAL): a node that cannot renew
+# its leases in time may have its jobs reclaimed while it is still running them.
+
+
+# returns the claimed job, or None if another node claimed it first
+def claim(collection, _id, owner, fields=None, unset=None, lease_duration=None):
+    fields = dict(fields or {})
+    fields.update({'job_status': STATUS_RUNNING,
+                   'job_owner': owner,
+                   'job_lease_expires': time.time() + (lease_duration or JOB_LEASE_DURATION)})
+    update = {'$set': fields}
+    if unset:
+        update['$unset'] = {field: '' for field in unset}
+    return collection.find_one_and_update({'_id': _id, 'job_status': STATUS_CREATING}, update,
+                                          return_document=ReturnDocument.AFTER)
+
+
+# extend the leases of all jobs the node is running, returns the number renewed
+def renew(collection, owner, lease_duration=None):
+    result = collection.update_many({'job_owner': owner, 'job_status': STATUS_RUNNING},
+                                    {'$set': {'job_lease_expires': time.time() + (lease_duration or JOB_LEASE_DURATION)}})
+    return result.modified_count
+
+
+# finish a job only if the node still holds it, returns False if it was reclaimed in the meantime
+def release(collection, _id, owner, fields):
+    result = collection.update_one({'_id': _id, 'job_owner': owner, 'job_status': STATUS_RUNNING},
+                                   {'$set': fields, '$unset': {'job_lease_expires': ''}})
+    return result.modified_count == 1
+
+
+# Jobs of RECLAIM_JOB_TYPES whose lease has expired are put back to CREATING to be run again. Other jobs (trades,
+# withdrawals) may have got as far as moving money before their node died so they are failed rather than repeated.
+# Returns the _ids of the jobs reclaimed, for the caller to start again, and the number failed
+def reclaim_expired(collection, reclaim_job_types=None, now=None):
+    now = now or time.time()
+    expired = {'job_status': STATUS_RUNNING, 'job_lease_expires': {'$lt': now}}
+    return give_up(collection, expired, 'Lease expired, the node running the job died', reclaim_job_types)
+
+
+# hands back the jobs a node is still running when it stops, in the same way as reclaim_expired
+def release_owned(collection, owner, reclaim_job_types=None):
+    owned = {'job_status': STATUS_RUNNING, 'job_owner': owner}
+    return give_up(collection, owned, 'The node running the job stopped', reclaim_job_types)
+
+
+def give_up(collection, query, reason, reclaim_job_types=None):
+    reclaim_job_types = reclaim_job_types if reclaim_job_types is not None else RECLAIM_JOB_TYPES
+    reclaim = dict(query, job_type={'$in': reclaim_job_types})
+    _ids = [job['_id'] for job in collection.find(reclaim, {'_id': 1})]
+    if _ids:
+        collection.update_many(dict(reclaim, _id={'$in': _ids}),
+                               {'$set': {'job_status': STATUS_CREATING},
+                                '$unset': {'job_owner': '', 'job_lease_expires': ''}})
+    failed = collection.update_many(dict(query, job_type={'$nin': reclaim_job_types}),
+                                    {'$set': {'job_status': STATUS_FAILED, 'job_error': reason,
+                                              'job_timestamps.finished': time.time()},
+                                     '$unset': {'job_lease_expires': '', 'job_key': ''}})
+    return _ids, failed.modified_count
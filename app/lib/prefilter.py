@@ -0,0 +1,50 @@
+import numpy as np
+
+# Prices are rounded to 8 decimal places so float64 holds them to well within this fraction. Margins are widened by it so
+# that rounding can only let a combination through, never screen out one that the exact path would find profitable
+FLOAT_TOLERANCE = 1e-12
+
+
+# Almost every buy/sell combination of exchanges is unprofitable, yet working one out exactly means Decimal maths and
+# trade validity checks for both exchanges. Before that, every combination of every trade pair is screened at once in
+# float64.
+#
+# Buying on i at ask a_i and selling on j at bid b_j makes v * (b_j * (1 - fee_j) - a_i * (1 + fee_i)) before fiat
+# conversion. The volume traded is at most the volume both exchanges have, and walking further down the books only makes
+# each further unit less profitable, so the margin at the best prices times that volume bounds the profit from above.
+# Combinations whose bound is no more than minimum_profit cannot become arbitrages and are dropped.
+#
+# exchange_lists holds the exchanges of each trade pair with their order books fetched and fiat_rates the fiat rate of
+# each pair's quote currency. volume(best, levels) is the volume an exchange has to trade. Returns the (buy, sell)
+# combinations of each pair that survive, the highest bound first.
+def screen(exchange_lists, fiat_rates, minimum_profit, volume):
+    if not exchange_lists:
+        return []
+    width = max(len(exchanges) for exchanges in exchange_lists)
+    # pairs traded by fewer exchanges are padded with nan, which never compares as profitable
+    asks, bids, ask_volumes, bid_volumes, fees = (np.full((len(exchange_lists), width), np.nan) for _ in range(5))
+    for pair, exchanges in enumerate(exchange_lists):
+        for index, exchange in enumerate(exchanges):
+            if not exchange.lowest_ask or not exchange.highest_bid:
+                continue
+            asks[pair, index] = float(exchange.lowest_ask['price'])
+            bids[pair, index] = float(exchange.highest_bid['price'])
+            ask_volumes[pair, index] = float(volume(exchange.lowest_ask, exchange.asks))
+            bid_volumes[pair, index] = float(volume(exchange.highest_bid, exchange.bids))
+            fees[pair, index] = float(exchange.fee)
+
+    # axis 1 is the buy exchange and axis 2 the sell exchange
+    cost = asks[:, :, None] * (1 + fees[:, :, None])
+    revenue = bids[:, None, :] * (1 - fees[:, None, :])
+    margin = revenue - cost + FLOAT_TOLERANCE * (cost + revenue)
+    bound = margin * np.minimum(ask_volumes[:, :, None], bid_volumes[:, None, :]) * \
+        np.asarray(fiat_rates, dtype=np.float64)[:, None, None]
+    # an exchange is never arbitraged against itself
+    bound[:, np.arange(width), np.arange(width)] = np.nan
+    with np.errstate(invalid='ignore'):
+        survivors = (margin > 0) & (bound > float(minimum_profit))
+
+    candidates = [[] for _ in exchange_lists]
+    for pair, buy, sell in sorted(zip(*np.nonzero(survivors)), key=lambda x: (x[0], -bound[x])):
+        candidates[pair].append((exchange_lists[pair][buy], exchange_lists[pair][sell]))
+    return candidates
@@ -0,0 +1,86 @@
+import bisect
+import datetime
+import glob
+import json
+import os
+import time
+from decimal import Decimal
+from app.settings import ORDER_BOOK_RECORD_DIRECTORY
+
+# Order books fetched by compares can be recorded so that they can be played back later without the exchanges, see
+# app.replay and app.tools.replay. Each order book is one JSON line holding the time it was fetched, the market it was
+# fetched for and its asks and bids as [price, volume] strings so that they are read back as the same Decimals. Lines are
+# only ever appended, each with a single write, so every job process can record to the same file of the day.
+
+# the attributes set from markets.json by exchange.set_trade_pair, written with each order book so that a recording can
+# be replayed without the markets.json it was recorded with
+MARKET_ATTRIBUTES = {'trading_code': 'trade_pair', 'decimal_places': 'decimal_places', 'fee': 'fee',
+                     'min_trade_size': 'min_trade_size', 'min_trade_size_currency': 'min_trade_size_currency',
+                     'base_currency': 'base_currency', 'quote_currency': 'quote_currency',
+                     'min_notional': 'min_notional'}
+
+
+# records the order book that exchange has just fetched if ORDER_BOOK_RECORD_DIRECTORY is set. Order books that are
+# being replayed are not recorded again
+def record_order_book(exchange, directory=None):
+    directory = directory or ORDER_BOOK_RECORD_DIRECTORY
+    if not directory or exchange.asks is None or exchange.bids is None or getattr(exchange, 'replayed', False):
+        return
+    market = {key: getattr(exchange, attribute) for key, attribute in MARKET_ATTRIBUTES.items()}
+    line = json.dumps({'time': time.time(), 'exchange': exchange.name, 'trade_pair': exchange.trade_pair_common,
+                       'market': market,
+                       'asks': [[str(level['price']), str(level['volume'])] for level in exchange.asks],
+                       'bids': [[str(level['price']), str(level['volume'])] for level in exchange.bids]},
+                      separators=(',', ':'), default=str)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'order_books_{}.jsonl'.format(datetime.datetime.utcnow().strftime('%Y%m%d')))
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def levels(recorded):
+    return [{'price': Decimal(price), 'volume': Decimal(volume)} for price, volume in recorded]
+
+
+# The order books of one or more recording files, or directories of them. book() returns an exchange's order book for a
+# trade pair as it was at a point in the recording, i.e. the last one fetched at or before that time
+class Recording:
+
+    def __init__(self, paths):
+        self.books = {}
+        self.markets = {}
+        records = []
+        for path in paths:
+            files = sorted(glob.glob(os.path.join(path, '*.jsonl'))) if os.path.isdir(path) else [path]
+            for file in files:
+                with open(file) as f:
+                    # the last line may be cut short if the recording was copied while a job was writing it
+                    records += [json.loads(line) for line in f if line.endswith('\n')]
+        records.sort(key=lambda x: x['time'])
+        for record in records:
+            self.books.setdefault((record['exchange'], record['trade_pair']), []).append(
+                (record['time'], levels(record['asks']), levels(record['bids'])))
+            self.markets.setdefault(record['exchange'], {})[record['trade_pair']] = record['market']
+        self.book_times = {key: [book[0] for book in books] for key, books in self.books.items()}
+
+    def trade_pairs(self):
+        return sorted({trade_pair for exchange, trade_pair in self.books})
+
+    def exchanges(self):
+        return sorted(self.markets)
+
+    # the times at which any exchange fetched the trade pair's order book, or any order book if trade_pair is None
+    def times(self, trade_pair=None):
+        return sorted({book[0] for (exchange, pair), books in self.books.items() for book in books
+                       if trade_pair is None or pair == trade_pair})
+
+    # (asks, bids) or None if the exchange had not fetched the order book by then
+    def book(self, exchange, trade_pair, at):
+        books = self.books.get((exchange, trade_pair), [])
+        index = bisect.bisect_right(self.book_times.get((exchange, trade_pair), []), at)
+        if not index:
+            return None
+        return books[index - 1][1], books[index - 1][2]
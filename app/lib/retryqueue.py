@@ -0,0 +1,72 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from app.settings import RETRY_MAX_DELAY, RETRY_JITTER
+
+
+# Calls callback(_id) for every scheduled job once its time has come. Pending retries are kept in a heap ordered by
+# run_at and a single thread sleeps until the earliest one is due, however many retries are waiting.
+class RetryQueue:
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        # breaks ties between jobs due at the same time, ObjectIds are not compared
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    # run_at is a time.time() so that it can be stored on the job and survive a restart
+    def schedule(self, _id, run_at):
+        with self.condition:
+            heapq.heappush(self.heap, (run_at, next(self.counter), _id))
+            # the new job may be due before the one being waited for
+            self.condition.notify()
+
+    def take_due(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                return heapq.heappop(self.heap)[2]
+        return None
+
+    def run(self):
+        while True:
+            _id = self.take_due()
+            if _id is None:
+                return
+            try:
+                self.callback(_id)
+            except Exception as e:
+                # one bad job must not stop the retries of the others
+                logging.error('Error retrying job {}: {}'.format(_id, e))
+
+
+# exponential backoff from base_delay, with jitter so that jobs that failed together are not all retried together
+def retry_delay(attempt, base_delay, max_delay=None, jitter=None):
+    max_delay = max_delay or RETRY_MAX_DELAY
+    jitter = jitter if jitter is not None else RETRY_JITTER
+    delay = min(base_delay * 2 ** (attempt - 1), max_delay)
+    return delay * random.uniform(1 - jitter, 1 + jitter)
@@ -0,0 +1,147 @@
+import threading
+import logging
+import time
+from collections import deque, Counter
+from app.settings import JOB_PRIORITY_ORDER, MAX_RUNNING_JOBS, MAX_RUNNING_JOBS_PER_TYPE, \
+    MAX_RUNNING_JOBS_PER_EXCHANGE, SCHEDULER_SATURATION, COMPARE_FRESHNESS_DEADLINE
+
+# jobs that are only worth running while the prices they fetch are fresh
+COMPARE_JOB_TYPES = ['COMPARE', 'COMPARE_BATCH']
+
+
+# Decides when jobs start. Waiting jobs are kept in one queue per job type and started in priority order
+# (JOB_PRIORITY_ORDER) whenever the total number of running jobs, and the running jobs of their job type and exchange,
+# are below their limits. When too many jobs are waiting, new COMPARE jobs are coalesced with a waiting COMPARE for the
+# same trade pair or shed, and COMPARE jobs (of COMPARE_JOB_TYPES) that have waited longer than the freshness deadline
+# are cancelled.
+#
+# launch(job) is called to start a job and returns False if the job could not be started (e.g. it was claimed by
+# someone else). cancel(job, reason) is called for jobs that are coalesced or shed. Both are called without the
+# scheduler's lock held so they are free to talk to the database.
+class JobScheduler:
+
+    def __init__(self, launch, cancel, priority_order=None, type_limits=None, exchange_limit=None, saturation=None,
+                 max_running=None, freshness_deadline=None):
+        self.launch = launch
+        self.cancel = cancel
+        self.priority_order = priority_order or JOB_PRIORITY_ORDER
+        self.max_running = max_running if max_running is not None else MAX_RUNNING_JOBS
+        self.freshness_deadline = freshness_deadline if freshness_deadline is not None else COMPARE_FRESHNESS_DEADLINE
+        self.type_limits = type_limits if type_limits is not None else MAX_RUNNING_JOBS_PER_TYPE
+        self.exchange_limit = exchange_limit if exchange_limit is not None else MAX_RUNNING_JOBS_PER_EXCHANGE
+        self.saturation = saturation if saturation is not None else SCHEDULER_SATURATION
+        self.queues = {job_type: deque() for job_type in self.priority_order}
+        self.queued = {}
+        self.running = {}
+        self.running_per_type = Counter()
+        self.running_per_exchange = Counter()
+        self.lock = threading.Lock()
+
+    def is_known(self, _id):
+        return _id in self.queued or _id in self.running
+
+    def queue_depth(self):
+        return len(self.queued)
+
+    def submit(self, job):
+        self.submit_many([job])
+
+    # jobs submitted together are all queued before any of them is started
+    def submit_many(self, jobs):
+        cancelled = []
+        with self.lock:
+            for job in jobs:
+                if self.is_known(job['_id']):
+                    continue
+                if job['job_type'] == 'COMPARE' and len(self.queued) >= self.saturation:
+                    waiting = self.find_waiting_compare(job)
+                    if waiting:
+                        # keep the older job's place in the queue but compare with the newer job
+                        logging.debug('Coalescing COMPARE {} into {}'.format(waiting['_id'], job['_id']))
+                        self.replace(waiting, job)
+                        cancelled.append((waiting, 'Coalesced with {}'.format(job['_id'])))
+                    else:
+                        cancelled.append((job, 'Shed as {} jobs are waiting'.format(len(self.queued))))
+                else:
+                    self.queues.setdefault(job['job_type'], deque()).append(job)
+                    self.queued[job['_id']] = job
+
+        for cancelled_job, reason in cancelled:
+            self.cancel(cancelled_job, reason)
+
+        self.dispatch()
+
+    # called when a running job has finished
+    def release(self, job):
+        with self.lock:
+            self.mark_finished(job)
+        self.dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            expired = self.take_expired()
+            startable = self.take_startable()
+
+        for job in expired:
+            self.cancel(job, 'Waited longer than {}s to start'.format(self.freshness_deadline))
+
+        for job in startable:
+            if not self.launch(job):
+                with self.lock:
+                    self.mark_finished(job)
+
+    # the prices a COMPARE would fetch are only worth having while they are fresh
+    def take_expired(self, now=None):
+        now = now or time.time()
+        expired = [job for job_type in COMPARE_JOB_TYPES for job in self.queues.get(job_type, [])
+                   if now - job.get('job_timestamps', {}).get('enqueued', now) > self.freshness_deadline]
+        for job in expired:
+            self.queues[job['job_type']].remove(job)
+            del self.queued[job['_id']]
+        return expired
+
+    def take_startable(self):
+        startable = []
+        for job_type, queue in self.queues.items():
+            limit = self.type_limits.get(job_type)
+            for job in list(queue):
+                if len(self.running) >= self.max_running:
+                    return startable
+                if limit is not None and self.running_per_type[job_type] >= limit:
+                    break
+                exchange = job['job_args'].get('exchange')
+                if exchange and self.running_per_exchange[exchange] >= self.exchange_limit:
+                    continue
+                queue.remove(job)
+                del self.queued[job['_id']]
+                self.mark_running(job)
+                startable.append(job)
+        return startable
+
+    def mark_running(self, job):
+        self.running[job['_id']] = job
+        self.running_per_type[job['job_type']] += 1
+        exchange = job['job_args'].get('exchange')
+        if exchange:
+            self.running_per_exchange[exchange] += 1
+
+    def mark_finished(self, job):
+        if self.running.pop(job['_id'], None) is None:
+            return
+        self.running_per_type[job['job_type']] -= 1
+        exchange = job['job_args'].get('exchange')
+        if exchange:
+            self.running_per_exchange[exchange] -= 1
+
+    def find_waiting_compare(self, job):
+        for waiting in self.queues.get('COMPARE', []):
+            if waiting['job_args'].get('curr_x') == job['job_args'].get('curr_x') and \
+                    waiting['job_args'].get('curr_y') == job['job_args'].get('curr_y'):
+                return waiting
+        return None
+
+    def replace(self, waiting, job):
+        queue = self.queues[waiting['job_type']]
+        queue[queue.index(waiting)] = job
+        del self.queued[waiting['_id']]
+        self.queued[job['_id']] = job
@@ -1,9 +1,11 @@
 import json
 import os
-from app.settings import DB_HOST, DB_NAME_JOBQUEUE, DB_PORT_JOBQUEUE, EXCHANGES, TRADE_PAIRS, MASTER_EXCHANGE
-from pymongo import MongoClient, version_tuple as pymongo_version_tuple
+from app.settings import DB_HOST, DB_NAME_JOBQUEUE, DB_NAME_COMMON, DB_PORT_JOBQUEUE, EXCHANGES, TRADE_PAIRS, \
+    MASTER_EXCHANGE
+from pymongo import MongoClient, ASCENDING, DESCENDING, version_tuple as pymongo_version_tuple
 from pymongo.errors import CollectionInvalid
 from app.lib.jobqueue import JOB_COLLECTION
+from app.lib.archive import JOB_COUNTERS_COLLECTION
 from app.lib.common import dynamically_import_exchange
 from app.lib.coingecko import get_coingecko_meta, get_current_fiat_rates
 from app.lib.db import store_fiat_rates
@@ -22,6 +24,18 @@ def setup_database():
         db.create_collection(JOB_COLLECTION)
     except CollectionInvalid:
         pass
+    # the job dispatcher looks up CREATING jobs by status
+    db[JOB_COLLECTION].create_index([('job_status', ASCENDING)])
+    # only one waiting or running job per job_key, the key is removed when a job finishes
+    db[JOB_COLLECTION].create_index([('job_key', ASCENDING)], unique=True,
+                                    partialFilterExpression={'job_key': {'$exists': True}})
+    # recent successful REPLENISH jobs are looked up by exchange and currency on every compare
+    db[JOB_COLLECTION].create_index([('job_type', ASCENDING), ('job_args.exchange', ASCENDING),
+                                     ('job_args.currency', ASCENDING), ('_id', ASCENDING)])
+    db[JOB_COUNTERS_COLLECTION].create_index([('date', ASCENDING), ('job_type', ASCENDING), ('job_status', ASCENDING)],
+                                             unique=True)
+    # the latest fiat rates are read by every compare
+    dbclient[DB_NAME_COMMON].fiat_rates.create_index([('datetime', DESCENDING)])
     # list database names does not exist in pymongo3.4, which we're using on raspberry pi
     if pymongo_version_tuple[0] <= 3 and pymongo_version_tuple[1] < 6:
         assert (DB_NAME_JOBQUEUE in dbclient.database_names())
@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from app.settings import LOGLEVEL, TRADE_PAIRS, EXCHANGES, EXECUTOR_MODE, EXECUTOR_SHARDS, SHARD_PIN_CPUS, \
+    SHARD_MAX_RESTARTS, SHARD_MONITOR_INTERVAL
+
+# Compares are CPU bound (Decimal maths, JSON parsing, log formatting) so one executor process cannot make use of more
+# than one core. The executor can instead be split into shards: one process per core, each with its own share of the
+# trade pairs and exchanges and its own timers, database connections and caches.
+#
+# A shard adds COMPARE jobs for its own trade pairs and runs the jobs that belong to it: COMPAREs of its trade pairs and
+# jobs naming one of its exchanges (TRANSACT, REPLENISH, WITHDRAWAL_FEE). Jobs are handed between shards through the
+# jobs collection, so sharding needs JOB_DISPATCH_MODE 'changestream'.
+
+
+# deals items out to the shards in turn, e.g. 6 trade pairs over 4 shards are split 2, 2, 1, 1
+def partition(items, shard_count):
+    return [list(items[shard::shard_count]) for shard in range(shard_count)]
+
+
+# the entry point of every shard process: pins the process to its core then runs the shard's target
+def shard_main(target, cpu, *args):
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        # jobs started by the shard inherit its core
+        os.sched_setaffinity(0, {cpu})
+    # shards are spawned rather than forked so logging starts again from nothing
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+    target(*args)
+
+
+# runs one job queue executor for a share of the trade pairs and exchanges until the job queue is stopped (exit code 0)
+# or the coordinator terminates it
+def run_shard(shard, trade_pairs, exchanges):
+    # imported here so that the coordinator process never connects to the database itself
+    from app.execute import JobQueueExecutor
+    from app.execute_async import AsyncJobQueueExecutor
+
+    logging.info('Shard {} running trade pairs {} exchanges {}'.format(shard, trade_pairs, exchanges))
+    if EXECUTOR_MODE == 'asyncio':
+        # stops on SIGTERM as well as when the job queue is stopped
+        AsyncJobQueueExecutor(trade_pairs, exchanges).run()
+        return
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopped.set())
+    executor = JobQueueExecutor(trade_pairs, exchanges)
+    executor.execute()
+    while not stopped.wait(SHARD_MONITOR_INTERVAL):
+        executor.is_running()
+        if not executor.running:
+            break
+    executor.stop_jobqueue()
+
+
+class Shard:
+
+    def __init__(self, index, trade_pairs, exchanges):
+        self.index = index
+        self.trade_pairs = trade_pairs
+        self.exchanges = exchanges
+        self.process = None
+        self.restarts = 0
+
+
+# Starts the shards and watches over them. A shard that dies is restarted with the same trade pairs and exchanges, up to
+# SHARD_MAX_RESTARTS times. After that it is given up and its trade pairs and exchanges are dealt out to the remaining
+# shards, which are restarted to take them on. Jobs the dead shard was running are reclaimed by the other shards once
+# their lease runs out, see app.lib.lease.
+#
+# target(shard, trade_pairs, exchanges, *args) is run in every shard process, run_shard unless benchmarking.
+class ShardCoordinator:
+
+    def __init__(self, shard_count=None, trade_pairs=None, exchanges=None, pin_cpus=None, max_restarts=None,
+                 target=None, args=()):
+        shard_count = shard_count or EXECUTOR_SHARDS
+        trade_pairs = trade_pairs if trade_pairs is not None else TRADE_PAIRS
+        exchanges = exchanges if exchanges is not None else EXCHANGES
+        # a shard with nothing to compare would only be an extra process
+        shard_count = max(1, min(shard_count, len(trade_pairs)))
+        self.pin_cpus = pin_cpus if pin_cpus is not None else SHARD_PIN_CPUS
+        self.max_restarts = max_restarts if max_restarts is not None else SHARD_MAX_RESTARTS
+        self.target = target or run_shard
+        self.args = args
+        self.context = multiprocessing.get_context('spawn')
+        self.shards = [Shard(index, shard_trade_pairs, shard_exchanges) for index, (shard_trade_pairs, shard_exchanges)
+                       in enumerate(zip(partition(trade_pairs, shard_count), partition(exchanges, shard_count)))]
+        self.stopped = threading.Event()
+
+    def start(self):
+        for shard in self.shards:
+            self.spawn(shard)
+
+    def spawn(self, shard):
+        cpu = shard.index % os.cpu_count() if self.pin_cpus else None
+        shard.process = self.context.Process(target=shard_main, name='shard-{}'.format(shard.index),
+                                             args=(self.target, cpu, shard.index, shard.trade_pairs, shard.exchanges)
+                                             + tuple(self.args))
+        shard.process.start()
+
+    # runs until the job queue is stopped or the coordinator is interrupted
+    def run(self):
+        signal.signal(signal.SIGINT, lambda sig, frame: self.stopped.set())
+        signal.signal(signal.SIGTERM, lambda sig, frame: self.stopped.set())
+        self.start()
+        while not self.stopped.wait(SHARD_MONITOR_INTERVAL):
+            self.check()
+        self.stop()
+
+    def check(self):
+        for shard in list(self.shards):
+            if shard.process.is_alive():
+                continue
+            if shard.process.exitcode == 0:
+                # the job queue has been stopped, the other shards are stopping too
+                logging.info('Shard {} stopped'.format(shard.index))
+                self.stopped.set()
+                return
+            if shard.restarts < self.max_restarts:
+                shard.restarts += 1
+                logging.warning('Shard {} died with exit code {}, restarting ({}/{})'.format(
+                    shard.index, shard.process.exitcode, shard.restarts, self.max_restarts))
+                self.spawn(shard)
+            else:
+                self.rebalance(shard)
+
+    def rebalance(self, dead):
+        self.shards.remove(dead)
+        if not self.shards:
+            logging.error('Shard {} died and there are no shards left to take over'.format(dead.index))
+            self.stopped.set()
+            return
+        logging.warning('Giving up on shard {}, moving {} and {} to the other shards'.format(
+            dead.index, dead.trade_pairs, dead.exchanges))
+        for shard, trade_pairs, exchanges in zip(self.shards, partition(dead.trade_pairs, len(self.shards)),
+                                                 partition(dead.exchanges, len(self.shards))):
+            if not trade_pairs and not exchanges:
+                continue
+            shard.trade_pairs += trade_pairs
+            shard.exchanges += exchanges
+            self.stop_shard(shard)
+            self.spawn(shard)
+
+    def stop_shard(self, shard):
+        shard.process.terminate()
+        shard.process.join()
+
+    def stop(self):
+        for shard in self.shards:
+            if shard.process.is_alive():
+                shard.process.terminate()
+        self.join()
+
+    def join(self):
+        for shard in self.shards:
+            shard.process.join()
@@ -0,0 +1,85 @@
+import fcntl
+import json
+import os
+import tempfile
+import time
+from app.settings import SNAPSHOT_MAX_AGE, SNAPSHOT_DIRECTORY
+
+
+# Some exchanges return every market from one request, e.g. Poloniex's returnOrderBook. Every COMPARE and MULTI job
+# against such an exchange would download the whole exchange to use one market of it. A snapshot keeps the last payload
+# on disk, shared by every job process, and fetches it again at most once every SNAPSHOT_MAX_AGE seconds.
+#
+# Only one process fetches at a time: the others wait on the lock and then read what it fetched. Each market is stored
+# on its own line with an index of where the lines start, so a job only parses the markets it asks for.
+class MarketSnapshot:
+
+    def __init__(self, name, max_age=None, directory=None):
+        self.max_age = max_age if max_age is not None else SNAPSHOT_MAX_AGE
+        directory = directory or SNAPSHOT_DIRECTORY or os.path.join(tempfile.gettempdir(), 'arb_snapshots')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, '{}.snapshot'.format(name))
+        self.lock_path = '{}.lock'.format(self.path)
+        # markets already parsed by this process, by the time the snapshot was fetched
+        self.parsed = {}
+
+    # Returns the market from a fresh snapshot, or None if the exchange did not return it. fetch() is called to get the
+    # payload, a dict of market => data, when the snapshot is missing or stale
+    def get(self, market, fetch):
+        header = self.read_header()
+        if not self.is_fresh(header):
+            with open(self.lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # someone else may have fetched while we were waiting for the lock
+                    header = self.read_header()
+                    if not self.is_fresh(header):
+                        header = self.write(fetch())
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return self.read_market(market)
+
+    def is_fresh(self, header):
+        return header is not None and time.time() - header['fetched_at'] < self.max_age
+
+    def read_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.loads(f.readline())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def read_market(self, market):
+        with open(self.path, 'rb') as f:
+            # the header is read again from the file the market is read from as the snapshot may have been replaced
+            header = json.loads(f.readline())
+            key = (header['fetched_at'], market)
+            if key not in self.parsed:
+                position = header['index'].get(market)
+                if position is None:
+                    return None
+                # offsets are from the end of the header line
+                f.seek(position[0], os.SEEK_CUR)
+                self.parsed = {k: v for k, v in self.parsed.items() if k[0] == header['fetched_at']}
+                self.parsed[key] = json.loads(f.read(position[1]))
+        return self.parsed[key]
+
+    # the header line holds the index: the offset and length of every market's line after it
+    def write(self, payload):
+        lines = []
+        index = {}
+        offset = 0
+        for market, data in payload.items():
+            line = json.dumps(data).encode() + b'\n'
+            index[market] = [offset, len(line)]
+            offset += len(line)
+            lines.append(line)
+        header = {'fetched_at': time.time(), 'index': index}
+
+        # readers either see the old snapshot or the new one, never half of one
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(handle, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.writelines(lines)
+        os.replace(temp_path, self.path)
+        return header
@@ -0,0 +1,149 @@
+import multiprocessing
+import queue
+import logging
+import traceback
+from decimal import Decimal
+from app.settings import LOGLEVEL, WORKER_POOL_SIZE, WORKER_POOL_MAX_JOBS
+from app.lib.jobqueue import set_result_callback, reset_stages, record_stage
+from app.lib.setup import load_currency_pairs
+from app.lib.db import WRITER
+from app.jobs import compare, compare_batch, replenish, transact, withdrawal_fee
+
+# how long to wait for a worker to exit cleanly before it is terminated
+WORKER_STOP_TIMEOUT = 5
+
+
+# Long lived worker processes that run jobs in place of `python3 -m app.jobs.x`. Each worker pays for interpreter start
+# up, imports and reading markets.json once and then runs jobs sent down its pipe until it is recycled.
+class WorkerPool:
+
+    def __init__(self, size=None, max_jobs=None):
+        # spawn rather than fork: the executor is threaded and holds mongo clients, neither of which survive a fork
+        self.context = multiprocessing.get_context('spawn')
+        self.size = size or WORKER_POOL_SIZE
+        self.max_jobs = max_jobs or WORKER_POOL_MAX_JOBS
+        self.idle = queue.Queue()
+        for _ in range(self.size):
+            self.idle.put(PoolWorker(self.context))
+
+    # blocks until a worker is free. Returns (success, result) where result is the job's return value on success and
+    # the error on failure, mirroring the retcode/stdout/stderr handling in Jobqueue.run_command
+    def run(self, job_type, job_args, worker_assigned=None):
+        worker = self.idle.get()
+        try:
+            if worker_assigned:
+                worker_assigned(worker.pid)
+            result = worker.run(job_type, job_args)
+        except WorkerCrashedError as e:
+            # replace the dead worker so that the pool stays at full strength
+            worker.stop()
+            worker = PoolWorker(self.context)
+            result = (False, str(e))
+        finally:
+            if worker.jobs_run >= self.max_jobs:
+                logging.debug('Recycling worker {} after {} jobs'.format(worker.pid, worker.jobs_run))
+                worker.stop()
+                worker = PoolWorker(self.context)
+            self.idle.put(worker)
+        return result
+
+    def stop(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.stop()
+
+
+class PoolWorker:
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        # only the worker should hold its end of the pipe, so that we see EOF if it dies
+        child_connection.close()
+        self.jobs_run = 0
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def run(self, job_type, job_args):
+        self.jobs_run += 1
+        try:
+            self.connection.send((job_type, job_args))
+            return self.connection.recv()
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            raise WorkerCrashedError(
+                'Worker {} exited with code {} whilst running {}'.format(self.pid, self.process.exitcode, job_type))
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+def worker_main(connection):
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+    markets = load_currency_pairs()
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        # None is the signal to shut down
+        if message is None:
+            break
+        job_type, job_args = message
+        try:
+            connection.send((True, run_job(job_type, job_args, markets)))
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+    connection.close()
+
+
+# run a job in this process with the same arguments that its setup() would have parsed from the command line
+def run_job(job_type, job_args, markets):
+    results = []
+    set_result_callback(results.append)
+    reset_stages()
+    # the imports were done when the worker started
+    record_stage('imports_done')
+    try:
+        if job_type == 'COMPARE':
+            compare.compare(job_args['curr_x'], job_args['curr_y'], markets, job_args['jobqueue_id'])
+        elif job_type == 'COMPARE_BATCH':
+            compare_batch.compare_batch(job_args['trade_pairs'].split(','), markets, job_args['jobqueue_id'])
+        elif job_type == 'TRANSACT':
+            transact.transact(job_args['exchange'], job_args['trade_pair_common'],
+                              Decimal(job_args['volume']).normalize(), Decimal(job_args['price']).normalize(),
+                              job_args['type'], markets, job_args['jobqueue_id'])
+        elif job_type == 'REPLENISH':
+            replenish.replenish(job_args['exchange'], job_args['currency'], job_args['jobqueue_id'])
+        elif job_type == 'WITHDRAWAL_FEE':
+            withdrawal_fee.withdrawal_fee(job_args['exchange'], job_args['currency'], job_args['withdrawal_id'],
+                                          job_args['audit_id'], job_args['jobqueue_id'])
+        else:
+            raise WorkerPoolError('Job type {} cannot be run in the worker pool'.format(job_type))
+    finally:
+        set_result_callback(None)
+        # the records a job wrote in the background are in the database by the time it finishes, as they would be if
+        # it had run in its own process
+        WRITER.flush()
+
+    return results[-1] if results else None
+
+
+class WorkerCrashedError(Exception):
+    pass
+
+
+class WorkerPoolError(Exception):
+    pass
@@ -0,0 +1,68 @@
+from app.lib.exchange import exchange, ExchangeError
+
+# the recording that replay wraps read their order books from and the time in it that they read them at, set by
+# app.tools.replay before each compare
+REPLAY = {'recording': None, 'time': None}
+
+
+def play(recording):
+    REPLAY['recording'] = recording
+    REPLAY['time'] = None
+
+
+def seek(time):
+    REPLAY['time'] = time
+
+
+# An exchange that fetches its order books from a recording rather than the exchange, see app.lib.recorder. Each
+# exchange has a wrap in app.replay, imported with dynamically_import_exchange(name, directory='app.replay.wrap').
+# Nothing can be traded and there are no balances
+class replay_exchange(exchange):
+
+    replayed = True
+
+    def __init__(self, name, jobqueue_id):
+        exchange.__init__(self, name=name, jobqueue_id=jobqueue_id)
+
+    def order_book(self):
+        book = REPLAY['recording'].book(self.name, self.trade_pair_common, REPLAY['time'])
+        # compares change the volumes of the best levels so every compare is given its own copy of the recorded levels
+        asks, bids = book if book else ([], [])
+        self.asks = [dict(level) for level in asks]
+        self.bids = [dict(level) for level in bids]
+        self.lowest_ask = self.asks[0] if self.asks else None
+        self.highest_bid = self.bids[0] if self.bids else None
+
+    def get_currency_pairs(self):
+        return REPLAY['recording'].markets.get(self.name, {})
+
+    def trade(self, trade_type, volume, price, trade_id=None):
+        raise ExchangeError('Cannot trade on a replayed exchange')
+
+    def get_order_status(self, order_id):
+        return {}
+
+    def get_order(self, order_id):
+        return {}
+
+    def get_orders(self, order_id):
+        return []
+
+    def format_trade(self, raw_trade, trade_type, trade_id):
+        return {}
+
+    def get_balances(self):
+        self.balances = {}
+
+    # replayed balances are never shared with the jobs of the real exchange
+    def get_cached_balances(self):
+        self.get_balances()
+
+    def get_address(self, symbol):
+        return None
+
+    def calculate_fees(self, trades_itemised, price):
+        return 0
+
+    def get_pending_balances(self):
+        self.pending_balances = {}
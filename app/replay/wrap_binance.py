@@ -0,0 +1,7 @@
+from app.replay.exchange import replay_exchange
+
+
+class binance(replay_exchange):
+
+    def __init__(self, jobqueue_id):
+        replay_exchange.__init__(self, name='binance', jobqueue_id=jobqueue_id)
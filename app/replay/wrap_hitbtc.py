@@ -0,0 +1,7 @@
+from app.replay.exchange import replay_exchange
+
+
+class hitbtc(replay_exchange):
+
+    def __init__(self, jobqueue_id):
+        replay_exchange.__init__(self, name='hitbtc', jobqueue_id=jobqueue_id)
@@ -0,0 +1,7 @@
+from app.replay.exchange import replay_exchange
+
+
+class p2pb2b(replay_exchange):
+
+    def __init__(self, jobqueue_id):
+        replay_exchange.__init__(self, name='p2pb2b', jobqueue_id=jobqueue_id)
@@ -29,9 +29,127 @@ JOBS_NOT_RUNNING = ['TRANSACT', 'REPLENISH']
 
 INTERVAL_COMPARE = int(5)
 INTERVAL_NEWJOBS = int(1)
-INTERVAL_RUNNINGJOBS = int(3)
+# finished jobs are moved out of the jobs collection into a history collection per day once they are this many minutes
+# old. This must be longer than the 30 minutes that get_replenish_jobs looks back for recent REPLENISH jobs
+JOB_ARCHIVE_AGE = int(60)
+# seconds between archiving runs, and the number of jobs moved at a time
+INTERVAL_ARCHIVE = int(60)
+JOB_ARCHIVE_BATCH = int(1000)
+# archived jobs are deleted after this many days, job_counters keeps the number of jobs for good
+JOB_HISTORY_TTL_DAYS = int(30)
+
+# jobs that finish together have their results written in one bulk write of up to this many jobs
+REAP_BATCH_SIZE = int(100)
+# audits and the balance history are written in the background in batches of up to WRITE_BATCH_SIZE records gathered
+# over up to WRITE_BATCH_INTERVAL seconds, see app.lib.db.BufferedWriter. Jobs wait once WRITE_QUEUE_SIZE records are
+# waiting to be written
+WRITE_BATCH_SIZE = int(100)
+WRITE_BATCH_INTERVAL = float(1)
+WRITE_QUEUE_SIZE = int(10000)
 # get a new fiat rate every 10 mins
 INTERVAL_FIAT_RATE = int(600)
 
+# each trade pair is compared between these intervals (seconds), more often when its spread is volatile or arbitrages
+# are found, see app.lib.cadence. INTERVAL_COMPARE is the interval for a pair of average weight
+INTERVAL_COMPARE_MIN = float(1)
+INTERVAL_COMPARE_MAX = float(60)
+# order book requests per minute that all COMPARE jobs together may make
+COMPARE_REQUEST_BUDGET = int(240)
+# requests per minute that may be made against each exchange by all jobs
+EXCHANGE_REQUEST_BUDGETS = {'binance': 600, 'bittrex': 60, 'hitbtc': 300, 'poloniex': 300, 'p2pb2b': 60}
+EXCHANGE_REQUEST_BUDGET_DEFAULT = int(60)
+# number of recent compares of a pair used to judge its volatility and hit rate
+CADENCE_WINDOW = int(20)
+# how much more often a pair that always finds an arbitrage is compared than one with average volatility
+CADENCE_HIT_WEIGHT = float(4)
+# compare every exchange that trades a pair, and is not locked, in one job instead of two exchanges chosen at random
+COMPARE_ALL_EXCHANGES = False
+# find the most profitable volume by walking down the order books instead of only taking the lowest ask and highest bid
+COMPARE_ORDER_BOOK_DEPTH = False
+# compare every trade pair that is due in one COMPARE_BATCH job instead of a COMPARE job for each pair. Pairs are still
+# compared as often as app.lib.cadence decides, checked every INTERVAL_COMPARE_MIN
+COMPARE_BATCH = False
+
+# balances fetched from an exchange are shared by all jobs for this many seconds, see app.lib.db.get_cached_balances.
+# Exchanges that limit how often balances can be requested are given their own time to live
+BALANCE_CACHE_TTL = int(10)
+BALANCE_CACHE_TTLS = {'p2pb2b': 60}
+
+# order books of exchanges that return every market at once are fetched at most once in this many seconds and shared
+# by all jobs, see app.lib.snapshot. Snapshots are kept in SNAPSHOT_DIRECTORY, the system temp directory if None
+SNAPSHOT_MAX_AGE = float(2)
+SNAPSHOT_DIRECTORY = None
+
+# every order book fetched by a compare is appended to a file of the day in this directory so that it can be played back
+# by app.tools.replay, see app.lib.recorder. None records nothing
+ORDER_BOOK_RECORD_DIRECTORY = None
+
+# 'subprocess' runs every job as a fresh `python3 -m app.jobs.x` process
+# 'pool' hands jobs to long lived worker processes that have already imported app.jobs
+JOB_EXECUTION_MODE = 'subprocess'
+WORKER_POOL_SIZE = int(6)
+# workers are replaced after this many jobs so that leaks in the exchange clients cannot build up
+WORKER_POOL_MAX_JOBS = int(200)
+
+# 'observer' only starts jobs that were added by the job queue executor's own process
+# 'changestream' follows the jobs collection so that jobs inserted by any process are started. It is meant for replica
+# sets, on a standalone mongod it falls back to polling the collection every DISPATCH_POLL_INTERVAL
+JOB_DISPATCH_MODE = 'observer'
+# seconds between checks for new jobs when the database does not support change streams (standalone mongod)
+DISPATCH_POLL_INTERVAL = float(1)
+# seconds to wait before following the jobs collection again after losing the database, doubled for every failure in a
+# row up to DISPATCH_RETRY_MAX_DELAY
+DISPATCH_RETRY_DELAY = float(1)
+DISPATCH_RETRY_MAX_DELAY = float(30)
+
+# when several jobs are waiting they are started in this order of job type
+JOB_PRIORITY_ORDER = ['TRANSACT', 'REPLENISH', 'COMPARE', 'COMPARE_BATCH', 'WITHDRAWAL_FEE']
+# maximum number of jobs of each type running at once
+MAX_RUNNING_JOBS_PER_TYPE = {'TRANSACT': 4, 'REPLENISH': 2, 'COMPARE': 6, 'COMPARE_BATCH': 2, 'WITHDRAWAL_FEE': 2}
+# maximum number of jobs running at once against a single exchange (for jobs that name an exchange)
+MAX_RUNNING_JOBS_PER_EXCHANGE = 3
+# number of executor processes (shards) to split TRADE_PAIRS and EXCHANGES between, see app.lib.sharding. 1 runs a
+# single executor. Shards need JOB_DISPATCH_MODE 'changestream'
+EXECUTOR_SHARDS = int(1)
+# pin each shard, and the jobs it starts, to its own CPU core
+SHARD_PIN_CPUS = True
+# a shard that dies is restarted this many times before its trade pairs and exchanges are moved to the other shards
+SHARD_MAX_RESTARTS = int(3)
+# seconds between checks that the shards are alive
+SHARD_MONITOR_INTERVAL = float(1)
+
+# maximum number of jobs running at once, of any type. Bounds the number of job subprocesses and threads
+MAX_RUNNING_JOBS = int(10)
+# once this many jobs are waiting new COMPARE jobs are coalesced with a waiting job for the same pair, or shed
+SCHEDULER_SATURATION = 12
+# the compare intervals stop adding COMPARE jobs once this many jobs are waiting and start again once the queue has
+# drained to COMPARE_RESUME_QUEUE_DEPTH
+COMPARE_PAUSE_QUEUE_DEPTH = int(8)
+COMPARE_RESUME_QUEUE_DEPTH = int(2)
+# waiting COMPARE and COMPARE_BATCH jobs added more than this many seconds ago are cancelled rather than started, prices will have moved
+COMPARE_FRESHNESS_DEADLINE = float(15)
+
+# several job queue executors can share the jobs collection. A job is leased to the executor that claimed it for this
+# many seconds, and the lease is renewed every JOB_HEARTBEAT_INTERVAL. Jobs whose lease runs out are reclaimed
+JOB_LEASE_DURATION = int(30)
+JOB_HEARTBEAT_INTERVAL = int(5)
+# jobs of these types are run again when their executor dies, any other job is failed as it may have moved money
+RECLAIM_JOB_TYPES = ['COMPARE', 'COMPARE_BATCH', 'WITHDRAWAL_FEE']
+
+# jobs of these types are retried when they fail. Jobs of any type are retried when their result asks for a retry
+RETRY_JOB_TYPES = ['REPLENISH', 'WITHDRAWAL_FEE']
+RETRY_MAX_ATTEMPTS = int(5)
+# seconds before the first retry, unless the job asks for a delay. The delay doubles with every attempt up to the max
+RETRY_BASE_DELAY = float(10)
+RETRY_MAX_DELAY = float(600)
+# retry delays are randomly moved by up to this fraction
+RETRY_JITTER = float(0.2)
+
+# 'threads' runs a timer thread per trade pair and a thread per running job
+# 'asyncio' runs all timers and jobs as coroutines on a single event loop
+EXECUTOR_MODE = 'threads'
+# database calls made by the asyncio executor run on a pool of this many threads (pymongo is blocking)
+ASYNC_DB_THREADS = int(8)
+
 MASTER_EXCHANGE = 'bittrex'
 FIAT_REPLENISH_AMOUNT = 1000
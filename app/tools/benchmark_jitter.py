@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from app.settings import LOGLEVEL
+from app.execute import call_repeatedly
+from app.execute_async import repeat
+from app.lib.common import percentile
+
+
+# Every timer records how late each of its calls was. Both call_repeatedly and repeat wait `interval` after the
+# previous call returns, so a call is due `interval` after the previous one finished.
+class Timer:
+
+    def __init__(self, interval, work):
+        self.interval = interval
+        self.work = work
+        self.last = time.monotonic()
+        self.lateness = []
+
+    def tick(self):
+        now = time.monotonic()
+        self.lateness.append(now - self.last - self.interval)
+        # stand in for the work a timer does, e.g. looking for an existing COMPARE job
+        busy_until = now + self.work
+        while time.monotonic() < busy_until:
+            pass
+        self.last = time.monotonic()
+
+
+def measure_threads(pairs, interval, duration, work):
+    timers = [Timer(interval, work) for _ in range(pairs)]
+    cancels = [call_repeatedly(interval, timer.tick) for timer in timers]
+    threads = threading.active_count()
+    time.sleep(duration)
+    for cancel in cancels:
+        cancel()
+    return [late for timer in timers for late in timer.lateness], threads
+
+
+def measure_asyncio(pairs, interval, duration, work):
+    timers = [Timer(interval, work) for _ in range(pairs)]
+
+    async def tick(timer):
+        timer.tick()
+
+    async def main():
+        tasks = [asyncio.create_task(repeat(interval, tick, timer)) for timer in timers]
+        await asyncio.sleep(duration)
+        threads = threading.active_count()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return threads
+
+    threads = asyncio.run(main())
+    return [late for timer in timers for late in timer.lateness], threads
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Compare timer jitter of the threaded and asyncio executors')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[10, 100, 500], help='Numbers of trade pairs')
+    parser.add_argument('--interval', type=float, default=0.5, help='Seconds between calls of each timer')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run each measurement for')
+    parser.add_argument('--work', type=float, default=0.0002, help='Seconds of CPU work done by each call')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    print('{:>8} {:>6} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('mode', 'pairs', 'calls', 'mean ms',
+                                                                       'p50 ms', 'p99 ms', 'max ms', 'threads'))
+    for pairs in args.pairs:
+        for mode, measure in [('threads', measure_threads), ('asyncio', measure_asyncio)]:
+            lateness, threads = measure(pairs, args.interval, args.duration, args.work)
+            if not lateness:
+                print('{:>8} {:>6} no calls made'.format(mode, pairs))
+                continue
+            print('{:>8} {:>6} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>8}'.format(
+                mode, pairs, len(lateness), sum(lateness) / len(lateness) * 1000,
+                percentile(lateness, 0.5) * 1000, percentile(lateness, 0.99) * 1000, max(lateness) * 1000, threads))
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from decimal import Decimal
+from app.settings import LOGLEVEL
+from app.lib.sharding import ShardCoordinator
+
+BENCHMARK_EXCHANGES = ['exchange{}'.format(i) for i in range(4)]
+
+
+def order_book(depth):
+    price = random.uniform(0.01, 0.1)
+    return json.dumps({'asks': [['{:.8f}'.format(price * (1 + i / 1000)), '{:.8f}'.format(random.uniform(0.1, 10))]
+                                for i in range(depth)],
+                       'bids': [['{:.8f}'.format(price * (1 - i / 1000)), '{:.8f}'.format(random.uniform(0.1, 10))]
+                                for i in range(depth)]})
+
+
+# Stands in for the CPU bound part of a COMPARE job: parse every exchange's order book, convert it to Decimal, find the
+# best prices and spread and format the result for the log. The network requests are left out so that the benchmark
+# measures how the CPU work scales with the number of shards
+def compare(books):
+    asks = []
+    bids = []
+    for book in books:
+        parsed = json.loads(book)
+        asks.append(min((Decimal(price), Decimal(volume)) for price, volume in parsed['asks']))
+        bids.append(max((Decimal(price), Decimal(volume)) for price, volume in parsed['bids']))
+    lowest_ask = min(asks)
+    highest_bid = max(bids)
+    spread = (highest_bid[0] - lowest_ask[0]) / lowest_ask[0]
+    return 'Returning {}'.format({'lowest_ask': asks, 'highest_bid': bids, 'spread': spread})
+
+
+# run in every shard process by the coordinator in place of an executor
+def compare_shard(shard, trade_pairs, exchanges, depth, duration, results):
+    books = {trade_pair: [order_book(depth) for _ in BENCHMARK_EXCHANGES] for trade_pair in trade_pairs}
+    compares = 0
+    ends = time.time() + duration
+    while time.time() < ends:
+        for trade_pair in trade_pairs:
+            compare(books[trade_pair])
+            compares += 1
+    results.put(compares)
+
+
+def measure(shards, trade_pairs, depth, duration, pin_cpus):
+    results = multiprocessing.get_context('spawn').Queue()
+    coordinator = ShardCoordinator(shards, trade_pairs, BENCHMARK_EXCHANGES, pin_cpus=pin_cpus, target=compare_shard,
+                                   args=(depth, duration, results))
+    coordinator.start()
+    compares = sum(results.get() for _ in coordinator.shards)
+    coordinator.join()
+    return compares / duration
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Measure compares per second as the executor is split into shards')
+    parser.add_argument('--shards', type=int, default=os.cpu_count(), help='Measure 1 up to this many shards')
+    parser.add_argument('--pairs', type=int, default=48, help='Number of trade pairs')
+    parser.add_argument('--depth', type=int, default=100, help='Orders on each side of every order book')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to measure each shard count for')
+    parser.add_argument('--no-pin', action='store_true', help='Do not pin shards to CPU cores')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    trade_pairs = ['PAIR{}-BTC'.format(i) for i in range(args.pairs)]
+    print('{:>6} {:>14} {:>8}'.format('shards', 'compares/s', 'speedup'))
+    single = None
+    for shards in range(1, args.shards + 1):
+        rate = measure(shards, trade_pairs, args.depth, args.duration, not args.no_pin)
+        single = single or rate
+        print('{:>6} {:>14.1f} {:>8.2f}'.format(shards, rate, rate / single))
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
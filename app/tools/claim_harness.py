@@ -0,0 +1,103 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+from bson import ObjectId
+from app.settings import LOGLEVEL
+from app.lib.db import jobqueue_db
+from app.lib import lease
+from app.lib.jobqueue import STATUS_CREATING, STATUS_RUNNING, STATUS_COMPLETE
+from app.execute import call_repeatedly
+
+# the harness has its own collections so that a running job queue executor never sees its jobs
+HARNESS_COLLECTION = 'jobs_claim_harness'
+HARNESS_EXECUTIONS_COLLECTION = 'jobs_claim_harness_executions'
+HARNESS_JOB_TYPE = 'CLAIM_HARNESS'
+
+
+# One node: claims jobs in the same way as JobQueueExecutor, "runs" them for a while and records every job it finishes
+# while still holding the lease. Keeps going until no job is waiting or running
+def node(node_id, lease_duration, heartbeat, work):
+    db = jobqueue_db()
+    jobs = db[HARNESS_COLLECTION]
+    executions = db[HARNESS_EXECUTIONS_COLLECTION]
+    owner = ObjectId()
+
+    def beat():
+        lease.renew(jobs, owner, lease_duration)
+        lease.reclaim_expired(jobs, [HARNESS_JOB_TYPE])
+
+    stop_heartbeat = call_repeatedly(heartbeat, beat)
+    while jobs.count_documents({'job_status': {'$in': [STATUS_CREATING, STATUS_RUNNING]}}):
+        for job in jobs.find({'job_status': STATUS_CREATING}, {'_id': 1}):
+            if not lease.claim(jobs, job['_id'], owner, lease_duration=lease_duration):
+                continue
+            time.sleep(random.uniform(0, work))
+            if lease.release(jobs, job['_id'], owner, {'job_status': STATUS_COMPLETE}):
+                executions.insert_one({'job_id': job['_id'], 'owner': owner, 'node': node_id})
+        time.sleep(0.01)
+    stop_heartbeat()
+
+
+def run(job_count, node_count, lease_duration, heartbeat, work, kill):
+    db = jobqueue_db()
+    jobs = db[HARNESS_COLLECTION]
+    executions = db[HARNESS_EXECUTIONS_COLLECTION]
+    jobs.drop()
+    executions.drop()
+    jobs.insert_many([{'job_type': HARNESS_JOB_TYPE, 'job_status': STATUS_CREATING} for _ in range(job_count)])
+
+    context = multiprocessing.get_context('spawn')
+    nodes = [context.Process(target=node, args=(i, lease_duration, heartbeat, work)) for i in range(node_count)]
+    started = time.time()
+    for process in nodes:
+        process.start()
+
+    if kill:
+        # kill a node part way through so that its jobs have to be reclaimed by the others
+        while not executions.count_documents({'node': 0}) and nodes[0].is_alive():
+            time.sleep(0.01)
+        logging.info('Killing node 0 (pid {})'.format(nodes[0].pid))
+        os.kill(nodes[0].pid, signal.SIGKILL)
+
+    for process in nodes:
+        process.join()
+    elapsed = time.time() - started
+
+    duplicates = list(executions.aggregate([{'$group': {'_id': '$job_id', 'count': {'$sum': 1}}},
+                                            {'$match': {'count': {'$gt': 1}}}]))
+    executed = len(executions.distinct('job_id'))
+    complete = jobs.count_documents({'job_status': STATUS_COMPLETE})
+    per_node = {x['_id']: x['count'] for x in executions.aggregate([{'$group': {'_id': '$node',
+                                                                                 'count': {'$sum': 1}}}])}
+    jobs.drop()
+    executions.drop()
+
+    print('Jobs: {} Nodes: {} Time: {:.2f}s'.format(job_count, node_count, elapsed))
+    print('Jobs finished per node: {}'.format(per_node))
+    print('Jobs complete: {}/{} executed: {}/{} executed more than once: {}'.format(complete, job_count, executed,
+                                                                                   job_count, len(duplicates)))
+    return not duplicates and executed == job_count and complete == job_count
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Run jobs on several competing nodes and check none ran twice')
+    parser.add_argument('--jobs', type=int, default=500, help='Number of jobs')
+    parser.add_argument('--nodes', type=int, default=4, help='Number of node processes')
+    parser.add_argument('--lease', type=float, default=2, help='Lease duration in seconds')
+    parser.add_argument('--heartbeat', type=float, default=0.2, help='Seconds between lease renewals')
+    parser.add_argument('--work', type=float, default=0.05, help='Maximum seconds each job takes')
+    parser.add_argument('--kill', action='store_true', help='Kill one node part way through')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    ok = run(args.jobs, args.nodes, args.lease, args.heartbeat, args.work, args.kill)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import threading
+import time
+from app.settings import LOGLEVEL
+from app.lib.db import jobqueue_db
+from app.lib.dispatcher import JobDispatcher
+from app.lib.jobqueue import STATUS_CREATING, STATUS_RUNNING
+from app.lib.common import percentile
+
+# probe jobs go in their own collection so that a running job queue executor never sees them
+LATENCY_PROBE_COLLECTION = 'jobs_latency_probe'
+
+
+# measure the time from a job being inserted to it being claimed by the dispatcher, end to end through the database
+def measure(count, interval):
+    collection = jobqueue_db()[LATENCY_PROBE_COLLECTION]
+    collection.drop()
+    latencies = []
+    finished = threading.Event()
+
+    def claim(_id):
+        # claim the probe in the same way JobQueueExecutor.start_job claims a job
+        job = collection.find_one_and_update({'_id': _id, 'job_status': STATUS_CREATING},
+                                             {'$set': {'job_status': STATUS_RUNNING}})
+        if job:
+            latencies.append(time.time() - job['job_timestamps']['enqueued'])
+        if len(latencies) >= count:
+            finished.set()
+
+    dispatcher = JobDispatcher(collection, claim)
+    dispatcher.start()
+    # give the dispatcher time to open its change stream
+    time.sleep(1)
+
+    for _ in range(count):
+        collection.insert_one({'job_type': 'LATENCY_PROBE',
+                               'job_status': STATUS_CREATING,
+                               'job_timestamps': {'enqueued': time.time()}})
+        time.sleep(interval)
+
+    finished.wait(count * interval + 10)
+    dispatcher.stop()
+    collection.drop()
+
+    return dispatcher.mode, latencies
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Measure job dispatch latency from insert to start')
+    parser.add_argument('--count', type=int, default=200, help='Number of probe jobs to insert')
+    parser.add_argument('--interval', type=float, default=0.01, help='Seconds between inserts')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    mode, latencies = measure(args.count, args.interval)
+    print('Dispatch mode: {}'.format(mode))
+    print('Jobs dispatched: {}/{}'.format(len(latencies), args.count))
+    for fraction in [0.5, 0.95, 0.99, 1]:
+        latency = percentile(latencies, fraction)
+        if latency is not None:
+            print('p{}: {:.2f}ms'.format(int(fraction * 100), latency * 1000))
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
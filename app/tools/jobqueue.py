@@ -1,13 +1,27 @@
 import argparse
 from app.execute import JobQueueExecutor
+from app.execute_async import AsyncJobQueueExecutor
+from app.lib.sharding import ShardCoordinator
 from app.lib.db import jobqueue_db
+from app.lib.jobqueue import Jobqueue, JOB_STAGES
 import logging
-from app.settings import LOGLEVEL
+from app.settings import LOGLEVEL, EXECUTOR_MODE, EXECUTOR_SHARDS
 import sys
 import signal
+import datetime
 
 
-def main(action):
+def main(action, minutes=60):
+    if action == 'execute' and EXECUTOR_SHARDS > 1:
+        # one executor process per shard, runs until the job queue is stopped or interrupted
+        ShardCoordinator().run()
+        return
+
+    if action == 'execute' and EXECUTOR_MODE == 'asyncio':
+        # runs until interrupted, the event loop handles SIGINT itself
+        AsyncJobQueueExecutor().run()
+        return
+
     if action == 'execute':
         jobqueue = JobQueueExecutor()
         jobqueue.execute()
@@ -20,9 +34,22 @@ def main(action):
         for job in jobs:
             pprint.pprint(job)
 
+    if action == 'stats':
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+        stats = Jobqueue().stage_stats(since)
+        order = JOB_STAGES + ['total']
+        stats.sort(key=lambda x: (x['job_type'], order.index(x['stage'])))
+        print('{:<16} {:<24} {:>8} {:>10} {:>10} {:>10}'.format('job type', 'stage', 'jobs', 'p50 ms', 'p95 ms',
+                                                               'p99 ms'))
+        for row in stats:
+            print('{:<16} {:<24} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(row['job_type'], row['stage'],
+                                                                            row['count'], row['p50'] * 1000,
+                                                                            row['p95'] * 1000, row['p99'] * 1000))
+
     if action == 'stop':
         jq_db = jobqueue_db()
-        jq_db.status.update({}, {'running': False})
+        # stops every job queue sharing the database
+        jq_db.status.update_many({}, {'$set': {'running': False}})
 
     def signal_handler(sig, frame):
         jobqueue.stop_jobqueue()
@@ -33,13 +60,14 @@ def main(action):
 
 def setup():
     parser = argparse.ArgumentParser(description='Process some currencies.')
-    parser.add_argument('action', type=str, help='What to do with the jobqueue [execute, show, stop]')
+    parser.add_argument('action', type=str, help='What to do with the jobqueue [execute, show, stats, stop]')
+    parser.add_argument('--minutes', type=int, default=60, help='stats: report on jobs added in the last N minutes')
     args = parser.parse_args()
     action = args.action
     logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
-    if action not in ['execute', 'show', 'stop']:
-        raise ValueError('Argument "action" must be one of "execute", "show", or "stop"')
-    main(action)
+    if action not in ['execute', 'show', 'stats', 'stop']:
+        raise ValueError('Argument "action" must be one of "execute", "show", "stats", or "stop"')
+    main(action, args.minutes)
 
 
 setup()
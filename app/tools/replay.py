@@ -0,0 +1,110 @@
+import argparse
+import logging
+import random
+import time
+from decimal import Decimal
+import app.settings as settings
+from app.settings import LOGLEVEL
+from app.lib.recorder import Recording
+from app.lib.jobqueue import set_result_callback
+from app.replay.exchange import play, seek
+from app.jobs import compare as compare_job
+
+REPLAY_DIRECTORY = 'app.replay.wrap'
+REPLAY_JOBQUEUE_ID = '000000000000000000000000'
+REPLAY_DATABASE_PREFIX = 'replay_'
+
+
+# replays write their audits, locks and balances to their own databases so that the real jobs never see them
+def use_replay_databases(prefix):
+    for name in ['DB_NAME_JOBQUEUE', 'DB_NAME_TRADES', 'DB_NAME_AUDIT', 'DB_NAME_COMMON', 'DB_NAME_EXCHANGE']:
+        setattr(settings, name, prefix + getattr(settings, name))
+
+
+# Runs compare() for every trade pair at every time one of its order books was recorded, as fast as it will go. Exchanges
+# are chosen at random as they are by COMPARE jobs so the random seed is set to make replays repeatable
+def replay_compares(recording, trade_pairs, seed):
+    random.seed(seed)
+    results = []
+    set_result_callback(results.append)
+    totals = {'compares': 0, 'combinations': 0, 'screened': 0, 'arbitrages': 0, 'downstream_jobs': 0}
+    started = time.perf_counter()
+    try:
+        for trade_pair in trade_pairs:
+            cur_x, cur_y = trade_pair.split('-')
+            for at in recording.times(trade_pair):
+                seek(at)
+                result = compare_job.compare(cur_x, cur_y, recording.markets, REPLAY_JOBQUEUE_ID, REPLAY_DIRECTORY)
+                totals['compares'] += 1
+                for key in ['combinations', 'screened', 'arbitrages']:
+                    totals[key] += result['market_summary'].get(key, 0)
+                totals['downstream_jobs'] += len(result['downstream_jobs'])
+    finally:
+        set_result_callback(None)
+    totals['seconds'] = time.perf_counter() - started
+    return totals
+
+
+# Runs the multi-exchange trade path search once for every recorded time
+def replay_multi(recording, seed):
+    # imported here as multi imports the binance client, which only --multi needs
+    from app.jobs import multi
+
+    random.seed(seed)
+    totals = {'searches': 0, 'profitable': 0, 'failed': 0}
+    started = time.perf_counter()
+    for at in recording.times():
+        seek(at)
+        totals['searches'] += 1
+        try:
+            profit = multi.process(recording.markets, REPLAY_DIRECTORY)
+        except Exception as e:
+            # the exchanges chosen at random may not have recorded every trade pair in the path
+            logging.debug('Trade path search failed: {}'.format(e))
+            totals['failed'] += 1
+            continue
+        if profit > 0:
+            totals['profitable'] += 1
+    totals['seconds'] = time.perf_counter() - started
+    return totals
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Replay recorded order books through compare() and multi, see '
+                                                 'ORDER_BOOK_RECORD_DIRECTORY')
+    parser.add_argument('recordings', nargs='+', help='Recording files or directories of them')
+    parser.add_argument('--trade-pairs', type=str, help='Comma separated trade pairs, all recorded pairs by default')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for choosing exchanges')
+    parser.add_argument('--fiat-rate', type=str, action='append', default=[],
+                        help='Fix a fiat rate, e.g. BTC=5000, rather than reading the current one')
+    parser.add_argument('--multi', action='store_true', help='Replay the multi-exchange trade path search too')
+    parser.add_argument('--database-prefix', type=str, default=REPLAY_DATABASE_PREFIX,
+                        help='Prefix of the databases the replay writes to')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
+
+    use_replay_databases(args.database_prefix)
+    for fiat_rate in args.fiat_rate:
+        symbol, rate = fiat_rate.split('=')
+        compare_job.FIAT_RATES.pin(symbol, Decimal(rate))
+
+    recording = Recording(args.recordings)
+    play(recording)
+    trade_pairs = args.trade_pairs.split(',') if args.trade_pairs else recording.trade_pairs()
+    logging.info('Replaying {} trade pairs from {} exchanges'.format(len(trade_pairs), len(recording.exchanges())))
+
+    totals = replay_compares(recording, trade_pairs, args.seed)
+    print('{} compares in {:.2f}s, {:.1f} compares/s'.format(totals['compares'], totals['seconds'],
+                                                            totals['compares'] / totals['seconds']
+                                                            if totals['seconds'] else 0))
+    print('{} exchange combinations, {} passed the screen, {} arbitrages, {} downstream jobs'.format(
+        totals['combinations'], totals['screened'], totals['arbitrages'], totals['downstream_jobs']))
+
+    if args.multi:
+        totals = replay_multi(recording, args.seed)
+        print('{} trade path searches in {:.2f}s, {} profitable, {} failed'.format(
+            totals['searches'], totals['seconds'], totals['profitable'], totals['failed']))
+
+
+if __name__ == "__main__":  # pragma: nocoverage
+    setup()
@@ -1,10 +1,10 @@
 from p2pb2bapi import P2PB2B
 from app.settings import P2PB2B_SECRET_KEY, P2PB2B_PUBLIC_KEY
 from decimal import Decimal
-from app.lib.db import store_balances, get_balances, store_api_access_time, get_api_access_time, lock_api_method, \
+from app.lib.db import store_balances, store_api_access_time, get_api_access_time, lock_api_method, \
     unlock_api_method, get_api_method_lock, get_minutely_api_requests, get_secondly_api_requests
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 from app.lib.exchange import exchange
 
@@ -32,7 +32,6 @@ class p2pb2b(exchange):
         self.highest_bid = None
         self.name = 'p2pb2b'
         self.balances = None
-        self.balances_time = None
         self.jobqueue_id = jobqueue_id
         self.minimum_deposit = MINIMUM_DEPOSIT
         exchange.__init__(self, name=self.name, jobqueue_id=jobqueue_id)
@@ -229,18 +228,11 @@ class p2pb2b(exchange):
 
         return trade
 
+    # this api has limits so jobs share the balances for 60s through exchange.get_cached_balances, see
+    # BALANCE_CACHE_TTLS. Once a job has moved funds the cache is invalidated and the balances are fetched again here
     def get_balances(self):
         last_accessed_time = get_api_access_time(self.name, 'get_balances')
-        # this api has limits so we've stored the balances in the database in case of querying too frequently
-        # fingers crossed they are correct !
         logging.debug('Last accessed time {}'.format(last_accessed_time))
-        # if we know when we last accessed balances and that time was less than 60s ago then we get balances from the db
-        if self.balances_time and datetime.utcnow() - self.balances_time < timedelta(
-                seconds=60) or time.time() - last_accessed_time.timestamp() < 60:
-            balances = get_balances(self.name)
-            self.balances = balances
-            logging.debug('p2pb2b balances already retrieved')
-            return
 
         wait_count = 0
         while get_api_method_lock(self.name, 'get_balances', self.jobqueue_id):
@@ -257,8 +249,7 @@ class p2pb2b(exchange):
             if not balances_response.get('success'):
                 raise Exception(balances_response.get('message'))
             unlock_api_method(self.name, 'get_balances', self.jobqueue_id)
-            self.balances_time = datetime.utcnow()
-            store_api_access_time(self.name, 'get_balances', self.balances_time)
+            store_api_access_time(self.name, 'get_balances', datetime.utcnow())
             balances = {symbol: Decimal(balances.get('available')) for symbol, balances in
                         balances_response.get('result').items()}
         except Exception as e:
@@ -4,6 +4,7 @@ import time
 from decimal import Decimal
 from app.lib.common import get_number_of_decimal_places
 from app.lib.exchange import exchange
+from app.lib.snapshot import MarketSnapshot
 from datetime import datetime, timedelta
 import logging
 
@@ -14,6 +15,9 @@ POLONIEX_ERROR_CODES = []
 
 MINIMUM_DEPOSIT = {}
 
+# returnOrderBook gives the order books of every market, shared by all jobs
+ORDER_BOOKS = MarketSnapshot('poloniex_order_books')
+
 
 class poloniex(exchange):
     def __init__(self, jobqueue_id):
@@ -38,8 +42,9 @@ class poloniex(exchange):
         self.api = Poloniex(POLONIEX_PUBLIC_KEY, POLONIEX_SECRET_KEY)
 
     def order_book(self):
-        ticker = self.api.returnOrderBook()
-        order_book_dict = ticker[self.trade_pair]
+        order_book_dict = ORDER_BOOKS.get(self.trade_pair, self.api.returnOrderBook)
+        if order_book_dict is None:
+            raise WrapPoloniexError('No order book for {}'.format(self.trade_pair))
         if order_book_dict.get('error'):
             raise (WrapPoloniexError(order_book_dict.get('error')))
         # ticker contains lowest ask and highest bid. we will only use this info as we currently don't care about other bids
@@ -1,6 +1,7 @@
 from app.jobs.compare import determine_arbitrage_viability, find_arbitrage, calculate_profit_and_volume, \
     check_trade_pair, exchange_selection, CompareError, equalise_buy_and_sell_volumes, set_maximum_trade_volume, \
-    run_exchange_functions_as_threads, get_downstream_jobs, check_zero_balances
+    run_exchange_functions_as_threads, get_downstream_jobs, check_zero_balances, rank_crossings, find_all_arbitrages
+from app.jobs import compare
 from decimal import Decimal
 from pytest import raises
 from testdata.wraps import wrap_exchange1, wrap_exchange2
@@ -217,3 +218,47 @@ def test_check_zero_balances():
     assert replenish_jobs == [{'job_type': 'REPLENISH', 'job_args': {'exchange': 'exchange1', 'currency': 'ADX'}},
                               {'job_type': 'REPLENISH', 'job_args': {'exchange': 'exchange1', 'currency': 'ETH'}},
                               {'job_type': 'REPLENISH', 'job_args': {'exchange': 'exchange2', 'currency': 'ADX'}}]
+
+
+def test_find_all_arbitrages():
+    exchanges = []
+    for wrap in [wrap_exchange1.exchange1, wrap_exchange2.exchange2]:
+        exchange = wrap(JOBQUEUE_ID)
+        exchange.set_trade_pair('ETH-BTC', MARKETS)
+        exchange.order_book()
+        exchanges.append(exchange)
+    assert [(x.name, y.name) for x, y in rank_crossings(exchanges)] == [('exchange2', 'exchange1')]
+    # the arbitrage is worked out on copies so the exchanges keep their order books as they were fetched
+    volume = exchanges[1].lowest_ask['volume']
+    arbitrages = find_all_arbitrages(exchanges, fiat_rate=Decimal(100), fiat_arbitrage_minimum=0)
+    assert [x['buy'].name for x in arbitrages] == ['exchange2']
+    assert arbitrages[0]['buy'] is not exchanges[1]
+    assert exchanges[1].lowest_ask['volume'] == volume
+
+
+def test_find_all_arbitrages_depth(monkeypatch):
+    monkeypatch.setattr(compare, 'COMPARE_ORDER_BOOK_DEPTH', True)
+
+    def book(name, asks, bids):
+        exchange = wrap_exchange1.exchange1(JOBQUEUE_ID)
+        exchange.set_trade_pair('ETH-BTC', MARKETS)
+        exchange.name = name
+        exchange.asks = [{'price': Decimal(price), 'volume': Decimal(volume)} for price, volume in asks]
+        exchange.bids = [{'price': Decimal(price), 'volume': Decimal(volume)} for price, volume in bids]
+        exchange.lowest_ask = exchange.asks[0]
+        exchange.highest_bid = exchange.bids[0]
+        return exchange
+
+    # two exchanges bid above the asks of a third, each for one ETH
+    exchange_buy = book('buy', [('0.030', '1'), ('0.031', '1'), ('0.040', '10')], [('0.020', '10')])
+    exchanges = [exchange_buy,
+                 book('sell1', [('0.050', '10')], [('0.033', '1'), ('0.020', '10')]),
+                 book('sell2', [('0.050', '10')], [('0.032', '1'), ('0.020', '10')])]
+    arbitrages = find_all_arbitrages(exchanges, fiat_rate=Decimal(100), fiat_arbitrage_minimum=0)
+    assert [(x['sell'].name, x['buy'].lowest_ask['volume']) for x in arbitrages] == [('sell1', 1), ('sell2', 1)]
+    # the second arbitrage buys the ask that the first one left rather than the same top level again
+    assert [x['buy'].lowest_ask['price'] for x in arbitrages] == [Decimal('0.030'), Decimal('0.031')]
+    assert arbitrages[1]['buy'].lowest_ask['levels'] == [{'price': Decimal('0.031'), 'volume': 1}]
+    assert arbitrages[1]['profit'] < arbitrages[0]['profit']
+    # the exchange keeps its order book as it was fetched
+    assert exchange_buy.asks[0] == {'price': Decimal('0.030'), 'volume': Decimal('1')}
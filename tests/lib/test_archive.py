@@ -0,0 +1,17 @@
+import datetime
+from bson import ObjectId
+from app.lib.archive import group_by_date, history_collection_name
+
+
+def test_group_by_date():
+    day = datetime.datetime(2019, 1, 31, 23, 59, tzinfo=datetime.timezone.utc)
+    added = ObjectId.from_datetime(day - datetime.timedelta(hours=1))
+
+    def finished(minutes):
+        return {'_id': added, 'job_timestamps': {'finished': (day + datetime.timedelta(minutes=minutes)).timestamp()}}
+
+    # jobs go by the day they finished, or the day they were added if their finish was not recorded
+    jobs = [finished(0), finished(2), {'_id': added}]
+    days = group_by_date(jobs)
+    assert {history_collection_name(date): len(day_jobs) for date, day_jobs in days.items()} == {
+        'jobs_history_20190131': 2, 'jobs_history_20190201': 1}
@@ -0,0 +1,51 @@
+from app.lib.cadence import AdaptiveCadence
+
+
+def cadence(**kwargs):
+    options = dict(trade_pairs=['ETH-BTC', 'GNT-ETH'], base_interval=5, min_interval=1, max_interval=60,
+                   request_budget=1000, exchange_budgets={}, window=10, hit_weight=4,
+                   exchanges=['exchange1', 'exchange2'])
+    options.update(kwargs)
+    return AdaptiveCadence(**options)
+
+
+def test_volatile_pair_compared_more_often():
+    c = cadence()
+    assert c.interval('ETH-BTC') == c.interval('GNT-ETH') == 5
+    for spread in [-0.01, 0.01, -0.02, 0.02]:
+        c.record('ETH-BTC', {'spread': spread, 'arbitrages': 0})
+        c.record('GNT-ETH', {'spread': -0.001, 'arbitrages': 0})
+    assert c.interval('ETH-BTC') < 5 < c.interval('GNT-ETH')
+
+    # finding arbitrages speeds a pair up as well
+    for _ in range(6):
+        c.record('GNT-ETH', {'spread': -0.001, 'arbitrages': 1})
+    assert c.interval('GNT-ETH') < c.interval('ETH-BTC')
+
+
+def test_request_budget():
+    # two pairs on two exchanges every 5s is 48 requests a minute
+    c = cadence(request_budget=24)
+    c.record('ETH-BTC', {'spread': -0.01, 'arbitrages': 0})
+    assert c.interval('ETH-BTC') == c.interval('GNT-ETH') == 10
+
+
+def test_exchange_budget():
+    c = cadence(exchange_budgets={'exchange1': 12}, exchanges=['exchange1'])
+    c.record('ETH-BTC', {'spread': -0.01, 'arbitrages': 0})
+    assert c.interval('ETH-BTC') == 10
+    # requests made by other jobs come out of the exchange's budget
+    for _ in range(6):
+        c.spend('exchange1', now=1000)
+    c.update(now=1000)
+    assert c.interval('ETH-BTC') == 20
+    # and are forgotten after a minute
+    c.update(now=1061)
+    assert c.interval('ETH-BTC') == 10
+
+
+def test_budget_share():
+    # each of two shards may use half of the budget, 24 requests a minute of 48
+    c = cadence(request_budget=48, budget_share=0.5)
+    c.record('ETH-BTC', {'spread': -0.01, 'arbitrages': 0})
+    assert c.interval('ETH-BTC') == c.interval('GNT-ETH') == 10
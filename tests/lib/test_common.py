@@ -1,6 +1,6 @@
 from app.lib.common import get_number_of_decimal_places, get_replenish_quantity, CommonError, \
     get_number_of_places_before_point, round_decimal_number, decimal_as_string, dynamically_import_exchange, \
-    get_longest_trade_path
+    get_longest_trade_path, percentile
 from app.settings import FIAT_REPLENISH_AMOUNT
 from decimal import Decimal
 from pytest import raises
@@ -71,4 +71,13 @@ def test_get_longest_trade_path():
 
     # common denominators are
     # ETH with 3 entries
-    # BTC with 2 entries
\ No newline at end of file
+    # BTC with 2 entries
+
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 0.5) == 3
+    assert percentile(values, 1) == 5
+    assert percentile(values, 0) == 1
+    assert percentile(list(range(1, 101)), 0.95) == 95
+    assert percentile([], 0.5) is None
@@ -0,0 +1,23 @@
+from pymongo import InsertOne
+import app.lib.db as db
+
+
+class FakeCollection:
+
+    def __init__(self, writes):
+        self.writes = writes
+
+    def bulk_write(self, operations, ordered=True):
+        self.writes.append(len(operations))
+
+
+def test_buffered_writer(monkeypatch):
+    writes = []
+    monkeypatch.setattr(db, 'db_connection', lambda: {'audit': {'audit': FakeCollection(writes)}})
+    writer = db.BufferedWriter(batch_size=10, interval=60, max_queued=100)
+    for i in range(25):
+        writer.write('audit', 'audit', InsertOne({'i': i}))
+    writer.flush()
+    # full batches are written straight away, the rest once the interval is up or on flush
+    assert sum(writes) == 25
+    assert writes[:2] == [10, 10]
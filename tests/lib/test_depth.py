@@ -0,0 +1,23 @@
+from decimal import Decimal
+from app.lib.depth import optimal_volume, walk, remaining
+
+
+def levels(*pairs):
+    return [{'price': Decimal(price), 'volume': Decimal(volume)} for price, volume in pairs]
+
+
+def test_optimal_volume():
+    asks = levels(('1.00', '1'), ('1.02', '1'), ('1.05', '5'))
+    bids = levels(('1.04', '1.5'), ('1.01', '2'))
+    # the second ask is still worth buying up to the end of the first bid, after that every unit loses
+    assert optimal_volume(asks, bids, 0, 0) == 1.5
+    # with fees only the first ask is worth buying
+    assert optimal_volume(asks, bids, 0.01, 0.01) == 1
+    # the cost of buying is capped
+    assert optimal_volume(asks, bids, 0, 0, max_cost=0.5) == 0.5
+    assert optimal_volume(asks, bids, 0, 0, max_volume=1.2) == 1.2
+    # a trade too small to make a profit
+    assert optimal_volume(asks, bids, 0, 0, min_volume=3.4) == 0
+
+    assert walk(asks, Decimal('1.5')) == levels(('1.00', '1'), ('1.02', '0.5'))
+    assert remaining(asks, Decimal('1.5')) == levels(('1.02', '0.5'), ('1.05', '5'))
@@ -0,0 +1,51 @@
+import threading
+import time
+from pytest import raises
+from app.lib.fiatcache import FiatRateCache, FiatRateError
+
+
+def test_fiat_rate_cache():
+    stored = {}
+    downloads = []
+    release = threading.Event()
+
+    def load(symbol):
+        return stored.get(symbol)
+
+    def download(symbol):
+        downloads.append(symbol)
+        release.wait(5)
+        stored[symbol] = (len(downloads) * 100, time.time())
+
+    cache = FiatRateCache(ttl=60, load=load, download=download)
+    # callers that miss at the same time wait for one download
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('BTC'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [100] * 4
+    assert downloads == ['BTC']
+
+    # a stale rate is returned straight away and refreshed in the background
+    cache.rates['BTC'] = (100, time.time() - 1)
+    stored['BTC'] = (100, time.time() - 120)
+    assert cache.get('BTC') == 100
+    for _ in range(50):
+        if cache.get('BTC') == 200:
+            break
+        time.sleep(0.01)
+    assert cache.get('BTC') == 200
+    assert downloads == ['BTC', 'BTC']
+
+
+def test_fiat_rate_cache_unavailable():
+    def download(symbol):
+        raise ValueError('CoinGecko is down')
+
+    cache = FiatRateCache(ttl=60, load=lambda symbol: None, download=download)
+    with raises(FiatRateError):
+        cache.get('BTC')
@@ -0,0 +1,110 @@
+from app.lib.jobqueue import write_result_frame, read_result_frames, bson_compatible, StreamTail, JobqueueError, \
+    job_key, record_stage, reset_stages, return_result, set_result_callback, Jobqueue, STATUS_CREATING, \
+    STATUS_CANCELLED
+from pymongo.errors import BulkWriteError
+from decimal import Decimal
+from bson import ObjectId, Decimal128
+from pytest import raises
+from types import SimpleNamespace
+import io
+import os
+
+
+def test_result_frames():
+    result = {'downstream_jobs': [], 'price': Decimal('0.00012345'), 'audit_id': ObjectId('507f191e810c19729de860ea')}
+    read_fd, write_fd = os.pipe()
+    write_result_frame(write_fd, {'first': True})
+    write_result_frame(write_fd, result)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as pipe:
+        data = pipe.read()
+    results = read_result_frames(data)
+    assert results == [{'first': True}, result]
+    assert isinstance(results[1]['price'], Decimal)
+
+    assert read_result_frames(b'') == []
+    with raises(JobqueueError):
+        read_result_frames(data[:-1])
+
+
+def test_bson_compatible():
+    result = bson_compatible({'job_result': {'volume': Decimal('1.5'), 'fills': [Decimal('0.5'), 'x']}})
+    assert result == {'job_result': {'volume': Decimal128('1.5'), 'fills': [Decimal128('0.5'), 'x']}}
+
+
+def test_stream_tail():
+    tail = StreamTail(io.BufferedReader(io.BytesIO(b'a' * 1000 + b'the end')), limit=7)
+    tail.start()
+    tail.join()
+    assert tail.text() == 'the end'
+
+
+def test_job_key():
+    key = job_key('compare', {'curr_y': 'BTC', 'curr_x': 'ETH', 'jobqueue_id': '1'})
+    assert key == 'COMPARE:curr_x=ETH,curr_y=BTC,jobqueue_id=1'
+    assert key != job_key('COMPARE', {'curr_y': 'BTC', 'curr_x': 'ETH', 'jobqueue_id': '2'})
+
+
+def test_job_stages():
+    results = []
+    set_result_callback(results.append)
+    reset_stages()
+    record_stage('imports_done')
+    record_stage('first_exchange_response')
+    return_result({'downstream_jobs': []})
+    # only the first time a stage is reached counts
+    record_stage('first_exchange_response')
+    return_result({'downstream_jobs': []})
+    set_result_callback(None)
+    reset_stages()
+    assert results[0]['job_timestamps'] == results[1]['job_timestamps']
+
+    job = {'job_timestamps': {'enqueued': 1, 'dispatched': 2}}
+    Jobqueue().set_job_result(job, results[1])
+    assert job['job_result'] == {'downstream_jobs': []}
+    assert list(job['job_timestamps']) == ['enqueued', 'dispatched', 'imports_done', 'first_exchange_response',
+                                           'result_parsed']
+
+
+class FakeJobs:
+
+    def __init__(self, fail_at=None):
+        self.jobs = {}
+        self.fail_at = fail_at
+
+    def insert_many(self, documents, ordered=True):
+        for index, document in enumerate(documents):
+            if index == self.fail_at:
+                raise BulkWriteError({'nInserted': index, 'writeErrors': [{'index': index, 'code': 11000,
+                                                                           'errmsg': 'duplicate key'}]})
+            document.setdefault('_id', ObjectId())
+            self.jobs[document['_id']] = dict(document)
+        return SimpleNamespace(inserted_ids=[document['_id'] for document in documents])
+
+    def update_many(self, query, update):
+        for _id in query['_id']['$in']:
+            if self.jobs[_id]['job_status'] == query['job_status']:
+                self.jobs[_id].update(update['$set'])
+                for field in update.get('$unset', {}):
+                    self.jobs[_id].pop(field, None)
+
+
+def compare_job(curr_x):
+    return {'job_type': 'COMPARE', 'job_args': {'curr_x': curr_x, 'curr_y': 'BTC', 'jobqueue_id': '1'}}
+
+
+def test_add_jobs():
+    jq = Jobqueue()
+    added = []
+    jq.bind_to(added.append)
+    jq.db = {'jobs': FakeJobs()}
+    _ids = jq.add_jobs([compare_job('ETH'), compare_job('LTC')])
+    assert added == [_ids]
+    assert [jq.db['jobs'].jobs[_id]['job_status'] for _id in _ids] == [STATUS_CREATING, STATUS_CREATING]
+
+    # the first job is inserted but the second is not, so the first is cancelled rather than run on its own
+    jq.db = {'jobs': FakeJobs(fail_at=1)}
+    assert jq.add_jobs([compare_job('ETH'), compare_job('LTC')]) == []
+    assert added == [_ids]
+    jobs = list(jq.db['jobs'].jobs.values())
+    assert len(jobs) == 1 and jobs[0]['job_status'] == STATUS_CANCELLED and 'job_key' not in jobs[0]
@@ -0,0 +1,27 @@
+from decimal import Decimal
+from testdata.wraps import wrap_exchange1, wrap_exchange2
+from testdata.markets import MARKETS
+from app.lib.prefilter import screen
+from app.jobs.compare import find_arbitrage, available_volume
+from tests.jobs.test_compare import JOBQUEUE_ID
+
+
+def test_screen():
+    exchange1 = wrap_exchange1.exchange1(JOBQUEUE_ID)
+    exchange2 = wrap_exchange2.exchange2(JOBQUEUE_ID)
+    exchange1.set_trade_pair('ETH-BTC', MARKETS)
+    exchange2.set_trade_pair('ETH-BTC', MARKETS)
+    exchange1.order_book()
+    exchange2.order_book()
+    # exchange1 has no order book for the second pair, only one exchange is left so nothing can pass
+    unquoted = wrap_exchange1.exchange1(JOBQUEUE_ID)
+
+    candidates = screen([[exchange1, exchange2], [exchange2, unquoted]], [Decimal(100), Decimal(100)], 0,
+                        available_volume)
+    # only buying on exchange2 and selling on exchange1 crosses after fees
+    assert candidates == [[(exchange2, exchange1)], []]
+    arbitrage = find_arbitrage(exchange2, exchange1, Decimal(100), fiat_arbitrage_minimum=0)
+    assert arbitrage['profit'] == Decimal('0.0821')
+
+    # the screen's bound is the exact profit here, a higher minimum rules the combination out
+    assert screen([[exchange1, exchange2]], [Decimal(100)], Decimal('0.0822'), available_volume) == [[]]
@@ -0,0 +1,37 @@
+from testdata.wraps import wrap_exchange1
+from testdata.markets import MARKETS
+from app.lib.recorder import record_order_book, Recording
+from app.lib.common import dynamically_import_exchange
+from app.replay.exchange import play, seek
+from tests.jobs.test_compare import JOBQUEUE_ID
+
+
+def test_record_and_replay(tmp_path):
+    exchange = wrap_exchange1.exchange1(JOBQUEUE_ID)
+    exchange.set_trade_pair('ETH-BTC', MARKETS)
+    exchange.order_book()
+    record_order_book(exchange, str(tmp_path))
+    record_order_book(exchange, str(tmp_path))
+
+    recording = Recording([str(tmp_path)])
+    assert recording.trade_pairs() == ['ETH-BTC']
+    times = recording.times('ETH-BTC')
+    assert len(times) == 2
+    assert recording.book('exchange1', 'ETH-BTC', times[0] - 1) is None
+    assert recording.book('exchange1', 'ETH-BTC', times[1]) == (exchange.asks, exchange.bids)
+
+    # a replay wrap is set up from the recorded market and fetches the recorded order book
+    recording.books[('binance', 'ETH-BTC')] = recording.books[('exchange1', 'ETH-BTC')]
+    recording.book_times[('binance', 'ETH-BTC')] = times
+    recording.markets['binance'] = recording.markets['exchange1']
+    play(recording)
+    seek(times[1])
+    replayed = dynamically_import_exchange('binance', 'app.replay.wrap')(JOBQUEUE_ID)
+    replayed.set_trade_pair('ETH-BTC', recording.markets)
+    assert replayed.fee == exchange.fee
+    replayed.order_book()
+    assert replayed.lowest_ask == exchange.lowest_ask
+    assert replayed.highest_bid == exchange.highest_bid
+    # the recorded order book is not changed by what compares do to the replayed one
+    replayed.lowest_ask['volume'] = 0
+    assert recording.book('binance', 'ETH-BTC', times[1])[0][0] == exchange.lowest_ask
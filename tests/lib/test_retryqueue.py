@@ -0,0 +1,32 @@
+from app.lib.retryqueue import RetryQueue, retry_delay
+import threading
+import time
+
+
+def test_retry_queue_order():
+    retried = []
+    done = threading.Event()
+
+    def callback(_id):
+        retried.append(_id)
+        if len(retried) == 3:
+            done.set()
+
+    queue = RetryQueue(callback)
+    queue.start()
+    now = time.time()
+    queue.schedule('later', now + 0.2)
+    queue.schedule('overdue', now - 10)
+    queue.schedule('soon', now + 0.1)
+    assert done.wait(2)
+    queue.stop()
+    assert retried == ['overdue', 'soon', 'later']
+    assert len(queue) == 0
+
+
+def test_retry_delay():
+    assert retry_delay(1, 20, max_delay=600, jitter=0) == 20
+    assert retry_delay(3, 20, max_delay=600, jitter=0) == 80
+    assert retry_delay(10, 20, max_delay=600, jitter=0) == 600
+    for _ in range(100):
+        assert 16 <= retry_delay(1, 20, max_delay=600, jitter=0.2) <= 24
@@ -0,0 +1,110 @@
+import time
+from app.lib.scheduler import JobScheduler
+
+
+def job(_id, job_type, **job_args):
+    return {'_id': _id, 'job_type': job_type, 'job_args': job_args}
+
+
+class TestClass(object):
+    def make_scheduler(self, type_limits=None, exchange_limit=10, saturation=10, max_running=10,
+                       freshness_deadline=15):
+        self.launched = []
+        self.cancelled = []
+        return JobScheduler(launch=self.launch,
+                            cancel=lambda j, reason: self.cancelled.append(j['_id']),
+                            priority_order=['TRANSACT', 'REPLENISH', 'COMPARE', 'WITHDRAWAL_FEE'],
+                            type_limits=type_limits or {},
+                            exchange_limit=exchange_limit,
+                            saturation=saturation,
+                            max_running=max_running,
+                            freshness_deadline=freshness_deadline)
+
+    def launch(self, j):
+        self.launched.append(j['_id'])
+        return True
+
+    def test_type_limit(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 2})
+        for i in range(3):
+            scheduler.submit(job(i, 'COMPARE', curr_x='ETH', curr_y=str(i)))
+        assert self.launched == [0, 1]
+        assert scheduler.queue_depth() == 1
+        scheduler.release(job(0, 'COMPARE'))
+        assert self.launched == [0, 1, 2]
+
+    def test_priority(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 0, 'TRANSACT': 0})
+        scheduler.submit(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        scheduler.submit(job(2, 'TRANSACT', exchange='exchange1'))
+        assert self.launched == []
+        # once there is room the TRANSACT is started ahead of the COMPARE that has been waiting longer
+        scheduler.type_limits = {'COMPARE': 1, 'TRANSACT': 1}
+        scheduler.dispatch()
+        assert self.launched == [2, 1]
+
+    def test_exchange_limit(self):
+        scheduler = self.make_scheduler(exchange_limit=1)
+        scheduler.submit(job(1, 'TRANSACT', exchange='exchange1'))
+        scheduler.submit(job(2, 'TRANSACT', exchange='exchange1'))
+        scheduler.submit(job(3, 'TRANSACT', exchange='exchange2'))
+        assert self.launched == [1, 3]
+        scheduler.release(job(1, 'TRANSACT', exchange='exchange1'))
+        assert self.launched == [1, 3, 2]
+
+    def test_duplicate_submit(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 0})
+        scheduler.submit(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        scheduler.submit(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        assert scheduler.queue_depth() == 1
+
+    def test_saturation(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 0}, saturation=2)
+        scheduler.submit(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        scheduler.submit(job(2, 'COMPARE', curr_x='LTC', curr_y='BTC'))
+        # saturated: a newer COMPARE for a waiting pair replaces the waiting one
+        scheduler.submit(job(3, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        assert self.cancelled == [1]
+        # saturated: a COMPARE for a pair that is not waiting is shed
+        scheduler.submit(job(4, 'COMPARE', curr_x='REP', curr_y='ETH'))
+        assert self.cancelled == [1, 4]
+        # other job types are never shed
+        scheduler.submit(job(5, 'TRANSACT', exchange='exchange1'))
+        assert self.launched == [5]
+        scheduler.type_limits = {'COMPARE': 2}
+        scheduler.dispatch()
+        assert self.launched == [5, 3, 2]
+
+    def test_launch_failure_frees_slot(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 1})
+        self.launch = lambda j: False
+        scheduler.launch = self.launch
+        scheduler.submit(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'))
+        assert not scheduler.is_known(1)
+
+    def test_submit_many(self):
+        scheduler = self.make_scheduler()
+        # jobs submitted together are started in priority order rather than the order they were submitted in
+        scheduler.submit_many([job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'),
+                                    job(2, 'TRANSACT', exchange='exchange1'),
+                                    job(3, 'TRANSACT', exchange='exchange2')])
+        assert self.launched == [2, 3, 1]
+
+    def test_max_running(self):
+        scheduler = self.make_scheduler(max_running=2)
+        scheduler.submit_many([job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'),
+                                    job(2, 'TRANSACT', exchange='exchange1'),
+                                    job(3, 'TRANSACT', exchange='exchange2')])
+        assert self.launched == [2, 3]
+        scheduler.release(job(2, 'TRANSACT', exchange='exchange1'))
+        assert self.launched == [2, 3, 1]
+
+    def test_freshness_deadline(self):
+        scheduler = self.make_scheduler(type_limits={'COMPARE': 0})
+        stale = dict(job(1, 'COMPARE', curr_x='ETH', curr_y='BTC'), job_timestamps={'enqueued': time.time() - 20})
+        fresh = dict(job(2, 'COMPARE', curr_x='LTC', curr_y='BTC'), job_timestamps={'enqueued': time.time()})
+        scheduler.submit_many([stale, fresh])
+        assert self.cancelled == [1]
+        scheduler.type_limits = {}
+        scheduler.dispatch()
+        assert self.launched == [2]
@@ -0,0 +1,9 @@
+from app.lib.sharding import partition
+
+
+def test_partition():
+    trade_pairs = ['ETH-BTC', 'ETC-ETH', 'LTC-BTC', 'REP-ETH', 'GNT-ETH', 'ZRX-ETH']
+    shards = partition(trade_pairs, 4)
+    assert shards == [['ETH-BTC', 'GNT-ETH'], ['ETC-ETH', 'ZRX-ETH'], ['LTC-BTC'], ['REP-ETH']]
+    # more shards than exchanges leaves some shards without an exchange of their own
+    assert partition(['binance', 'hitbtc'], 3) == [['binance'], ['hitbtc'], []]
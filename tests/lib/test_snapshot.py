@@ -0,0 +1,23 @@
+from app.lib.snapshot import MarketSnapshot
+
+ORDER_BOOKS = {'BTC_ETH': {'asks': [['0.1', 1]], 'bids': [['0.09', 2]]}, 'BTC_LTC': {'asks': [], 'bids': []}}
+
+
+def test_snapshot(tmp_path):
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return ORDER_BOOKS
+
+    snapshot = MarketSnapshot('test', max_age=60, directory=str(tmp_path))
+    assert snapshot.get('BTC_ETH', fetch) == ORDER_BOOKS['BTC_ETH']
+    # another process reads the same snapshot rather than fetching again
+    other = MarketSnapshot('test', max_age=60, directory=str(tmp_path))
+    assert other.get('BTC_LTC', fetch) == ORDER_BOOKS['BTC_LTC']
+    assert other.get('BTC_XRP', fetch) is None
+    assert len(fetches) == 1
+
+    stale = MarketSnapshot('test', max_age=0, directory=str(tmp_path))
+    stale.get('BTC_ETH', fetch)
+    assert len(fetches) == 2
@@ -0,0 +1,107 @@
+import time
+from types import SimpleNamespace
+import app.execute as execute
+from app.execute import JobQueueExecutor
+from app.lib.jobqueue import JOB_COLLECTION, JOB_STATUS_COLLECTION, STATUS_CREATING, STATUS_RUNNING, STATUS_FAILED
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        value = document.get(field)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$nin' in condition and value in condition['$nin']:
+                return False
+            if '$lt' in condition and (value is None or value >= condition['$lt']):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+# just enough of a pymongo collection for the executor's job handling
+class FakeCollection:
+
+    def __init__(self, documents=None):
+        self.documents = list(documents or [])
+
+    def find(self, query, projection=None):
+        return FakeCursor([document for document in self.documents if matches(document, query)])
+
+    def find_one(self, query):
+        return next(iter(self.find(query)), None)
+
+    def update_one(self, query, update):
+        return self.update(query, update, many=False)
+
+    def update_many(self, query, update):
+        return self.update(query, update, many=True)
+
+    def find_one_and_update(self, query, update, return_document=None):
+        document = self.find_one(query)
+        if document:
+            self.update_one({'_id': document['_id']}, update)
+        return document
+
+    def update(self, query, update, many):
+        modified = 0
+        for document in self.find(query):
+            for field, value in update.get('$set', {}).items():
+                *parents, name = field.split('.')
+                target = document
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[name] = value
+            for field in update.get('$unset', {}):
+                document.pop(field, None)
+            modified += 1
+            if not many:
+                break
+        return SimpleNamespace(matched_count=modified, modified_count=modified)
+
+
+class FakeCursor(list):
+
+    def sort(self, keys):
+        return self
+
+
+def compare_job(_id, owner, lease_expires):
+    return {'_id': _id, 'job_type': 'COMPARE', 'job_status': STATUS_RUNNING, 'job_owner': owner,
+            'job_lease_expires': lease_expires, 'job_timestamps': {'enqueued': time.time()},
+            'job_args': {'curr_x': 'ETH', 'curr_y': 'BTC', 'jobqueue_id': owner}}
+
+
+def executor(_id, jobs, monkeypatch):
+    monkeypatch.setattr(execute, 'remove_api_method_locks', lambda: None)
+    node = JobQueueExecutor()
+    node._id = _id
+    node.jq.db = {JOB_COLLECTION: jobs, JOB_STATUS_COLLECTION: FakeCollection()}
+    node.launched = []
+    # claim the job as launch_job does without running it
+    node.scheduler.launch = lambda job: node.launched.append(node.claim_job(job)['_id']) or True
+    return node
+
+
+def test_reclaim_starts_jobs_again(monkeypatch):
+    jobs = FakeCollection([compare_job(1, 'dead', 0),
+                           dict(compare_job(2, 'dead', 0), job_type='TRANSACT', job_args={})])
+    node = executor('node', jobs, monkeypatch)
+    node.heartbeat()
+    # the expired COMPARE is put back to CREATING and started straight away, the TRANSACT is failed
+    assert node.launched == [1]
+    assert jobs.find_one({'_id': 1})['job_owner'] == 'node'
+    assert jobs.find_one({'_id': 2})['job_status'] == STATUS_FAILED
+
+
+def test_stopped_jobs_started_by_next_job_queue(monkeypatch):
+    jobs = FakeCollection([compare_job(1, 'stopping', time.time() + 60)])
+    stopping = executor('stopping', jobs, monkeypatch)
+    stopping.stop_jobqueue()
+    assert jobs.find_one({'_id': 1})['job_status'] == STATUS_CREATING
+
+    node = executor('node', jobs, monkeypatch)
+    node.start_released()
+    assert node.launched == [1]
+    assert jobs.find_one({'_id': 1})['job_status'] == STATUS_RUNNING
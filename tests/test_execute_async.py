@@ -0,0 +1,30 @@
+import asyncio
+from app.execute_async import AsyncJobQueueExecutor
+from app.lib.jobqueue import JOB_STATUS_COLLECTION
+
+
+class FakeStatus:
+
+    def __init__(self, running):
+        self.running = running
+
+    def find_one(self, query):
+        return {'_id': query['_id'], 'running': self.running}
+
+
+def test_check_running():
+    executor = AsyncJobQueueExecutor()
+    executor._id = 'x'
+
+    async def check(running):
+        executor.loop = asyncio.get_running_loop()
+        executor.stopped = asyncio.Event()
+        executor.jq.db = {JOB_STATUS_COLLECTION: FakeStatus(running)}
+        await executor.run_db(executor.check_running)
+        # let the loop run the callback set from the database thread
+        await asyncio.sleep(0)
+        return executor.stopped.is_set()
+
+    assert not asyncio.run(check(True))
+    # jobqueue stop marks the job queue as no longer running, which stops the executor
+    assert asyncio.run(check(False))
@@ -1,4 +1,5 @@
 from app.wraps.wrap_p2pb2b import p2pb2b
+from app.wraps import wrap_p2pb2b
 from tests.jobs.test_compare import JOBQUEUE_ID
 from testdata.markets import MARKETS
 import datetime
@@ -96,3 +97,19 @@ class mockdatetime:
 
     def fromtimestamp(self, timestamp):
         return datetime.datetime.fromtimestamp(timestamp)
+
+
+def test_get_balances(monkeypatch):
+    exchange = setup()
+    stored = []
+    # the api was called a moment ago, e.g. before a trade invalidated the balance cache
+    monkeypatch.setattr(wrap_p2pb2b, 'get_api_access_time', lambda *args: datetime.datetime.utcnow())
+    monkeypatch.setattr(wrap_p2pb2b, 'get_api_method_lock', lambda *args: None)
+    for name in ['lock_api_method', 'unlock_api_method', 'store_api_access_time']:
+        monkeypatch.setattr(wrap_p2pb2b, name, lambda *args: None)
+    monkeypatch.setattr(wrap_p2pb2b, 'store_balances', lambda *args: stored.append(args))
+    exchange.api.getBalances = lambda: {'success': True, 'result': {'BTC': {'available': '1.5'}}}
+    exchange.get_balances()
+    # the balances are fetched again rather than read back from the history
+    assert exchange.balances == {'BTC': Decimal('1.5')}
+    assert stored == [('p2pb2b', {'BTC': Decimal('1.5')})]
@@ -1,6 +1,22 @@
+from app.lib.snapshot import MarketSnapshot
+from app.wraps import wrap_poloniex
 from app.wraps.wrap_poloniex import poloniex
 
+ORDER_BOOKS = {'BTC_ETH': {'asks': [['0.031', '2'], ['0.032', '5']], 'bids': [['0.030', '3'], ['0.029', '7']],
+                           'isFrozen': '0', 'seq': 1}}
+
 
 def test_can_initialise_class():
     initialised = poloniex(jobqueue_id='x')
     assert (isinstance(initialised, poloniex))
+
+
+def test_order_book_from_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(wrap_poloniex, 'ORDER_BOOKS', MarketSnapshot('test', directory=str(tmp_path)))
+    initialised = poloniex(jobqueue_id='x')
+    initialised.api.returnOrderBook = lambda: ORDER_BOOKS
+    initialised.trade_pair = 'BTC_ETH'
+    initialised.order_book()
+    # the order book is read from the shared snapshot
+    assert [str(x['price']) for x in initialised.asks] == ['0.031', '0.032']
+    assert [str(x['price']) for x in initialised.bids] == ['0.030', '0.029']